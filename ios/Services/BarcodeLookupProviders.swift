@@ -129,7 +129,7 @@ private actor LocalBarcodeDatabaseReader {
                 let row = try Row.fetchOne(
                     db,
                     sql: """
-                    SELECT barcode, name, brand, category
+                    SELECT name, brand, category
                     FROM products
                     WHERE barcode = ?
                     LIMIT 1
@@ -140,7 +140,6 @@ private actor LocalBarcodeDatabaseReader {
                 return nil
             }
 
-            let resolvedBarcode = (row["barcode"] as String?)?.trimmingCharacters(in: .whitespacesAndNewlines) ?? barcode
             let resolvedCategory = ((row["category"] as String?)?.trimmingCharacters(in: .whitespacesAndNewlines)).flatMap {
                 $0.isEmpty ? nil : $0
             } ?? "Продукты"
@@ -148,8 +147,10 @@ private actor LocalBarcodeDatabaseReader {
                 value.isEmpty ? nil : value
             }
 
+            // Indexes built with --schema integer store the canonical GTIN as an INTEGER key;
+            // column affinity still matches the scanned text, so report the requested code.
             return ProductRecord(
-                barcode: resolvedBarcode,
+                barcode: barcode,
                 name: (row["name"] as String?) ?? "",
                 brand: brand,
                 category: resolvedCategory
@@ -0,0 +1,1066 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import csv
+import gc
+import gzip
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import build_barcode_index as builder  # noqa: E402
+
+NAME_WORDS = (
+    "Молоко",
+    "Кефир",
+    "Сыр",
+    "Российский",
+    "пастеризованное",
+    "Хлеб",
+    "Бородинский",
+    "Шоколад",
+    "молочный",
+    "Крем",
+    "для",
+    "рук",
+    "Корм",
+    "для кошек",
+    "Chocolate",
+    "Milk",
+    "ёлочный",
+)
+BRANDS = ("Простоквашино", "Вкуснотеево", "Бабаевский", "Nestlé", "Felix", "Чистая линия", "")
+CATEGORIES = ("Молочные продукты", "Хлеб", "Сладости", "Корма", "Косметика", "en:beverages", "")
+JUNK_NAMES = ("", "Штрихкод", "поиск", "1234567", "   ")
+OPENFACTS_FILLER_COLUMNS = 190
+GENERATOR_VERSION = 1
+SCALES = {"100k": 100_000, "1m": 1_000_000, "10m": 10_000_000}
+# Share of the total row count per raw file, roughly the proportions of the real downloads.
+SOURCE_SHARES = (
+    ("uhtt_barcode_ref_all.zip", 0.15),
+    ("catalog-barcodes-csv.zip", 0.25),
+    ("openfoodfacts-products.csv.gz", 0.45),
+    ("openbeautyfacts-products.csv.gz", 0.05),
+    ("openpetfoodfacts-products.csv.gz", 0.05),
+    ("openproductsfacts-products.csv.gz", 0.05),
+)
+UHTT_ENTRIES = 2
+BENCH_MANIFEST = "bench-manifest.json"
+BASELINE_PATH = Path(__file__).resolve().parent / "bench_baseline.json"
+# Phases shorter than this in the baseline are too noisy to compare on their own.
+MIN_COMPARABLE_SECONDS = 0.5
+SEARCH_QUERIES = {
+    "prefix": ("мо", "мол", "моло", "шок", "хле", "кр", "ёл", "fel", "nes", "chocol"),
+    "multi-token": ("молоко паст", "шоколад молоч", "корм для ко", "крем для р", "сыр росс", "milk choc"),
+}
+SEARCH_LIMIT = 20
+LOOKUP_SQL = "SELECT name, brand, category FROM products WHERE barcode = ? LIMIT 1"
+LOOKUP_SAMPLE = 20_000
+LOOKUP_PAGE_SIZES = (1024, 4096, 16384)
+LOOKUP_EXTRA_INDEX = "idx_products_source_rank_quality"
+LOOKUP_COLD_SAMPLE = 300
+ZIPF_EXPONENT = 1.1
+
+
+def synthetic_barcode(rng: random.Random, pool: int) -> str:
+    # A bounded pool makes duplicates across rows and sources realistic.
+    body = f"46{rng.randrange(pool):010d}"
+    return body + str(builder.gtin_check_digit(body))
+
+
+def synthetic_row_fields(rng: random.Random, pool: int) -> tuple:
+    """(barcode, name, brand, category) with the junk mix the real dumps have."""
+    barcode = "" if rng.random() < 0.02 else synthetic_barcode(rng, pool)
+    name = barcode if barcode and rng.random() < 0.03 else synthetic_name(rng)
+    return barcode, name, rng.choice(BRANDS), rng.choice(CATEGORIES)
+
+
+def synthetic_name(rng: random.Random) -> str:
+    if rng.random() < 0.08:
+        return rng.choice(JUNK_NAMES)
+    return " ".join(rng.choice(NAME_WORDS) for _ in range(rng.randint(1, 5))) + f" {rng.randint(1, 999)} г"
+
+
+def openfacts_header() -> List[str]:
+    filler = [f"field_{index:03d}" for index in range(OPENFACTS_FILLER_COLUMNS)]
+    return ["code", "url", "creator", *filler[:60], "product_name", "abbreviated_product_name", "generic_name",
+            *filler[60:120], "brands", "categories", "countries_tags", *filler[120:]]
+
+
+def write_uhtt_zip(path: Path, rows: int, seed: int = 1, pool: Optional[int] = None) -> None:
+    rng = random.Random(seed)
+    pool = pool or max(rows // 2, 1)
+    per_entry = -(-rows // UHTT_ENTRIES)
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+        for entry in range(UHTT_ENTRIES):
+            name = f"UhttBarcodeReference/DATA/uhtt_barcode_ref_{entry + 1:04d}.csv"
+            with archive.open(name, "w") as binary_file:
+                with io.TextIOWrapper(binary_file, encoding="utf-8", newline="") as handle:
+                    writer = csv.writer(handle, delimiter="\t", lineterminator="\n")
+                    writer.writerow(["ID", "Code", "Name", "GroupID", "GroupName", "BrandID", "BrandName"])
+                    for row_id in range(entry * per_entry, min(rows, (entry + 1) * per_entry)):
+                        if rng.random() < 0.01:
+                            writer.writerow([str(row_id), "truncated"])
+                            continue
+                        barcode, name, brand, category = synthetic_row_fields(rng, pool)
+                        writer.writerow([str(row_id), barcode, name, str(rng.randint(1, 500)), category, "0", brand])
+
+
+def write_catalog_zip(path: Path, rows: int, seed: int = 1, pool: Optional[int] = None) -> None:
+    rng = random.Random(seed)
+    pool = pool or max(rows // 2, 1)
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+        with archive.open("barcodes.csv", "w") as binary_file:
+            with io.TextIOWrapper(binary_file, encoding="utf-8", newline="") as handle:
+                writer = csv.writer(handle, delimiter=";", lineterminator="\n")
+                writer.writerow(["Id", "Category", "Vendor", "Name", "Article", "Barcode"])
+                for row_id in range(rows):
+                    barcode, name, brand, category = synthetic_row_fields(rng, pool)
+                    writer.writerow([str(row_id), category, brand, name, f"A{rng.randrange(10**6)}", barcode])
+
+
+def write_catalog_db_zip(path: Path, rows: int, seed: int = 1, pool: Optional[int] = None) -> None:
+    """The rows of write_catalog_zip() with the same seed, as catalog.app's SQLite export."""
+    rng = random.Random(seed)
+    pool = pool or max(rows // 2, 1)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database = Path(tmp_dir) / "barcodes.db"
+        connection = sqlite3.connect(database)
+        try:
+            connection.execute(
+                """
+                CREATE TABLE barcodes (
+                    Id INTEGER PRIMARY KEY, Category TEXT, Vendor TEXT, Name TEXT, Article TEXT, Barcode TEXT
+                )
+                """
+            )
+            batch = []
+            for row_id in range(rows):
+                barcode, name, brand, category = synthetic_row_fields(rng, pool)
+                batch.append((row_id, category, brand, name, f"A{rng.randrange(10**6)}", barcode))
+            connection.executemany("INSERT INTO barcodes VALUES (?, ?, ?, ?, ?, ?)", batch)
+            connection.commit()
+        finally:
+            connection.close()
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+            archive.write(database, "barcodes.db")
+
+
+def write_openfacts_gzip(path: Path, rows: int, seed: int = 1, pool: Optional[int] = None) -> None:
+    rng = random.Random(seed)
+    header = openfacts_header()
+    positions = {name: index for index, name in enumerate(header)}
+    pool = pool or max(rows // 2, 1)
+    with gzip.open(path, "wt", encoding="utf-8", newline="", compresslevel=1) as handle:
+        writer = csv.writer(handle, delimiter="\t", lineterminator="\n")
+        writer.writerow(header)
+        for _ in range(rows):
+            row = [""] * len(header)
+            row[positions["code"]], row[positions["product_name"]], _, _ = synthetic_row_fields(rng, pool)
+            if rng.random() < 0.3:
+                row[positions["generic_name"]] = synthetic_name(rng)
+            row[positions["brands"]] = ",".join(rng.sample(BRANDS, rng.randint(0, 2)))
+            row[positions["categories"]] = ",".join(rng.sample(CATEGORIES, rng.randint(0, 3)))
+            row[positions["countries_tags"]] = rng.choice(("en:russia", "en:france", "en:germany,en:russia", ""))
+            for index in rng.sample(range(len(header)), 12):
+                if not row[index]:
+                    row[index] = str(rng.randint(0, 10_000))
+            writer.writerow(row)
+
+
+def parse_openfacts_dictreader(path: Path, source: str, source_rank: int) -> Iterator[builder.Candidate]:
+    """The csv.DictReader parser the positional reader replaced, kept as a reference."""
+    with gzip.open(path, "rt", encoding="utf-8", errors="ignore", newline="") as text_file:
+        reader = csv.DictReader(text_file, delimiter="\t")
+        for row in reader:
+            barcode = builder.normalize_barcode(row.get("code", ""))
+            if not barcode:
+                continue
+
+            name = (
+                builder.normalize_optional(row.get("product_name"))
+                or builder.normalize_optional(row.get("generic_name"))
+                or builder.normalize_optional(row.get("abbreviated_product_name"))
+            )
+            if not name:
+                continue
+
+            brand_raw = builder.normalize_optional(row.get("brands"))
+            brand = None
+            if brand_raw:
+                brand = builder.normalize_optional(brand_raw.split(",")[0])
+
+            category_raw = builder.normalize_optional(row.get("categories"))
+            category = None
+            if category_raw:
+                category = builder.normalize_optional(category_raw.split(",")[0])
+
+            yield builder.Candidate(
+                barcode=barcode,
+                name=name,
+                brand=brand,
+                category=category,
+                source=source,
+                source_rank=source_rank,
+                quality_score=builder.compute_quality_score(name, barcode),
+            )
+
+
+def time_parser(
+    label: str,
+    parse: Callable[[], Iterator[builder.Candidate]],
+    rows: int,
+    repeat: int,
+) -> List[builder.Candidate]:
+    best = float("inf")
+    candidates: List[builder.Candidate] = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        candidates = list(parse())
+        best = min(best, time.perf_counter() - started)
+    print(f"{label:<12} {best:8.3f} s  {rows / best:12,.0f} rows/s  candidates={len(candidates)}")
+    return candidates
+
+
+def bench_parse(rows: int, repeat: int, dump: Optional[Path]) -> int:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = dump
+        if path is None:
+            path = Path(tmp_dir) / "openfoodfacts-products.csv.gz"
+            write_openfacts_gzip(path, rows)
+
+        reference = time_parser(
+            "dictreader",
+            lambda: parse_openfacts_dictreader(path, "open_food_facts", 100),
+            rows,
+            repeat,
+        )
+        positional = time_parser(
+            "positional",
+            lambda: builder.parse_openfacts_gzip(path, "open_food_facts", 100),
+            rows,
+            repeat,
+        )
+
+    if positional != reference:
+        print("[error] positional reader output differs from the DictReader path", file=sys.stderr)
+        return 1
+    return 0
+
+
+REFERENCE_SPACE_RE = re.compile(r"\s+")
+
+
+def reference_normalize_text(value: str) -> str:
+    return REFERENCE_SPACE_RE.sub(" ", value.strip())
+
+
+def reference_normalize_optional(value: Optional[str]) -> Optional[str]:
+    if value is None:
+        return None
+    text = reference_normalize_text(value)
+    return text if text else None
+
+
+def reference_name_reject_reason(raw_name: str, barcode: str) -> Optional[str]:
+    """name_reject_reason() before the shared kernel: normalises, lowercases and scans on its own."""
+    name = reference_normalize_text(raw_name)
+    if not name:
+        return "empty_name"
+    lower = name.lower()
+    if lower == "поиск" or any(token in lower for token in builder.GENERIC_TOKENS):
+        return "generic_token"
+    if name == barcode:
+        return "name_is_barcode"
+    if builder.LETTER_RE.search(name) is None:
+        return "no_letters"
+    digits_only = "".join(ch for ch in name if ch.isdigit())
+    if digits_only == barcode and len(name) <= len(barcode) + 4:
+        return "digits_only_name"
+    return None
+
+
+def reference_quality_score(raw_name: str, barcode: str) -> int:
+    name = reference_normalize_text(raw_name)
+    score = sum(1 for ch in name if ch.isalpha()) * 2 + min(len(name), 140)
+    lower = name.lower()
+    if lower.isupper():
+        score -= 2
+    if barcode in name:
+        score -= 20
+    if len(name) < 6:
+        score -= 10
+    if any(token in lower for token in builder.GENERIC_TOKENS):
+        score -= 1000
+    return score
+
+
+def reference_row(fields: tuple) -> tuple:
+    raw_barcode, raw_name, raw_brand, raw_category, listed = fields
+    barcode = "".join(ch for ch in raw_barcode if ch.isdigit())
+    name = reference_normalize_text(raw_name)
+    if listed:
+        brand_raw = reference_normalize_optional(raw_brand)
+        brand = reference_normalize_optional(brand_raw.split(",")[0]) if brand_raw else None
+        category_raw = reference_normalize_optional(raw_category)
+        category = reference_normalize_optional(category_raw.split(",")[0]) if category_raw else None
+    else:
+        brand = reference_normalize_optional(raw_brand)
+        category = reference_normalize_optional(raw_category)
+    return (
+        barcode,
+        name,
+        brand,
+        category,
+        reference_quality_score(name, barcode),
+        reference_name_reject_reason(name, barcode),
+    )
+
+
+def kernel_row(fields: tuple) -> tuple:
+    raw_barcode, raw_name, raw_brand, raw_category, listed = fields
+    barcode = builder.normalize_barcode(raw_barcode)
+    name = builder.normalize_text(raw_name)
+    field = builder.first_list_item if listed else builder.normalize_field
+    return (
+        barcode,
+        name,
+        field(raw_brand),
+        field(raw_category),
+        builder.compute_quality_score(name, barcode),
+        builder.name_reject_reason(name, barcode),
+    )
+
+
+def iter_fixture_fields(raw_dir: Path) -> Iterator[tuple]:
+    """(barcode, name, brand, category, listed) as each source's parser reads them from the raw files."""
+    for path in sorted(raw_dir.glob("*uhtt*.zip")):
+        with zipfile.ZipFile(path) as archive:
+            for entry in builder.list_uhtt_entries(archive):
+                with archive.open(entry) as handle:
+                    for row in csv.reader(io.TextIOWrapper(handle, encoding="utf-8", newline=""), delimiter="\t"):
+                        if len(row) >= 7 and row[0] != "ID":
+                            yield row[1], row[2], row[6], row[4], False
+    with zipfile.ZipFile(raw_dir / "catalog-barcodes-csv.zip") as archive:
+        with archive.open("barcodes.csv") as handle:
+            for row in csv.DictReader(io.TextIOWrapper(handle, encoding="utf-8", newline=""), delimiter=";"):
+                yield row["Barcode"], row["Name"], row["Vendor"], row["Category"], False
+    for path in sorted(raw_dir.glob("open*facts-products.csv.gz")):
+        with gzip.open(path, "rt", encoding="utf-8", newline="") as handle:
+            reader = csv.reader(handle, delimiter="\t")
+            code, name, brands, categories = builder.resolve_columns(
+                next(reader), ("code", "product_name", "brands", "categories")
+            )
+            for row in reader:
+                yield row[code], row[name], row[brands], row[categories], True
+
+
+def bench_normalize(scale: str, work_dir: Optional[Path], repeat: int) -> int:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw_dir = (work_dir or Path(tmp_dir)) / scale / "raw"
+        ensure_synthetic_raw(raw_dir, SCALES[scale])
+        rows = list(iter_fixture_fields(raw_dir))
+
+    results = {}
+    for label, row_function, caches in (
+        ("reference", reference_row, ()),
+        ("kernel", kernel_row, (builder.name_features, builder.normalize_field, builder.first_list_item)),
+    ):
+        best = float("inf")
+        for _ in range(repeat):
+            for cache in caches:
+                cache.cache_clear()
+            # Like timeit: collections over the million preloaded rows would dominate the timing.
+            gc.disable()
+            started = time.perf_counter()
+            results[label] = [row_function(fields) for fields in rows]
+            best = min(best, time.perf_counter() - started)
+            gc.enable()
+        print(f"{label:<10} {best:8.3f} s  {best / len(rows) * 1e9:8.0f} ns/row  rows={len(rows):,}")
+
+    if results["kernel"] != results["reference"]:
+        print("[error] kernel output differs from the reference normalisation", file=sys.stderr)
+        return 1
+    return 0
+
+
+def bench_catalog(rows: int, repeat: int) -> int:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_zip = Path(tmp_dir) / "catalog-barcodes-csv.zip"
+        db_zip = Path(tmp_dir) / "catalog-barcodes-db.zip"
+        write_catalog_zip(csv_zip, rows)
+        write_catalog_db_zip(db_zip, rows)
+
+        reference = time_parser("csv", lambda: builder.parse_catalog_csv_zip(csv_zip, 200), rows, repeat)
+        started = time.perf_counter()
+        builder.extract_catalog_db(db_zip, Path(tmp_dir))
+        print(f"{'db extract':<12} {time.perf_counter() - started:8.3f} s  (first build only)")
+        native = time_parser(
+            "db", lambda: builder.parse_catalog_db_zip(db_zip, 200, extract_dir=Path(tmp_dir)), rows, repeat
+        )
+
+    if native != reference:
+        print("[error] database export yields different candidates than the CSV export", file=sys.stderr)
+        return 1
+    return 0
+
+
+def ensure_synthetic_raw(raw_dir: Path, total_rows: int) -> Dict[str, int]:
+    """Generate (or reuse) a raw/ directory with `total_rows` rows spread across every source."""
+    manifest_path = raw_dir / BENCH_MANIFEST
+    rows = {file_name: max(int(total_rows * share), 1) for file_name, share in SOURCE_SHARES}
+    expected = {"generator": GENERATOR_VERSION, "rows": rows}
+    if manifest_path.exists() and json.loads(manifest_path.read_text(encoding="utf-8")) == expected:
+        return rows
+
+    raw_dir.mkdir(parents=True, exist_ok=True)
+    # One pool across sources, so the same barcodes show up in several of them.
+    pool = max(int(total_rows * 0.6), 1)
+    for seed, (file_name, _) in enumerate(SOURCE_SHARES, start=1):
+        started = time.perf_counter()
+        path = raw_dir / file_name
+        if file_name.startswith("uhtt"):
+            write_uhtt_zip(path, rows[file_name], seed, pool)
+        elif file_name.startswith("catalog"):
+            write_catalog_zip(path, rows[file_name], seed, pool)
+        else:
+            write_openfacts_gzip(path, rows[file_name], seed, pool)
+        print(f"[gen] {file_name}: {rows[file_name]:,} rows in {time.perf_counter() - started:.1f} s", file=sys.stderr)
+    manifest_path.write_text(json.dumps(expected, indent=2), encoding="utf-8")
+    return rows
+
+
+def measure_build(raw_dir: Path, output: Path, settings: builder.BuildSettings) -> dict:
+    """Serial build_index, timed phase by phase. Runs in its own process so peak RSS is per build."""
+    rows_by_file = json.loads((raw_dir / BENCH_MANIFEST).read_text(encoding="utf-8"))["rows"]
+    tasks = builder.collect_source_tasks(raw_dir, include_off_food=True)
+    phases: List[dict] = []
+
+    def record(name: str, started: float, rows: int) -> None:
+        seconds = time.perf_counter() - started
+        phases.append(
+            {
+                "phase": name,
+                "seconds": round(seconds, 3),
+                "rows": rows,
+                "rows_per_sec": round(rows / seconds) if seconds else 0,
+                "peak_rss_mib": round(builder.peak_rss_bytes() / (1 << 20), 1),
+            }
+        )
+
+    build_started = time.perf_counter()
+    aggregator = builder.create_aggregator(settings.aggregator_backend, settings.staging_dir or output.parent)
+    try:
+        for task in tasks:
+            started = time.perf_counter()
+            for candidate in builder.iter_source_candidates(task, settings.parse_options):
+                aggregator.offer(candidate)
+            record(f"parse:{task.source}", started, rows_by_file.get(task.file_key, 0))
+
+        started = time.perf_counter()
+        builder.write_products(output, aggregator.iter_winners(), builder.build_timestamp(), settings.schema)
+        record("write", started, len(aggregator))
+        unique = len(aggregator)
+    finally:
+        aggregator.close()
+
+    total_seconds = time.perf_counter() - build_started
+    total_rows = sum(rows_by_file.values())
+    return {
+        "rows": total_rows,
+        "unique": unique,
+        "seconds": round(total_seconds, 3),
+        "rows_per_sec": round(total_rows / total_seconds),
+        "peak_rss_mib": round(builder.peak_rss_bytes() / (1 << 20), 1),
+        "phases": phases,
+    }
+
+
+def run_measured_build(raw_dir: Path, output: Path, aggregator: str, schema: str) -> dict:
+    command = [
+        sys.executable,
+        str(Path(__file__).resolve()),
+        "measure",
+        "--raw-dir",
+        str(raw_dir),
+        "--output",
+        str(output),
+        "--aggregator",
+        aggregator,
+        "--schema",
+        schema,
+    ]
+    completed = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True)
+    return json.loads(completed.stdout)
+
+
+def print_build_result(label: str, result: dict) -> None:
+    print(f"{label}: {result['rows']:,} rows -> {result['unique']:,} products")
+    for phase in result["phases"]:
+        print(
+            f"  {phase['phase']:<28} {phase['seconds']:8.2f} s  {phase['rows_per_sec']:10,} rows/s"
+            f"  peak {phase['peak_rss_mib']:8.1f} MiB"
+        )
+    print(
+        f"  {'total':<28} {result['seconds']:8.2f} s  {result['rows_per_sec']:10,} rows/s"
+        f"  peak {result['peak_rss_mib']:8.1f} MiB"
+    )
+
+
+def compare_with_baseline(
+    label: str,
+    result: dict,
+    baseline: dict,
+    time_tolerance: float,
+    rss_tolerance: float,
+) -> List[str]:
+    regressions: List[str] = []
+    if result["seconds"] > baseline["seconds"] * (1 + time_tolerance):
+        regressions.append(f"{label} total {result['seconds']:.2f} s vs baseline {baseline['seconds']:.2f} s")
+    if result["peak_rss_mib"] > baseline["peak_rss_mib"] * (1 + rss_tolerance):
+        regressions.append(
+            f"{label} peak RSS {result['peak_rss_mib']:.1f} MiB vs baseline {baseline['peak_rss_mib']:.1f} MiB"
+        )
+    baseline_phases = {phase["phase"]: phase for phase in baseline["phases"]}
+    for phase in result["phases"]:
+        reference = baseline_phases.get(phase["phase"])
+        if reference is None or reference["seconds"] < MIN_COMPARABLE_SECONDS:
+            continue
+        if phase["rows_per_sec"] * (1 + time_tolerance) < reference["rows_per_sec"]:
+            regressions.append(
+                f"{label} {phase['phase']} {phase['rows_per_sec']:,} rows/s "
+                f"vs baseline {reference['rows_per_sec']:,} rows/s"
+            )
+    return regressions
+
+
+def bench_build(
+    scales: Sequence[str],
+    aggregator: str,
+    schema: str,
+    work_dir: Optional[Path],
+    repeat: int,
+    baseline_path: Path,
+    update_baseline: bool,
+    time_tolerance: float,
+    rss_tolerance: float,
+) -> int:
+    baseline = json.loads(baseline_path.read_text(encoding="utf-8")) if baseline_path.exists() else {}
+    machine = f"{platform.system()} {platform.machine()} / Python {platform.python_version()}"
+    if baseline and not update_baseline and baseline.get("machine") != machine:
+        print(f"[warn] baseline was recorded on {baseline.get('machine')}, this is {machine}", file=sys.stderr)
+
+    regressions: List[str] = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = work_dir or Path(tmp_dir)
+        for scale in scales:
+            label = f"{scale}/{aggregator}/{schema}"
+            raw_dir = root / scale / "raw"
+            ensure_synthetic_raw(raw_dir, SCALES[scale])
+            output = root / scale / f"index-{aggregator}-{schema}.sqlite"
+            runs = [run_measured_build(raw_dir, output, aggregator, schema) for _ in range(repeat)]
+            output.unlink()
+            result = min(runs, key=lambda run: run["seconds"])
+            print_build_result(label, result)
+
+            recorded = baseline.setdefault("runs", {})
+            if update_baseline:
+                recorded[label] = result
+            elif label in recorded:
+                regressions += compare_with_baseline(label, result, recorded[label], time_tolerance, rss_tolerance)
+            else:
+                print(f"[warn] no baseline for {label}; run with --update-baseline to record one", file=sys.stderr)
+
+    if update_baseline:
+        baseline["machine"] = machine
+        baseline_path.write_text(json.dumps(baseline, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+        print(f"[ok] baseline written: {baseline_path}", file=sys.stderr)
+        return 0
+
+    for regression in regressions:
+        print(f"[regression] {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+def percentile(values: Sequence[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def search_sql(schema: str, ranked: bool) -> str:
+    key = "p.barcode" if schema == "integer" else "p.rowid"
+    order = "ORDER BY s.rank" if ranked else ""
+    return f"""
+        SELECT p.barcode, p.name, p.brand, p.category
+        FROM products_search AS s
+        JOIN products AS p ON {key} = s.rowid
+        WHERE products_search MATCH ?
+        {order}
+        LIMIT {SEARCH_LIMIT}
+    """
+
+
+def bench_search(index: Optional[Path], scale: str, work_dir: Optional[Path], repeat: int) -> int:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = work_dir or Path(tmp_dir)
+        if index is None:
+            raw_dir = root / scale / "raw"
+            ensure_synthetic_raw(raw_dir, SCALES[scale])
+            index = root / scale / "index-search.sqlite"
+            started = time.perf_counter()
+            builder.build_index(raw_dir, index, True, builder.BuildSettings(search_index=True))
+            print(f"[build] {index} with products_search in {time.perf_counter() - started:.1f} s", file=sys.stderr)
+
+        schema = builder.products_schema(index)
+        connection = sqlite3.connect(f"file:{index}?mode=ro", uri=True)
+        try:
+            if not builder.has_search_index(connection):
+                print(f"[error] {index} has no products_search table; build it with --search-index", file=sys.stderr)
+                return 1
+            rows = connection.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+            print(f"index: {index} | {rows:,} products | {builder.format_mib(index.stat().st_size)}")
+
+            for ranked in (False, True):
+                sql = search_sql(schema or "text", ranked)
+                for kind, queries in SEARCH_QUERIES.items():
+                    latencies: List[float] = []
+                    matches = 0
+                    for query in queries:
+                        expression = builder.search_match(query)
+                        for _ in range(repeat):
+                            started = time.perf_counter()
+                            found = connection.execute(sql, (expression,)).fetchall()
+                            latencies.append(time.perf_counter() - started)
+                        matches += len(found)
+                    label = f"{kind} ({'bm25 ranked' if ranked else 'first hits'})"
+                    print(
+                        f"  {label:<32} p50 {percentile(latencies, 0.5) * 1000:8.2f} ms"
+                        f"  p99 {percentile(latencies, 0.99) * 1000:8.2f} ms"
+                        f"  avg hits {matches / len(queries):5.1f}"
+                    )
+        finally:
+            connection.close()
+    return 0
+
+
+def synthetic_misses(rng: random.Random, known: set, count: int) -> List[str]:
+    misses = []
+    while len(misses) < count:
+        # Same EAN-13 shape as real scans, but outside every synthetic prefix.
+        digits = "47" + "".join(rng.choice("0123456789") for _ in range(10))
+        barcode = digits + str(builder.gtin_check_digit(digits))
+        if barcode not in known:
+            misses.append(barcode)
+    return misses
+
+
+def lookup_latencies(lookup: Callable[[str], object], barcodes: Sequence[str]) -> List[float]:
+    latencies = []
+    for barcode in barcodes:
+        started = time.perf_counter()
+        lookup(barcode)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def bench_binary(index: Optional[Path], scale: str, work_dir: Optional[Path], samples: int) -> int:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = work_dir or Path(tmp_dir)
+        if index is None:
+            raw_dir = root / scale / "raw"
+            ensure_synthetic_raw(raw_dir, SCALES[scale])
+            index = root / scale / "index.sqlite"
+            if not index.exists():
+                builder.build_index(raw_dir, index, True, builder.BuildSettings())
+        binary_path = Path(tmp_dir) / "index.bcix"
+        started = time.perf_counter()
+        builder.write_binary_index(index, binary_path)
+        print(f"[build] {binary_path} in {time.perf_counter() - started:.2f} s", file=sys.stderr)
+
+        schema = builder.products_schema(index)
+        connection = sqlite3.connect(f"file:{index}?mode=ro", uri=True)
+        reader = builder.BinaryIndexReader(binary_path)
+        try:
+            rng = random.Random(7)
+            present = [str(row[0]) for row in connection.execute("SELECT barcode FROM products")]
+            if schema == "integer":
+                # INTEGER keys have lost the leading zeros of UPC-A and padded EAN-8 codes; scan them as EAN-13.
+                present = [barcode.zfill(13) for barcode in present]
+            hits = rng.sample(present, min(samples, len(present)))
+            misses = synthetic_misses(rng, set(present), samples)
+
+            def sqlite_lookup(barcode: str):
+                key = int(builder.canonicalize_gtin(barcode) or 0) if schema == "integer" else barcode
+                return connection.execute(LOOKUP_SQL, (key,)).fetchone()
+
+            # A hit SQLite cannot find would make both lookups agree on None without testing anything.
+            mismatches = [
+                barcode
+                for barcode in hits
+                if sqlite_lookup(barcode) is None or reader.lookup(barcode) != sqlite_lookup(barcode)
+            ]
+            if mismatches:
+                print(f"[error] binary and SQLite lookups differ, e.g. for {mismatches[0]}", file=sys.stderr)
+                return 1
+            bloom_passes = sum(1 for barcode in misses if reader.might_contain(reader.key_for(barcode)))
+
+            print(
+                f"index: {len(present):,} products | sqlite {builder.format_mib(index.stat().st_size)}"
+                f" | binary {builder.format_mib(binary_path.stat().st_size)}"
+                f" | bloom false positives {bloom_passes / len(misses):.2%}"
+            )
+            for label, lookup in (("sqlite", sqlite_lookup), ("binary", reader.lookup)):
+                for kind, barcodes in (("hits", hits), ("misses", misses)):
+                    latencies = lookup_latencies(lookup, barcodes)
+                    print(
+                        f"  {label:<7}{kind:<8} p50 {percentile(latencies, 0.5) * 1e6:7.2f} us"
+                        f"  p99 {percentile(latencies, 0.99) * 1e6:7.2f} us"
+                        f"  {len(latencies) / sum(latencies):12,.0f} lookups/s"
+                    )
+        finally:
+            reader.close()
+            connection.close()
+    return 0
+
+
+def process_read_bytes() -> Optional[int]:
+    """Bytes this process has read through read()/pread(); SQLite reads every page it misses that way."""
+    try:
+        with open("/proc/self/io", "r", encoding="ascii") as handle:
+            for line in handle:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def evict_from_os_cache(path: Path) -> None:
+    if not hasattr(os, "posix_fadvise"):
+        return
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(descriptor, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(descriptor)
+
+
+def lookup_streams(index: Path, lookups: int, seed: int) -> Dict[str, List[str]]:
+    """Scanned-barcode streams: uniform hits, Zipf-skewed hits (a few products scanned often) and misses."""
+    rng = random.Random(seed)
+    connection = sqlite3.connect(f"file:{index}?mode=ro", uri=True)
+    try:
+        present = [str(barcode) for (barcode,) in connection.execute("SELECT barcode FROM products ORDER BY barcode")]
+    finally:
+        connection.close()
+    rng.shuffle(present)
+    weights = list(itertools.accumulate(1.0 / (rank + 1) ** ZIPF_EXPONENT for rank in range(len(present))))
+    return {
+        "hits-uniform": rng.choices(present, k=lookups),
+        "hits-zipf": rng.choices(present, cum_weights=weights, k=lookups),
+        "misses": synthetic_misses(rng, set(present), lookups),
+    }
+
+
+def open_read_only(index: Path) -> sqlite3.Connection:
+    # What LocalBarcodeDatabaseReader does: read-only, default page cache, no extra pragmas.
+    return sqlite3.connect(f"file:{index}?mode=ro", uri=True)
+
+
+def measure_lookups(index: Path, barcodes: Sequence[str], cold: bool) -> Tuple[List[float], Optional[float]]:
+    """Latencies of the app's lookup query and the average pages it read from the file per lookup.
+
+    Cold lookups each get a fresh connection on a file evicted from the OS
+    page cache, so schema and B-tree pages all come from disk. Warm lookups
+    share one connection after a pass that loads the same stream.
+    """
+    connection = open_read_only(index)
+    page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+    latencies: List[float] = []
+    read_bytes = 0
+    try:
+        if cold:
+            for barcode in barcodes:
+                connection.close()
+                evict_from_os_cache(index)
+                connection = open_read_only(index)
+                before = process_read_bytes()
+                started = time.perf_counter()
+                connection.execute(LOOKUP_SQL, (barcode,)).fetchone()
+                latencies.append(time.perf_counter() - started)
+                after = process_read_bytes()
+                if before is not None and after is not None:
+                    read_bytes += after - before
+        else:
+            for barcode in barcodes:
+                connection.execute(LOOKUP_SQL, (barcode,)).fetchone()
+            before = process_read_bytes()
+            latencies = lookup_latencies(
+                lambda barcode: connection.execute(LOOKUP_SQL, (barcode,)).fetchone(), barcodes
+            )
+            after = process_read_bytes()
+            if before is not None and after is not None:
+                read_bytes = after - before
+    finally:
+        connection.close()
+    pages = read_bytes / page_size / len(barcodes) if process_read_bytes() is not None else None
+    return latencies, pages
+
+
+def make_lookup_variant(source: Path, target: Path, page_size: int, extra_index: bool) -> None:
+    shutil.copyfile(source, target)
+    connection = sqlite3.connect(target)
+    try:
+        if not extra_index:
+            connection.execute(f"DROP INDEX IF EXISTS {LOOKUP_EXTRA_INDEX}")
+        connection.execute(f"PRAGMA page_size = {page_size}")
+        connection.execute("VACUUM")
+    finally:
+        connection.close()
+
+
+def print_lookup_variant(label: str, index: Path, streams: Dict[str, List[str]], cold_lookups: int) -> None:
+    connection = open_read_only(index)
+    try:
+        page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+        # dbstat paths look like '/', '/000/', '/000/01f/': one more '/' per level.
+        depths = connection.execute(
+            """
+            SELECT name, MAX(length(path) - length(replace(path, '/', '')))
+            FROM dbstat
+            WHERE name IN ('idx_products_barcode', 'products', 'idx_product_rows_barcode', 'product_rows')
+            GROUP BY name
+            ORDER BY name
+            """
+        ).fetchall()
+    finally:
+        connection.close()
+    probe = " + ".join(f"{name} {depth}" for name, depth in depths)
+    print(f"{label} | page {page_size} | {builder.format_mib(index.stat().st_size)} | b-tree levels: {probe}")
+    for kind, barcodes in streams.items():
+        cold, cold_pages = measure_lookups(index, barcodes[:cold_lookups], cold=True)
+        warm, warm_pages = measure_lookups(index, barcodes, cold=False)
+        pages = "" if cold_pages is None else f" {cold_pages:5.1f} pages"
+        warm_pages_text = "" if warm_pages is None else f" {warm_pages:5.2f} pages"
+        print(
+            f"  {kind:<13} cold p50 {percentile(cold, 0.5) * 1e6:8.1f} us p99 {percentile(cold, 0.99) * 1e6:8.1f} us"
+            f"{pages} | warm p50 {percentile(warm, 0.5) * 1e6:6.1f} us p99 {percentile(warm, 0.99) * 1e6:6.1f} us"
+            f"{warm_pages_text}"
+        )
+
+
+def bench_lookup(
+    index: Optional[Path],
+    scale: str,
+    work_dir: Optional[Path],
+    schemas: Sequence[str],
+    page_sizes: Sequence[int],
+    lookups: int,
+    cold_lookups: int,
+    seed: int,
+) -> int:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if index is not None:
+            print_lookup_variant(str(index), index, lookup_streams(index, lookups, seed), cold_lookups)
+            return 0
+
+        root = work_dir or Path(tmp_dir)
+        raw_dir = root / scale / "raw"
+        ensure_synthetic_raw(raw_dir, SCALES[scale])
+        for schema in schemas:
+            built = root / scale / ("index.sqlite" if schema == "text" else f"index-{schema}.sqlite")
+            if not built.exists():
+                settings = builder.BuildSettings(
+                    schema=schema, parse_options=builder.ParseOptions(canonical_gtin=schema == "integer")
+                )
+                builder.build_index(raw_dir, built, True, settings)
+            streams = lookup_streams(built, lookups, seed)
+            for page_size in page_sizes:
+                for extra_index in (True, False):
+                    variant = Path(tmp_dir) / f"lookup-{schema}-{page_size}-{int(extra_index)}.sqlite"
+                    make_lookup_variant(built, variant, page_size, extra_index)
+                    label = f"{schema} keys, {'with' if extra_index else 'without'} {LOOKUP_EXTRA_INDEX}"
+                    print_lookup_variant(label, variant, streams, cold_lookups)
+                    variant.unlink()
+    return 0
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmarks for build_barcode_index.py.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parse_command = commands.add_parser("parse", help="Open*Facts TSV parse throughput: DictReader vs positional.")
+    parse_command.add_argument("--rows", type=int, default=100_000, help="Synthetic rows to generate.")
+    parse_command.add_argument("--repeat", type=int, default=3, help="Runs per parser; the best one is reported.")
+    parse_command.add_argument("--dump", type=Path, default=None, help="Benchmark a real *.csv.gz dump instead.")
+
+    catalog_command = commands.add_parser(
+        "catalog",
+        help="catalog.app parse throughput: CSV export vs the extracted SQLite export, checked for equal output.",
+    )
+    catalog_command.add_argument("--rows", type=int, default=250_000, help="Synthetic rows per export.")
+    catalog_command.add_argument("--repeat", type=int, default=3, help="Runs per reader; the best one is reported.")
+
+    normalize_command = commands.add_parser(
+        "normalize",
+        help="Per-row name/brand/category normalisation, validation and scoring: kernel vs reference.",
+    )
+    normalize_command.add_argument("--scale", choices=tuple(SCALES), default="100k", help="Synthetic fixture size.")
+    normalize_command.add_argument("--work-dir", type=Path, default=None, help="Reuse generated raw data from here.")
+    normalize_command.add_argument("--repeat", type=int, default=3, help="Runs per path; the best one is reported.")
+
+    build_command = commands.add_parser(
+        "build",
+        help="Full builds over synthetic UHTT/catalog/Open*Facts data, checked against the stored baseline.",
+    )
+    build_command.add_argument(
+        "--scale",
+        dest="scales",
+        action="append",
+        choices=tuple(SCALES),
+        help="Total synthetic rows across all sources; repeatable (default: 100k).",
+    )
+    build_command.add_argument("--aggregator", choices=builder.AGGREGATOR_BACKENDS, default="dict")
+    build_command.add_argument("--schema", choices=builder.PRODUCT_SCHEMAS, default="text")
+    build_command.add_argument(
+        "--work-dir",
+        type=Path,
+        default=None,
+        help="Keep generated raw data here and reuse it across runs (default: a temporary directory).",
+    )
+    build_command.add_argument("--repeat", type=int, default=3, help="Builds per scale; the fastest one is reported.")
+    build_command.add_argument("--baseline", type=Path, default=BASELINE_PATH, help="Baseline JSON file.")
+    build_command.add_argument("--update-baseline", action="store_true", help="Record this run as the baseline.")
+    build_command.add_argument(
+        "--time-tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed slowdown before a run counts as a regression (0.25 = 25%%).",
+    )
+    build_command.add_argument(
+        "--rss-tolerance",
+        type=float,
+        default=0.15,
+        help="Allowed peak RSS growth before a run counts as a regression.",
+    )
+
+    search_command = commands.add_parser(
+        "search",
+        help="products_search (FTS5) latency for prefix and multi-token queries.",
+    )
+    search_command.add_argument("--index", type=Path, default=None, help="Existing index built with --search-index.")
+    search_command.add_argument("--scale", choices=tuple(SCALES), default="1m", help="Synthetic size when no --index.")
+    search_command.add_argument("--work-dir", type=Path, default=None, help="Reuse generated raw data from here.")
+    search_command.add_argument("--repeat", type=int, default=20, help="Runs per query.")
+
+    binary_command = commands.add_parser(
+        "binary",
+        help="Barcode lookups through the --binary-output file vs the app's SQLite query.",
+    )
+    binary_command.add_argument("--index", type=Path, default=None, help="Existing SQLite index to convert.")
+    binary_command.add_argument("--scale", choices=tuple(SCALES), default="1m", help="Synthetic size when no --index.")
+    binary_command.add_argument("--work-dir", type=Path, default=None, help="Reuse generated raw data from here.")
+    binary_command.add_argument("--samples", type=int, default=LOOKUP_SAMPLE, help="Hit and miss lookups each.")
+
+    lookup_command = commands.add_parser(
+        "lookup",
+        help="The app's read-only barcode query over hit/miss/skewed streams, cold and warm, per schema variant.",
+    )
+    lookup_command.add_argument("--index", type=Path, default=None, help="Measure this built index as it is.")
+    lookup_command.add_argument("--scale", choices=tuple(SCALES), default="1m", help="Synthetic size when no --index.")
+    lookup_command.add_argument("--work-dir", type=Path, default=None, help="Reuse generated raw data from here.")
+    lookup_command.add_argument(
+        "--schema",
+        dest="schemas",
+        action="append",
+        choices=builder.PRODUCT_SCHEMAS,
+        help="Key variant to build and measure; repeatable (default: all).",
+    )
+    lookup_command.add_argument(
+        "--page-size",
+        dest="page_sizes",
+        action="append",
+        type=int,
+        help=f"Page size variant; repeatable (default: {', '.join(map(str, LOOKUP_PAGE_SIZES))}).",
+    )
+    lookup_command.add_argument("--lookups", type=int, default=LOOKUP_SAMPLE, help="Warm lookups per stream.")
+    lookup_command.add_argument(
+        "--cold-lookups", type=int, default=LOOKUP_COLD_SAMPLE, help="Cold lookups per stream (each reopens the file)."
+    )
+    lookup_command.add_argument("--seed", type=int, default=7, help="Seed for the barcode streams.")
+
+    measure_command = commands.add_parser(
+        "measure",
+        help="One measured serial build, printed as JSON (used by 'build').",
+    )
+    measure_command.add_argument("--raw-dir", type=Path, required=True)
+    measure_command.add_argument("--output", type=Path, required=True)
+    measure_command.add_argument("--aggregator", choices=builder.AGGREGATOR_BACKENDS, default="dict")
+    measure_command.add_argument("--schema", choices=builder.PRODUCT_SCHEMAS, default="text")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    if args.command == "parse":
+        return bench_parse(args.rows, args.repeat, args.dump)
+    if args.command == "normalize":
+        return bench_normalize(args.scale, args.work_dir, args.repeat)
+    if args.command == "catalog":
+        return bench_catalog(args.rows, args.repeat)
+    if args.command == "build":
+        return bench_build(
+            args.scales or ["100k"],
+            args.aggregator,
+            args.schema,
+            args.work_dir,
+            args.repeat,
+            args.baseline,
+            args.update_baseline,
+            args.time_tolerance,
+            args.rss_tolerance,
+        )
+    if args.command == "search":
+        return bench_search(args.index, args.scale, args.work_dir, args.repeat)
+    if args.command == "binary":
+        return bench_binary(args.index, args.scale, args.work_dir, args.samples)
+    if args.command == "lookup":
+        return bench_lookup(
+            args.index,
+            args.scale,
+            args.work_dir,
+            args.schemas or builder.PRODUCT_SCHEMAS,
+            args.page_sizes or LOOKUP_PAGE_SIZES,
+            args.lookups,
+            args.cold_lookups,
+            args.seed,
+        )
+    if args.command == "measure":
+        settings = builder.BuildSettings(
+            aggregator_backend=args.aggregator,
+            schema=args.schema,
+            parse_options=builder.ParseOptions(canonical_gtin=args.schema == "integer"),
+        )
+        print(json.dumps(measure_build(args.raw_dir, args.output, settings)))
+        return 0
+    return 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -2,27 +2,234 @@
 from __future__ import annotations
 
 import argparse
+import bisect
+import cProfile
 import csv
 import gzip
+import hashlib
+import heapq
 import io
+import itertools
+import json
+import mmap
+import operator
+import os
+import pstats
+import queue
 import re
+import resource
+import shutil
 import sqlite3
+import struct
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 import zipfile
-from dataclasses import dataclass
+import zlib
+from array import array
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager, nullcontext
+from dataclasses import asdict, dataclass, field, fields, replace
 from datetime import datetime, timezone
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import Dict, Iterable, Iterator, Optional
+from typing import BinaryIO, Callable, Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
 
 LETTER_RE = re.compile(r"[A-Za-zА-Яа-яЁё]")
-SPACE_RE = re.compile(r"\s+")
 GENERIC_TOKENS = ("штрих-код", "штрихкод", "barcode", "поиск")
+GENERIC_TOKEN_RE = re.compile("|".join(map(re.escape, GENERIC_TOKENS)))
+# The aggregator validates each name right after the parser scored it, and the pipelined parser runs
+# up to PIPELINE_QUEUE_DEPTH batches ahead, so the cache covers that window.
+NAME_FEATURES_CACHE_SIZE = 1 << 16
+# Brand and category columns repeat a few thousand distinct values across millions of rows.
+FIELD_CACHE_SIZE = 1 << 14
+DEFAULT_CATEGORY = "Продукты"
+# Bump when parsing or ranking rules change so incremental state is rebuilt.
+STATE_VERSION = "1"
+# Bump when parsing or normalisation changes the (barcode, name, brand, category) rows a parser yields.
+PARSE_CACHE_VERSION = "1"
+AGGREGATOR_BACKENDS = ("dict", "compact", "sqlite")
+STAGING_BATCH_SIZE = 50_000
+STAGING_CACHE_KIB = 64 * 1024
+BULK_LOAD_CACHE_KIB = 256 * 1024
+MEMORY_SAMPLE_SIZE = 10_000
+PIPELINE_BLOCK_SIZE = 4 << 20
+PIPELINE_BATCH_SIZE = 5_000
+PIPELINE_QUEUE_DEPTH = 8
+CHUNKS_IN_FLIGHT_PER_JOB = 2
+
+PRODUCT_SCHEMAS = ("text", "integer")
+CATALOG_FORMATS = ("auto", "csv", "db")
+SQLITE_HEADER = b"SQLite format 3\x00"
+# Columns read from the catalog.app database export, named as in its CSV export.
+CATALOG_DB_COLUMNS = ("barcode", "name", "vendor", "category")
+GTIN_LENGTHS = (8, 12, 13, 14)
+PROGRESS_INTERVAL_SECONDS = 5.0
+PROFILE_MODES = ("cprofile", "tracemalloc")
+PROFILE_TOP_ENTRIES = 25
+CHECKPOINT_VERSION = 1
+DEFAULT_CHECKPOINT_INTERVAL = 300.0
+# Record-aligned block size for checkpointed Open*Facts parsing; part of the checkpoint fingerprint.
+CHECKPOINT_CHUNK_LINES = 20_000
+OPENFACTS_COLUMNS = (
+    "code",
+    "product_name",
+    "generic_name",
+    "abbreviated_product_name",
+    "brands",
+    "categories",
+    "countries_tags",
+    "categories_tags",
+)
+# Pushdown filters drop Open*Facts rows before a Candidate is built; each has its own reject reason.
+OPENFACTS_FILTER_REASONS = ("filtered_country", "filtered_category", "filtered_barcode_prefix")
+
+PRODUCTS_SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS products (
+        barcode TEXT NOT NULL,
+        name TEXT NOT NULL,
+        brand TEXT,
+        category TEXT,
+        source TEXT NOT NULL,
+        source_rank INTEGER NOT NULL,
+        quality_score INTEGER NOT NULL,
+        updated_at TEXT NOT NULL
+    )
+"""
+
+# Canonical GTINs as a clustered integer key: a barcode lookup is one B-tree probe.
+# INTEGER affinity still lets the app bind the scanned code as text.
+PRODUCTS_INTEGER_SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS products (
+        barcode INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        brand TEXT,
+        category TEXT,
+        source TEXT NOT NULL,
+        source_rank INTEGER NOT NULL,
+        quality_score INTEGER NOT NULL,
+        updated_at TEXT NOT NULL
+    ) WITHOUT ROWID
+"""
+
+PRODUCTS_INSERT_SQL = """
+    INSERT INTO products (
+        barcode,
+        name,
+        brand,
+        category,
+        source,
+        source_rank,
+        quality_score,
+        updated_at
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+PRODUCTS_INDEX_SQL = (
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_products_barcode ON products(barcode)",
+    "CREATE INDEX IF NOT EXISTS idx_products_source_rank_quality ON products(source_rank DESC, quality_score DESC)",
+)
+
+PRODUCTS_INTEGER_INDEX_SQL = PRODUCTS_INDEX_SQL[1:]
+
+# Every build stamps updated_at, so rows are compared on everything else.
+PRODUCT_CONTENT_COLUMNS = ("barcode", "name", "brand", "category", "source", "source_rank", "quality_score")
+PRODUCT_COLUMNS = PRODUCT_CONTENT_COLUMNS + ("updated_at",)
+# Bump when the products or index_meta layout changes in a way readers must know about.
+INDEX_SCHEMA_VERSION = 1
+# One row describing the whole build, so the app and deploy tooling can check an index without hashing it.
+# content_digest is order-independent (see ContentDigest); sources is JSON keyed by source name.
+INDEX_META_SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS index_meta (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        schema_version INTEGER NOT NULL,
+        products_schema TEXT NOT NULL,
+        built_at TEXT NOT NULL,
+        product_count INTEGER NOT NULL,
+        content_digest TEXT NOT NULL,
+        sources TEXT NOT NULL
+    )
+"""
+MASK256 = (1 << 256) - 1
+# backend/data/local_barcode_db.sqlite as backend/scripts/build-local-db.ts creates it; that script cuts
+# name/brand/category with JavaScript substring(), i.e. in UTF-16 code units, to these lengths.
+BACKEND_PRODUCTS_SCHEMA_SQL = """
+    CREATE TABLE products (
+        barcode TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        brand TEXT,
+        category TEXT
+    )
+"""
+BACKEND_FIELD_LIMITS = (200, 100, 100)
+EXPORT_BATCH_SIZE = 10_000
+# json.dumps() with keyword arguments builds a new encoder per call.
+NDJSON_ENCODER = json.JSONEncoder(ensure_ascii=False)
+DELTA_FORMAT_VERSION = "1"
+
+# Contentless: the index stores tokens only and joins back to products by rowid
+# (the GTIN itself for the WITHOUT ROWID integer layout). Text is folded before
+# indexing because unicode61 does not fold ё; queries must go through search_match().
+SEARCH_TABLE_SQL = """
+    CREATE VIRTUAL TABLE products_search USING fts5(
+        name,
+        brand,
+        content = '',
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3 4'
+    )
+"""
+SEARCH_TOKEN_RE = re.compile(r"\w+")
+
+SHARD_FORMAT_VERSION = 1
+SHARD_MANIFEST = "manifest.json"
+DEFAULT_HOT_PREFIXES = "460-469"
+
+# Sorted, memory-mappable lookup file: little-endian header, then 8-byte aligned sections
+# (keys, name offsets, brand ids, category ids, dictionary offsets, dictionary blob, name blob, bloom bits).
+BINARY_MAGIC = b"BCIX"
+BINARY_FORMAT_VERSION = 1
+BINARY_FLAG_CANONICAL = 1
+BINARY_HEADER = struct.Struct("<4sHHQQQI4x8Q")
+BINARY_BLOOM_BITS_PER_KEY = 16
+BINARY_BLOOM_HASHES = 3
+MASK64 = (1 << 64) - 1
+
+# Shipped layout (--optimize-for-ship): repeated strings live once in product_strings and
+# a products view joins them back, so the app's lookup query does not change.
+# Chosen with `bench_barcode_index.py lookup` on the shipped 1m index (461k products). A cold hit reads
+# 12.2 / 9.1 / 8.0 / 7.0 / 7.0 pages at 1 / 2 / 4 / 8 / 16 KiB, and cold p99 latency was within run-to-run
+# noise for 2 to 8 KiB. 4 KiB is the fewest pages that are no bigger than an APFS block, so each page is one
+# device read. Larger pages read 2-4 blocks each; smaller ones add b-tree levels and file size
+# (36.3 vs 35.8 MiB at 2 KiB). It equals SQLite's default and is pinned so the shipped layout does not follow
+# a future default.
+SHIP_PAGE_SIZE = 4096
+SHIP_STRING_COLUMNS = ("brand", "category", "source", "updated_at")
+DELTA_TABLES = ("inserted", "updated")
 
 try:
     csv.field_size_limit(sys.maxsize)
 except OverflowError:
     csv.field_size_limit(1_000_000_000)
 
+# Parsers accept a path or an already open binary file (see ProgressFile).
+SourceFile = Union[Path, BinaryIO]
+PARSER_REJECT_REASONS = (
+    "short_row",
+    "empty_barcode",
+    "invalid_barcode",
+    "missing_name",
+    "sampled_out",
+    *OPENFACTS_FILTER_REASONS,
+)
+# --sample keeps a barcode when the CRC-32 of its cleaned text falls below fraction * SAMPLE_SPACE,
+# so every source keeps the same barcodes and winner resolution still sees all their candidates.
+SAMPLE_SPACE = 1 << 32
+
 
 @dataclass
 class Candidate:
@@ -35,35 +242,622 @@ class Candidate:
     quality_score: int
 
 
+@dataclass(frozen=True)
+class SourceTask:
+    kind: str
+    path: Path
+    source: str
+    source_rank: int
+    entry: Optional[str] = None
+
+    @property
+    def file_key(self) -> str:
+        return self.path.name
+
+    @property
+    def label(self) -> str:
+        if self.entry is None:
+            return str(self.path)
+        return f"{self.path}:{self.entry}"
+
+
+@dataclass(frozen=True)
+class ParseOptions:
+    canonical_gtin: bool = False
+    # Open*Facts filters; an empty tuple keeps every row. Tags match countries_tags / categories_tags
+    # entries exactly, prefix ranges match the cleaned barcode.
+    countries: Tuple[str, ...] = ()
+    categories: Tuple[str, ...] = ()
+    barcode_prefixes: Tuple[Tuple[str, str], ...] = ()
+    sample: float = 1.0
+
+    def fingerprint(self) -> str:
+        return json.dumps(asdict(self), sort_keys=True)
+
+
+DEFAULT_PARSE_OPTIONS = ParseOptions()
+
+
+@dataclass(frozen=True)
+class BuildSettings:
+    jobs: int = 1
+    aggregator_backend: str = "dict"
+    staging_dir: Optional[Path] = None
+    schema: str = "text"
+    pipeline: bool = False
+    openfacts_chunk_lines: int = 0
+    parse_options: ParseOptions = DEFAULT_PARSE_OPTIONS
+    search_index: bool = False
+    progress: bool = False
+    stats_json: Optional[Path] = None
+    profile_source: Optional[str] = None
+    profile_mode: str = "cprofile"
+    profile_output: Optional[Path] = None
+    checkpoint: bool = False
+    checkpoint_interval: float = DEFAULT_CHECKPOINT_INTERVAL
+    resume: bool = False
+    parse_cache_dir: Optional[Path] = None
+    catalog_format: str = "auto"
+    backend_output: Optional[Path] = None
+    ndjson_output: Optional[Path] = None
+
+
+@dataclass
+class SourceStats:
+    """One source's share of a build; UHTT entries and other split tasks are summed per source."""
+
+    source: str
+    files: List[str] = field(default_factory=list)
+    compressed_bytes: int = 0
+    seconds: float = 0.0
+    candidates: int = 0
+    valid: int = 0
+    rejects: Counter = field(default_factory=Counter)
+    peak_rss_bytes: int = 0
+    winners: int = 0
+
+    @property
+    def rows(self) -> int:
+        # Rows the parser dropped never became candidates, so add them back.
+        return self.candidates + sum(self.rejects[reason] for reason in PARSER_REJECT_REASONS)
+
+    def add(self, other: "SourceStats") -> None:
+        self.files += [name for name in other.files if name not in self.files]
+        self.compressed_bytes += other.compressed_bytes
+        self.seconds += other.seconds
+        self.candidates += other.candidates
+        self.valid += other.valid
+        self.rejects.update(other.rejects)
+        self.peak_rss_bytes = max(self.peak_rss_bytes, other.peak_rss_bytes)
+
+    def to_json(self) -> dict:
+        return {
+            "source": self.source,
+            "files": self.files,
+            "compressed_bytes": self.compressed_bytes,
+            "seconds": round(self.seconds, 3),
+            "rows": self.rows,
+            "rows_per_sec": round(self.rows / self.seconds) if self.seconds else 0,
+            "candidates": self.candidates,
+            "valid": self.valid,
+            "rejects": dict(sorted(self.rejects.items())),
+            "winners": self.winners,
+            "peak_rss_mib": round(self.peak_rss_bytes / (1 << 20), 1),
+        }
+
+
+def candidate_rank_key(candidate: Candidate) -> tuple:
+    return (candidate.source_rank, candidate.quality_score, len(candidate.name))
+
+
 class CandidateAggregator:
     def __init__(self) -> None:
         self.best_by_barcode: Dict[str, Candidate] = {}
         self.total_seen = 0
         self.total_valid = 0
+        self.rejects: Counter = Counter()
+
+    def __len__(self) -> int:
+        return len(self.best_by_barcode)
 
     def offer(self, candidate: Candidate) -> None:
         self.total_seen += 1
-        if not is_valid_name(candidate.name, candidate.barcode):
+        reason = name_reject_reason(candidate.name, candidate.barcode)
+        if reason is not None:
+            self.rejects[reason] += 1
             return
 
         self.total_valid += 1
+        self.offer_winner(candidate)
+
+    def offer_winner(self, candidate: Candidate) -> None:
         prev = self.best_by_barcode.get(candidate.barcode)
         if prev is None:
             self.best_by_barcode[candidate.barcode] = candidate
             return
 
-        prev_key = (prev.source_rank, prev.quality_score, len(prev.name))
-        next_key = (candidate.source_rank, candidate.quality_score, len(candidate.name))
-        if next_key > prev_key:
+        if candidate_rank_key(candidate) > candidate_rank_key(prev):
             self.best_by_barcode[candidate.barcode] = candidate
 
+    def merge(self, other: "Aggregator") -> None:
+        """Fold in an aggregator built from sources that come after this one's.
+
+        Merging in source order keeps both the winner (ties go to the earlier
+        candidate) and the barcode insertion order identical to a serial build.
+        """
+        self.total_seen += other.total_seen
+        self.total_valid += other.total_valid
+        self.rejects.update(other.rejects)
+        for candidate in other.iter_winners():
+            self.offer_winner(candidate)
+
+    def iter_winners(self) -> Iterator[Candidate]:
+        return iter(self.best_by_barcode.values())
+
+    def close(self) -> None:
+        self.best_by_barcode.clear()
+
+
+class StringInterner:
+    """Maps repeated strings to small integer ids; id 0 is reserved for None."""
+
+    def __init__(self) -> None:
+        self.values: List[Optional[str]] = [None]
+        self.ids: Dict[str, int] = {}
+
+    def intern(self, value: Optional[str]) -> int:
+        if value is None:
+            return 0
+        value_id = self.ids.get(value)
+        if value_id is None:
+            value_id = len(self.values)
+            self.values.append(value)
+            self.ids[value] = value_id
+        return value_id
+
+    def approx_memory_bytes(self) -> int:
+        return (
+            sys.getsizeof(self.values)
+            + sys.getsizeof(self.ids)
+            + sum(sys.getsizeof(value) for value in self.values if value is not None)
+        )
+
+
+class CompactCandidateAggregator:
+    """Array-backed aggregator for builds with tens of millions of barcodes.
+
+    Winners live in parallel typed arrays indexed by slot, barcodes are stored
+    as integer keys, names as UTF-8 in one growing blob, and source/brand/category
+    as ids into a shared interner. offer() and merge() behave exactly like
+    CandidateAggregator, including tie-breaking and winner order.
+
+    Barcodes that are not plain ASCII digits (normalize_barcode keeps anything
+    str.isdigit accepts, e.g. superscripts) cannot round-trip through an int and
+    are kept by string in slot_by_text instead.
+    """
+
+    def __init__(self) -> None:
+        self.slot_by_key: Dict[int, int] = {}
+        self.slot_by_text: Dict[str, int] = {}
+        self.name_blob = bytearray()
+        self.name_offsets = array("Q")
+        self.name_sizes = array("I")
+        self.name_lengths = array("I")
+        self.brand_ids = array("I")
+        self.category_ids = array("I")
+        self.source_ids = array("I")
+        self.source_ranks = array("i")
+        self.quality_scores = array("i")
+        self.strings = StringInterner()
+        self.total_seen = 0
+        self.total_valid = 0
+        self.rejects: Counter = Counter()
+
+    def __len__(self) -> int:
+        return len(self.slot_by_key) + len(self.slot_by_text)
+
+    def offer(self, candidate: Candidate) -> None:
+        self.total_seen += 1
+        reason = name_reject_reason(candidate.name, candidate.barcode)
+        if reason is not None:
+            self.rejects[reason] += 1
+            return
+
+        self.total_valid += 1
+        self.offer_winner(candidate)
+
+    def offer_winner(self, candidate: Candidate) -> None:
+        barcode = candidate.barcode
+        if is_ascii_digits(barcode):
+            slots: Dict = self.slot_by_key
+            key: Union[int, str] = barcode_key(barcode)
+        else:
+            slots, key = self.slot_by_text, barcode
+        slot = slots.get(key)
+        if slot is None:
+            slots[key] = len(self.source_ranks)
+            encoded = candidate.name.encode("utf-8")
+            self.name_offsets.append(len(self.name_blob))
+            self.name_sizes.append(len(encoded))
+            self.name_lengths.append(len(candidate.name))
+            self.name_blob += encoded
+            self.brand_ids.append(self.strings.intern(candidate.brand))
+            self.category_ids.append(self.strings.intern(candidate.category))
+            self.source_ids.append(self.strings.intern(candidate.source))
+            self.source_ranks.append(candidate.source_rank)
+            self.quality_scores.append(candidate.quality_score)
+            return
+
+        prev_key = (self.source_ranks[slot], self.quality_scores[slot], self.name_lengths[slot])
+        if candidate_rank_key(candidate) <= prev_key:
+            return
+
+        # The replaced name stays in the blob; replacements are rare next to inserts.
+        encoded = candidate.name.encode("utf-8")
+        self.name_offsets[slot] = len(self.name_blob)
+        self.name_sizes[slot] = len(encoded)
+        self.name_lengths[slot] = len(candidate.name)
+        self.name_blob += encoded
+        self.brand_ids[slot] = self.strings.intern(candidate.brand)
+        self.category_ids[slot] = self.strings.intern(candidate.category)
+        self.source_ids[slot] = self.strings.intern(candidate.source)
+        self.source_ranks[slot] = candidate.source_rank
+        self.quality_scores[slot] = candidate.quality_score
+
+    def merge(self, other: "Aggregator") -> None:
+        self.total_seen += other.total_seen
+        self.total_valid += other.total_valid
+        self.rejects.update(other.rejects)
+        for candidate in other.iter_winners():
+            self.offer_winner(candidate)
+
+    def iter_winners(self) -> Iterator[Candidate]:
+        values = self.strings.values
+        blob = self.name_blob
+        # slot_by_key iterates in insertion order, which is also slot order.
+        slots: Iterable[Tuple[str, int]] = ((barcode_from_key(key), slot) for key, slot in self.slot_by_key.items())
+        if self.slot_by_text:
+            slots = heapq.merge(slots, self.slot_by_text.items(), key=operator.itemgetter(1))
+        for barcode, slot in slots:
+            offset = self.name_offsets[slot]
+            yield Candidate(
+                barcode=barcode,
+                name=blob[offset : offset + self.name_sizes[slot]].decode("utf-8"),
+                brand=values[self.brand_ids[slot]],
+                category=values[self.category_ids[slot]],
+                source=values[self.source_ids[slot]],
+                source_rank=self.source_ranks[slot],
+                quality_score=self.quality_scores[slot],
+            )
+
+    def close(self) -> None:
+        self.slot_by_key.clear()
+        self.slot_by_text.clear()
+
+    def approx_memory_bytes(self) -> int:
+        arrays = (
+            self.name_offsets,
+            self.name_sizes,
+            self.name_lengths,
+            self.brand_ids,
+            self.category_ids,
+            self.source_ids,
+            self.source_ranks,
+            self.quality_scores,
+        )
+        sample = list(itertools.islice(self.slot_by_key, MEMORY_SAMPLE_SIZE))
+        key_bytes = sum(sys.getsizeof(key) for key in sample) * len(self) // max(len(sample), 1)
+        return (
+            sys.getsizeof(self.slot_by_key)
+            + sys.getsizeof(self.slot_by_text)
+            + key_bytes
+            + len(self) * sys.getsizeof(len(self))
+            + sys.getsizeof(self.name_blob)
+            + sum(sys.getsizeof(values) for values in arrays)
+            + self.strings.approx_memory_bytes()
+        )
+
+
+class SQLiteStagingAggregator:
+    """Disk-backed aggregator whose memory use does not grow with the input.
+
+    Valid candidates are buffered and upserted in batches into a staging table.
+    The conditional ON CONFLICT update applies the same ranking tuple as
+    CandidateAggregator, and the first insert of a barcode fixes its rowid, so
+    winners come back in the same order as from the in-memory backends.
+    """
+
+    UPSERT_TAIL = """
+        ON CONFLICT(barcode) DO UPDATE SET
+            name = excluded.name,
+            brand = excluded.brand,
+            category = excluded.category,
+            source = excluded.source,
+            source_rank = excluded.source_rank,
+            quality_score = excluded.quality_score
+        WHERE (excluded.source_rank, excluded.quality_score, length(excluded.name))
+            > (staging.source_rank, staging.quality_score, length(staging.name))
+    """
+
+    def __init__(self, staging_dir: Optional[Path] = None, batch_size: int = STAGING_BATCH_SIZE) -> None:
+        handle, path = tempfile.mkstemp(prefix="barcode-staging-", suffix=".sqlite", dir=staging_dir)
+        os.close(handle)
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self.pending: List[tuple] = []
+        self.total_seen = 0
+        self.total_valid = 0
+        self.rejects: Counter = Counter()
+        self.connection = self._connect()
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS staging (
+                barcode TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                brand TEXT,
+                category TEXT,
+                source TEXT NOT NULL,
+                source_rank INTEGER NOT NULL,
+                quality_score INTEGER NOT NULL
+            )
+            """
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        # Unpickling happens on the executor's result thread, use happens on the main thread.
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute(f"PRAGMA cache_size = -{STAGING_CACHE_KIB}")
+        return connection
+
+    def __getstate__(self) -> dict:
+        # Workers hand their staging file to the parent process by path.
+        self.flush()
+        self.connection.close()
+        state = dict(self.__dict__)
+        del state["connection"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.connection = self._connect()
+
+    def __len__(self) -> int:
+        self.flush()
+        return self.connection.execute("SELECT COUNT(*) FROM staging").fetchone()[0]
+
+    def offer(self, candidate: Candidate) -> None:
+        self.total_seen += 1
+        reason = name_reject_reason(candidate.name, candidate.barcode)
+        if reason is not None:
+            self.rejects[reason] += 1
+            return
+
+        self.total_valid += 1
+        self.offer_winner(candidate)
+
+    def offer_winner(self, candidate: Candidate) -> None:
+        self.pending.append(
+            (
+                candidate.barcode,
+                candidate.name,
+                candidate.brand,
+                candidate.category,
+                candidate.source,
+                candidate.source_rank,
+                candidate.quality_score,
+            )
+        )
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        self.connection.executemany(
+            """
+            INSERT INTO staging (barcode, name, brand, category, source, source_rank, quality_score)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """
+            + self.UPSERT_TAIL,
+            self.pending,
+        )
+        self.connection.commit()
+        self.pending = []
+
+    def merge(self, other: "Aggregator") -> None:
+        self.total_seen += other.total_seen
+        self.total_valid += other.total_valid
+        self.rejects.update(other.rejects)
+        if not isinstance(other, SQLiteStagingAggregator):
+            for candidate in other.iter_winners():
+                self.offer_winner(candidate)
+            return
+
+        self.flush()
+        other.flush()
+        self.connection.execute("ATTACH DATABASE ? AS other", (str(other.path),))
+        try:
+            # WHERE true keeps the upsert's ON from being parsed as a join constraint.
+            self.connection.execute(
+                """
+                INSERT INTO staging (barcode, name, brand, category, source, source_rank, quality_score)
+                SELECT barcode, name, brand, category, source, source_rank, quality_score
+                FROM other.staging
+                WHERE true
+                ORDER BY rowid
+                """
+                + self.UPSERT_TAIL
+            )
+            self.connection.commit()
+        finally:
+            self.connection.execute("DETACH DATABASE other")
+
+    def iter_winners(self) -> Iterator[Candidate]:
+        self.flush()
+        cursor = self.connection.execute(
+            """
+            SELECT barcode, name, brand, category, source, source_rank, quality_score
+            FROM staging
+            ORDER BY rowid
+            """
+        )
+        for row in cursor:
+            yield Candidate(*row)
+
+    def close(self) -> None:
+        self.pending = []
+        self.connection.close()
+        self.path.unlink(missing_ok=True)
+
+
+Aggregator = Union[CandidateAggregator, CompactCandidateAggregator, SQLiteStagingAggregator]
+
+
+def create_aggregator(backend: str, staging_dir: Optional[Path] = None) -> Aggregator:
+    if backend == "dict":
+        return CandidateAggregator()
+    if backend == "compact":
+        return CompactCandidateAggregator()
+    if backend == "sqlite":
+        return SQLiteStagingAggregator(staging_dir)
+    raise ValueError(f"unknown aggregator backend: {backend}")
+
+
+def is_ascii_digits(barcode: str) -> bool:
+    # str.isdigit also accepts superscripts and other scripts' digits; int() rejects or converts those.
+    return barcode.isascii() and barcode.isdecimal()
+
+
+def barcode_key(barcode: str) -> int:
+    # The leading 1 keeps leading zeros, so "0123" and "123" stay distinct keys.
+    # Only for is_ascii_digits() barcodes.
+    return int("1" + barcode)
+
+
+def barcode_from_key(key: int) -> str:
+    return str(key)[1:]
+
+
+def estimate_candidate_bytes(candidates: Iterable[Candidate], count: int) -> int:
+    """Estimate what `count` Candidate objects cost, measured on a sample."""
+    sample = list(itertools.islice(candidates, MEMORY_SAMPLE_SIZE))
+    if not sample:
+        return 0
+    sampled = 0
+    for candidate in sample:
+        sampled += sys.getsizeof(candidate) + sys.getsizeof(candidate.__dict__)
+        for value in (candidate.barcode, candidate.name, candidate.brand, candidate.category):
+            if value is not None:
+                sampled += sys.getsizeof(value)
+    return sampled * count // len(sample)
+
+
+def format_mib(size: int) -> str:
+    return f"{size / (1024 * 1024):.1f} MiB"
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
+
+
+def peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class _CharFilter(dict):
+    """str.translate() table keeping the characters `keep` accepts; filled in lazily per code point."""
+
+    def __init__(self, keep: Callable[[str], bool]) -> None:
+        super().__init__()
+        self.keep = keep
+
+    def __missing__(self, ordinal: int) -> Optional[int]:
+        value = ordinal if self.keep(chr(ordinal)) else None
+        self[ordinal] = value
+        return value
+
+
+DIGITS_ONLY = _CharFilter(str.isdigit)
+
 
 def normalize_text(value: str) -> str:
-    return SPACE_RE.sub(" ", value.strip())
+    # split() and strip() share the regex engine's notion of Unicode whitespace.
+    return " ".join(value.split())
 
 
 def normalize_barcode(raw: str) -> str:
-    return "".join(ch for ch in raw if ch.isdigit())
+    return raw.translate(DIGITS_ONLY)
+
+
+def gtin_check_digit(body: str) -> int:
+    # ASCII digits only. GS1 weights alternate 3, 1, 3, ... starting from the digit next to the check digit.
+    total = sum(int(digit) * (3 if index % 2 == 0 else 1) for index, digit in enumerate(reversed(body)))
+    return (10 - total % 10) % 10
+
+
+def expand_upce(code: str) -> str:
+    """Expand an 8-digit UPC-E code (number system 0 or 1) to its 12-digit UPC-A form."""
+    system, body, check = code[0], code[1:7], code[7]
+    last = body[5]
+    if last in "012":
+        middle = body[:2] + last + "0000" + body[2:5]
+    elif last == "3":
+        middle = body[:3] + "00000" + body[3:5]
+    elif last == "4":
+        middle = body[:4] + "00000" + body[4]
+    else:
+        middle = body[:5] + "0000" + last
+    return system + middle + check
+
+
+def canonicalize_gtin(raw: str) -> Optional[str]:
+    """Return the canonical form of a GTIN-8/12/13/14, or None if it is not a valid GTIN.
+
+    UPC-A, EAN-13 and GTIN-14 spellings of one product collapse to the form iOS
+    scanners report: 8 digits for EAN-8, 13 for EAN-13/UPC-A, 14 otherwise.
+    An 8-digit code is valid as EAN-8 or, with number system 0 or 1, as UPC-E
+    checked on its UPC-A expansion. It keeps its 8 digits either way: the app
+    looks codes up as scanned, and the digits alone cannot tell UPC-E from EAN-8.
+    """
+    digits = normalize_barcode(raw)
+    # Superscripts and other scripts' digits pass normalize_barcode but are not GTIN digits.
+    if len(digits) not in GTIN_LENGTHS or not is_ascii_digits(digits):
+        return None
+    checked = digits
+    if len(digits) == 8 and digits[0] in "01" and gtin_check_digit(digits[:-1]) != int(digits[-1]):
+        checked = expand_upce(digits)
+    if gtin_check_digit(checked[:-1]) != int(checked[-1]):
+        return None
+
+    gtin14 = digits.zfill(14)
+    if gtin14.startswith("000000"):
+        return gtin14[6:]
+    if gtin14.startswith("0"):
+        return gtin14[1:]
+    return gtin14
+
+
+def clean_barcode(raw: str, options: ParseOptions) -> str:
+    if options.canonical_gtin:
+        return canonicalize_gtin(raw) or ""
+    return normalize_barcode(raw)
+
+
+def sample_threshold(options: ParseOptions) -> Optional[int]:
+    """CRC-32 bound below which a barcode is in the sample; None when every barcode is kept."""
+    if options.sample >= 1.0:
+        return None
+    return int(options.sample * SAMPLE_SPACE)
+
+
+def barcode_reject_reason(raw: str) -> str:
+    return "invalid_barcode" if raw.strip() else "empty_barcode"
 
 
 def normalize_optional(value: Optional[str]) -> Optional[str]:
@@ -73,70 +867,124 @@ def normalize_optional(value: Optional[str]) -> Optional[str]:
     return text if text else None
 
 
-def is_valid_name(raw_name: str, barcode: str) -> bool:
-    name = normalize_text(raw_name)
-    if not name:
-        return False
+@lru_cache(maxsize=FIELD_CACHE_SIZE)
+def normalize_field(value: Optional[str]) -> Optional[str]:
+    """normalize_optional() memoised for brand and category columns."""
+    return normalize_optional(value)
+
 
-    lower = name.lower()
-    if lower == "поиск":
-        return False
-    if any(token in lower for token in GENERIC_TOKENS):
-        return False
+@lru_cache(maxsize=FIELD_CACHE_SIZE)
+def first_list_item(value: Optional[str]) -> Optional[str]:
+    """First entry of an Open*Facts comma-separated brands/categories field, normalised; memoised."""
+    text = normalize_optional(value)
+    return normalize_optional(text.split(",")[0]) if text else None
+
+
+class NameFeatures(NamedTuple):
+    text: str
+    lower: str
+    letters: int
+    digits: str
+    generic: bool
+
+
+@lru_cache(maxsize=NAME_FEATURES_CACHE_SIZE)
+def name_features(raw_name: str) -> NameFeatures:
+    """Normalise a name once for both name_reject_reason() and compute_quality_score()."""
+    text = normalize_text(raw_name)
+    lower = text.lower()
+    # Positional arguments: keyword construction of a NamedTuple costs noticeably more per row.
+    return NameFeatures(
+        text, lower, sum(map(str.isalpha, text)), text.translate(DIGITS_ONLY), GENERIC_TOKEN_RE.search(lower) is not None
+    )
+
+
+def name_reject_reason(raw_name: str, barcode: str) -> Optional[str]:
+    features = name_features(raw_name)
+    name = features.text
+    if not name:
+        return "empty_name"
+    if features.generic:
+        return "generic_token"
     if name == barcode:
-        return False
+        return "name_is_barcode"
 
-    if LETTER_RE.search(name) is None:
-        return False
+    # LETTER_RE only matches alphabetic characters, so a name without any skips the regex.
+    if not features.letters or LETTER_RE.search(name) is None:
+        return "no_letters"
 
-    digits_only = "".join(ch for ch in name if ch.isdigit())
-    if digits_only == barcode and len(name) <= len(barcode) + 4:
-        return False
+    if features.digits == barcode and len(name) <= len(barcode) + 4:
+        return "digits_only_name"
 
-    return True
+    return None
+
+
+def is_valid_name(raw_name: str, barcode: str) -> bool:
+    return name_reject_reason(raw_name, barcode) is None
 
 
 def compute_quality_score(raw_name: str, barcode: str) -> int:
-    name = normalize_text(raw_name)
-    letters = sum(1 for ch in name if ch.isalpha())
-    score = letters * 2 + min(len(name), 140)
+    features = name_features(raw_name)
+    name = features.text
+    score = features.letters * 2 + min(len(name), 140)
 
-    lower = name.lower()
-    if lower.isupper():
+    # Only true for names whose cased letters have no lowercase form (e.g. "ℂ"); kept for stable scores.
+    if features.lower.isupper():
         score -= 2
     if barcode in name:
         score -= 20
     if len(name) < 6:
         score -= 10
-    if any(token in lower for token in GENERIC_TOKENS):
+    if features.generic:
         score -= 1000
 
     return score
 
 
-def parse_uhtt_zip(path: Path, source_rank: int) -> Iterator[Candidate]:
+def list_uhtt_entries(archive: zipfile.ZipFile) -> List[str]:
+    return sorted(
+        name
+        for name in archive.namelist()
+        if name.lower().endswith(".csv") and "uhtt_barcode_ref_" in Path(name).name.lower()
+    )
+
+
+def parse_uhtt_zip(
+    path: SourceFile,
+    source_rank: int,
+    entries: Optional[List[str]] = None,
+    options: ParseOptions = DEFAULT_PARSE_OPTIONS,
+    rejects: Optional[Counter] = None,
+) -> Iterator[Candidate]:
+    rejects = Counter() if rejects is None else rejects
+    sample_below = sample_threshold(options)
     with zipfile.ZipFile(path, "r") as archive:
-        entries = sorted(
-            name
-            for name in archive.namelist()
-            if name.lower().endswith(".csv") and "uhtt_barcode_ref_" in Path(name).name.lower()
-        )
+        if entries is None:
+            entries = list_uhtt_entries(archive)
         for entry in entries:
             with archive.open(entry, "r") as binary_file:
                 with io.TextIOWrapper(binary_file, encoding="utf-8", errors="ignore", newline="") as text_file:
                     reader = csv.reader(text_file, delimiter="\t")
                     for row in reader:
                         if len(row) < 7:
+                            rejects["short_row"] += 1
                             continue
                         if row[0].strip().lower() == "id":
                             continue
 
-                        barcode = normalize_barcode(row[1])
-                        name = normalize_text(row[2])
-                        category = normalize_optional(row[4])
-                        brand = normalize_optional(row[6])
+                        barcode = clean_barcode(row[1], options)
+                        if not barcode:
+                            rejects[barcode_reject_reason(row[1])] += 1
+                            continue
+                        if sample_below is not None and zlib.crc32(barcode.encode()) >= sample_below:
+                            rejects["sampled_out"] += 1
+                            continue
 
-                        if not barcode or not name:
+                        name = normalize_text(row[2])
+                        category = normalize_field(row[4])
+                        brand = normalize_field(row[6])
+                        if not name:
+                            rejects["missing_name"] += 1
                             continue
 
                         yield Candidate(
@@ -150,7 +998,48 @@ def parse_uhtt_zip(path: Path, source_rank: int) -> Iterator[Candidate]:
                         )
 
 
-def parse_catalog_csv_zip(path: Path, source_rank: int) -> Iterator[Candidate]:
+def catalog_candidates(
+    rows: Iterable[Tuple[str, str, Optional[str], Optional[str]]],
+    source_rank: int,
+    options: ParseOptions = DEFAULT_PARSE_OPTIONS,
+    rejects: Optional[Counter] = None,
+) -> Iterator[Candidate]:
+    """Candidates from (barcode, name, vendor, category) rows of either catalog.app export."""
+    rejects = Counter() if rejects is None else rejects
+    sample_below = sample_threshold(options)
+    for raw_barcode, raw_name, raw_vendor, raw_category in rows:
+        barcode = clean_barcode(raw_barcode, options)
+        if not barcode:
+            rejects[barcode_reject_reason(raw_barcode)] += 1
+            continue
+        if sample_below is not None and zlib.crc32(barcode.encode()) >= sample_below:
+            rejects["sampled_out"] += 1
+            continue
+
+        name = normalize_text(raw_name)
+        brand = normalize_field(raw_vendor)
+        category = normalize_field(raw_category)
+        if not name:
+            rejects["missing_name"] += 1
+            continue
+
+        yield Candidate(
+            barcode=barcode,
+            name=name,
+            brand=brand,
+            category=category,
+            source="catalog",
+            source_rank=source_rank,
+            quality_score=compute_quality_score(name, barcode),
+        )
+
+
+def parse_catalog_csv_zip(
+    path: SourceFile,
+    source_rank: int,
+    options: ParseOptions = DEFAULT_PARSE_OPTIONS,
+    rejects: Optional[Counter] = None,
+) -> Iterator[Candidate]:
     with zipfile.ZipFile(path, "r") as archive:
         target_name = None
         for name in archive.namelist():
@@ -163,111 +1052,955 @@ def parse_catalog_csv_zip(path: Path, source_rank: int) -> Iterator[Candidate]:
         with archive.open(target_name, "r") as binary_file:
             with io.TextIOWrapper(binary_file, encoding="utf-8", errors="ignore", newline="") as text_file:
                 reader = csv.DictReader(text_file, delimiter=";")
-                for row in reader:
-                    barcode = normalize_barcode(row.get("Barcode", ""))
-                    name = normalize_text(row.get("Name", ""))
-                    brand = normalize_optional(row.get("Vendor"))
-                    category = normalize_optional(row.get("Category"))
-
-                    if not barcode or not name:
-                        continue
-
-                    yield Candidate(
-                        barcode=barcode,
-                        name=name,
-                        brand=brand,
-                        category=category,
-                        source="catalog",
-                        source_rank=source_rank,
-                        quality_score=compute_quality_score(name, barcode),
-                    )
+                rows = (
+                    (row.get("Barcode") or "", row.get("Name") or "", row.get("Vendor"), row.get("Category"))
+                    for row in reader
+                )
+                yield from catalog_candidates(rows, source_rank, options, rejects)
 
 
-def parse_openfacts_gzip(path: Path, source: str, source_rank: int) -> Iterator[Candidate]:
-    with gzip.open(path, "rt", encoding="utf-8", errors="ignore", newline="") as text_file:
-        reader = csv.DictReader(text_file, delimiter="\t")
-        for row in reader:
-            barcode = normalize_barcode(row.get("code", ""))
-            if not barcode:
-                continue
+def find_sqlite_entry(archive: zipfile.ZipFile) -> Optional[str]:
+    """Name of the first archive member that is an SQLite database, judged by its header rather than its name."""
+    for info in archive.infolist():
+        if info.is_dir() or info.file_size < len(SQLITE_HEADER):
+            continue
+        with archive.open(info) as handle:
+            if handle.read(len(SQLITE_HEADER)) == SQLITE_HEADER:
+                return info.filename
+    return None
+
 
-            name = (
-                normalize_optional(row.get("product_name"))
-                or normalize_optional(row.get("generic_name"))
-                or normalize_optional(row.get("abbreviated_product_name"))
+def extract_catalog_db(path: Path, target_dir: Path) -> Path:
+    """Extract the database from catalog-barcodes-db.zip into `target_dir`; later builds reuse it while the zip is
+    unchanged. Never the raw directory: it holds the downloads and their manifest, and may be read-only or shared.
+    """
+    stat = path.stat()
+    target = target_dir / f".{path.stem}.{stat.st_size}-{stat.st_mtime_ns}.sqlite"
+    if target.exists():
+        return target
+    with zipfile.ZipFile(path, "r") as archive:
+        entry = find_sqlite_entry(archive)
+        if entry is None:
+            raise RuntimeError(f"no SQLite database found in {path}")
+        with atomic_output(target) as tmp_path, archive.open(entry) as source, tmp_path.open("wb") as handle:
+            shutil.copyfileobj(source, handle, 1 << 20)
+    for old in target_dir.glob(f".{path.stem}.*.sqlite"):
+        if old != target:
+            old.unlink(missing_ok=True)
+    return target
+
+
+def has_text_affinity(declared_type: str) -> bool:
+    # SQLite's column affinity rules: INT wins over the text markers.
+    declared = declared_type.upper()
+    return "INT" not in declared and any(marker in declared for marker in ("CHAR", "CLOB", "TEXT"))
+
+
+def catalog_db_query(connection: sqlite3.Connection) -> str:
+    """SELECT of CATALOG_DB_COLUMNS from the export's barcode table, in stored (= export) row order."""
+    tables = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")
+    for (table,) in tables.fetchall():
+        quoted = '"' + table.replace('"', '""') + '"'
+        info = connection.execute(f"PRAGMA table_info({quoted})").fetchall()
+        columns = {row[1].lower(): row[1] for row in info}
+        if "barcode" in columns and "name" in columns:
+            # An INTEGER column has already dropped leading zeros and a REAL one adds ".0", so such a
+            # table cannot give the CSV export's barcodes back.
+            barcode_type = next(row[2] for row in info if row[1].lower() == "barcode")
+            if not has_text_affinity(barcode_type):
+                raise RuntimeError(
+                    f"catalog database stores barcodes as {barcode_type or 'untyped'} values, not TEXT; "
+                    "use --catalog-format csv"
+                )
+            selected = ", ".join(
+                '"' + columns[name].replace('"', '""') + '"' if name in columns else "NULL"
+                for name in CATALOG_DB_COLUMNS
             )
-            if not name:
-                continue
+            return f"SELECT {selected} FROM {quoted} ORDER BY rowid"
+    raise RuntimeError("catalog database has no table with Barcode and Name columns")
 
-            brand_raw = normalize_optional(row.get("brands"))
-            brand = None
-            if brand_raw:
-                brand = normalize_optional(brand_raw.split(",")[0])
 
-            category_raw = normalize_optional(row.get("categories"))
-            category = None
-            if category_raw:
-                category = normalize_optional(category_raw.split(",")[0])
+def parse_catalog_db_zip(
+    path: Path,
+    source_rank: int,
+    options: ParseOptions = DEFAULT_PARSE_OPTIONS,
+    rejects: Optional[Counter] = None,
+    extract_dir: Optional[Path] = None,
+) -> Iterator[Candidate]:
+    """Read catalog-barcodes-db.zip through SQL; no CSV tokenising.
 
-            yield Candidate(
-                barcode=barcode,
-                name=name,
-                brand=brand,
-                category=category,
-                source=source,
-                source_rank=source_rank,
-                quality_score=compute_quality_score(name, barcode),
+    With `extract_dir` (builds pass --staging-dir) the zip is inflated once and reused by later builds;
+    without it the database goes to a temporary directory that is removed afterwards.
+    """
+    with ExitStack() as stack:
+        if extract_dir is None:
+            extract_dir = Path(stack.enter_context(tempfile.TemporaryDirectory(prefix="barcode-catalog-")))
+        yield from read_catalog_db(extract_catalog_db(path, extract_dir), source_rank, options, rejects)
+
+
+def read_catalog_db(
+    database: Path,
+    source_rank: int,
+    options: ParseOptions = DEFAULT_PARSE_OPTIONS,
+    rejects: Optional[Counter] = None,
+) -> Iterator[Candidate]:
+    connection = sqlite3.connect(f"file:{database}?mode=ro", uri=True)
+    try:
+        cursor = connection.execute(catalog_db_query(connection))
+        # Barcodes are TEXT (see catalog_db_query); other typed columns come back as int/float, and
+        # NULL is what the CSV export writes as an empty cell.
+        rows = (
+            (
+                "" if barcode is None else str(barcode),
+                "" if name is None else str(name),
+                None if vendor is None else str(vendor),
+                None if category is None else str(category),
             )
+            for barcode, name, vendor, category in cursor
+        )
+        yield from catalog_candidates(rows, source_rank, options, rejects)
+    finally:
+        connection.close()
 
 
-def build_index(raw_dir: Path, output_db: Path, include_off_food: bool) -> None:
-    output_db.parent.mkdir(parents=True, exist_ok=True)
+def resolve_columns(header: List[str], names: Iterable[str]) -> Tuple[int, ...]:
+    """Map column names to positions in a TSV header; -1 marks a missing column.
 
-    aggregator = CandidateAggregator()
+    Later duplicates win, matching what csv.DictReader would expose.
+    """
+    positions = {name: index for index, name in enumerate(header)}
+    return tuple(positions.get(name, -1) for name in names)
 
-    uhtt_archives = sorted(raw_dir.glob("*uhtt*.zip"))
-    if uhtt_archives:
-        for archive in uhtt_archives:
-            print(f"[uhtt] parsing {archive}", file=sys.stderr)
-            for candidate in parse_uhtt_zip(archive, source_rank=300):
-                aggregator.offer(candidate)
-    else:
-        print("[warn] UHTT archive not found (*.zip)", file=sys.stderr)
 
-    catalog_csv_zip = raw_dir / "catalog-barcodes-csv.zip"
-    if catalog_csv_zip.exists():
-        print(f"[catalog] parsing {catalog_csv_zip}", file=sys.stderr)
-        for candidate in parse_catalog_csv_zip(catalog_csv_zip, source_rank=200):
-            aggregator.offer(candidate)
-    else:
-        print("[warn] catalog-barcodes-csv.zip not found", file=sys.stderr)
+def parse_openfacts_rows(
+    rows: Iterator[List[str]],
+    columns: Tuple[int, ...],
+    source: str,
+    source_rank: int,
+    options: ParseOptions = DEFAULT_PARSE_OPTIONS,
+    rejects: Optional[Counter] = None,
+) -> Iterator[Candidate]:
+    rejects = Counter() if rejects is None else rejects
+    code_at, product_name_at, generic_name_at, abbreviated_name_at, brands_at, categories_at, *filter_columns = columns
+    if code_at < 0:
+        return
+    countries = frozenset(options.countries)
+    categories = frozenset(options.categories)
+    prefixes = options.barcode_prefixes
+    sample_below = sample_threshold(options)
+    countries_at, category_tags_at = filter_columns
+    if countries and countries_at < 0:
+        raise RuntimeError(f"{source} dump has no countries_tags column to filter on")
+    if categories and category_tags_at < 0:
+        raise RuntimeError(f"{source} dump has no categories_tags column to filter on")
+    used = columns[:6] + ((countries_at,) if countries else ()) + ((category_tags_at,) if categories else ())
+    min_width = max(used) + 1
 
-    openfacts_sources = [
-        (raw_dir / "openbeautyfacts-products.csv.gz", "open_beauty_facts", 100),
-        (raw_dir / "openpetfoodfacts-products.csv.gz", "open_pet_food_facts", 100),
-        (raw_dir / "openproductsfacts-products.csv.gz", "open_products_facts", 100),
-    ]
+    for row in rows:
+        if len(row) < min_width:
+            # Ragged rows are rare; pad them so positional access stays branch-free below.
+            if not row:
+                continue
+            row = row + [""] * (min_width - len(row))
 
-    if include_off_food:
-        openfacts_sources.append((raw_dir / "openfoodfacts-products.csv.gz", "open_food_facts", 100))
+        raw_code = row[code_at]
+        if not raw_code:
+            rejects["empty_barcode"] += 1
+            continue
+        if countries and countries.isdisjoint(row[countries_at].split(",")):
+            rejects["filtered_country"] += 1
+            continue
+        if categories and categories.isdisjoint(row[category_tags_at].split(",")):
+            rejects["filtered_category"] += 1
+            continue
+        barcode = clean_barcode(raw_code, options)
+        if not barcode:
+            rejects[barcode_reject_reason(raw_code)] += 1
+            continue
+        if prefixes and not prefix_in_ranges(barcode, prefixes):
+            rejects["filtered_barcode_prefix"] += 1
+            continue
+        if sample_below is not None and zlib.crc32(barcode.encode()) >= sample_below:
+            rejects["sampled_out"] += 1
+            continue
 
-    for path, source, rank in openfacts_sources:
-        if not path.exists():
-            print(f"[warn] source file not found: {path.name}", file=sys.stderr)
+        name = (
+            (normalize_optional(row[product_name_at]) if product_name_at >= 0 else None)
+            or (normalize_optional(row[generic_name_at]) if generic_name_at >= 0 else None)
+            or (normalize_optional(row[abbreviated_name_at]) if abbreviated_name_at >= 0 else None)
+        )
+        if not name:
+            rejects["missing_name"] += 1
             continue
 
-        print(f"[{source}] parsing {path}", file=sys.stderr)
-        for candidate in parse_openfacts_gzip(path, source=source, source_rank=rank):
-            aggregator.offer(candidate)
+        brand = first_list_item(row[brands_at]) if brands_at >= 0 else None
+        category = first_list_item(row[categories_at]) if categories_at >= 0 else None
 
-    now = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+        yield Candidate(
+            barcode=barcode,
+            name=name,
+            brand=brand,
+            category=category,
+            source=source,
+            source_rank=source_rank,
+            quality_score=compute_quality_score(name, barcode),
+        )
 
-    connection = sqlite3.connect(output_db)
-    try:
-        cursor = connection.cursor()
-        cursor.execute(
+
+def parse_openfacts_text(
+    text_file: Iterable[str],
+    source: str,
+    source_rank: int,
+    options: ParseOptions = DEFAULT_PARSE_OPTIONS,
+    rejects: Optional[Counter] = None,
+) -> Iterator[Candidate]:
+    # A positional reader over only the columns we use; DictReader built ~200-key dicts per row.
+    reader = csv.reader(text_file, delimiter="\t")
+    header = next((row for row in reader if row), None)
+    if header is None:
+        return
+    columns = resolve_columns(header, OPENFACTS_COLUMNS)
+    yield from parse_openfacts_rows(reader, columns, source, source_rank, options, rejects)
+
+
+def read_tsv_header(text_file: Iterable[str]) -> Optional[List[str]]:
+    return next((row for row in csv.reader(text_file, delimiter="\t") if row), None)
+
+
+def ends_inside_quotes(line: str, in_quotes: bool) -> bool:
+    """Whether csv.reader (tab delimiter, doubled quotes) is still inside a quoted field after `line`."""
+    index = 0
+    length = len(line)
+    at_field_start = not in_quotes
+    while index < length:
+        if in_quotes:
+            close = line.find('"', index)
+            if close < 0:
+                return True
+            if line.startswith('"', close + 1):
+                index = close + 2
+                continue
+            in_quotes = False
+            at_field_start = False
+            index = close + 1
+        elif at_field_start and line[index] == '"':
+            in_quotes = True
+            index += 1
+        else:
+            # Outside quotes a '"' only matters at the start of a field, so skip to the next one.
+            tab = line.find("\t", index)
+            if tab < 0:
+                return False
+            at_field_start = True
+            index = tab + 1
+    return in_quotes
+
+
+def iter_record_chunks(text_file: Iterable[str], lines_per_chunk: int) -> Iterator[str]:
+    """Group TSV lines into blocks of about `lines_per_chunk`, never splitting a quoted multi-line record."""
+    lines: List[str] = []
+    in_quotes = False
+    for line in text_file:
+        lines.append(line)
+        if in_quotes or '"' in line:
+            in_quotes = ends_inside_quotes(line, in_quotes)
+        if len(lines) >= lines_per_chunk and not in_quotes:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+
+def aggregate_openfacts_chunk(
+    chunk: str,
+    columns: Tuple[int, ...],
+    source: str,
+    source_rank: int,
+    backend: str = "dict",
+    staging_dir: Optional[Path] = None,
+    options: ParseOptions = DEFAULT_PARSE_OPTIONS,
+) -> Aggregator:
+    aggregator = create_aggregator(backend, staging_dir)
+    # newline="" splits lines exactly the way the gzip text reader did in the main process.
+    reader = csv.reader(io.StringIO(chunk, newline=""), delimiter="\t")
+    for candidate in parse_openfacts_rows(reader, columns, source, source_rank, options, aggregator.rejects):
+        aggregator.offer(candidate)
+    return aggregator
+
+
+def parse_openfacts_gzip(
+    path: SourceFile,
+    source: str,
+    source_rank: int,
+    options: ParseOptions = DEFAULT_PARSE_OPTIONS,
+    rejects: Optional[Counter] = None,
+) -> Iterator[Candidate]:
+    with gzip.open(path, "rt", encoding="utf-8", errors="ignore", newline="") as text_file:
+        yield from parse_openfacts_text(text_file, source, source_rank, options, rejects)
+
+
+class _StageFailure:
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+_PIPELINE_END = object()
+
+
+def _queue_put(target: queue.Queue, item: object, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            target.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _queue_get(source: queue.Queue, stop: threading.Event) -> object:
+    while not stop.is_set():
+        try:
+            return source.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _PIPELINE_END
+
+
+class _BlockQueueReader(io.RawIOBase):
+    """Raw file view over decompressed byte blocks arriving from the reader thread."""
+
+    def __init__(self, blocks: queue.Queue, stop: threading.Event) -> None:
+        super().__init__()
+        self.blocks = blocks
+        self.stop = stop
+        self.pending = memoryview(b"")
+        self.finished = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.pending:
+            if self.finished:
+                return 0
+            item = _queue_get(self.blocks, self.stop)
+            if item is _PIPELINE_END:
+                self.finished = True
+                return 0
+            if isinstance(item, _StageFailure):
+                raise item.error
+            self.pending = memoryview(item)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def parse_openfacts_gzip_pipelined(
+    path: SourceFile,
+    source: str,
+    source_rank: int,
+    options: ParseOptions = DEFAULT_PARSE_OPTIONS,
+    rejects: Optional[Counter] = None,
+) -> Iterator[Candidate]:
+    """Same output as parse_openfacts_gzip, split into threaded stages.
+
+    A reader thread inflates large blocks (zlib drops the GIL while it works),
+    a parse thread decodes, tokenises and scores rows into candidate batches,
+    and the caller aggregates. Bounded queues between the stages provide
+    back-pressure, so at most PIPELINE_QUEUE_DEPTH blocks and batches are in flight.
+    """
+    blocks: queue.Queue = queue.Queue(maxsize=PIPELINE_QUEUE_DEPTH)
+    batches: queue.Queue = queue.Queue(maxsize=PIPELINE_QUEUE_DEPTH)
+    stop = threading.Event()
+    # The caller may share `rejects` with its aggregator, so the parse thread counts separately.
+    parse_rejects: Counter = Counter()
+
+    def read_blocks() -> None:
+        try:
+            with gzip.open(path, "rb") as binary_file:
+                while True:
+                    block = binary_file.read(PIPELINE_BLOCK_SIZE)
+                    if not block:
+                        break
+                    if not _queue_put(blocks, block, stop):
+                        return
+        except Exception as error:
+            _queue_put(blocks, _StageFailure(error), stop)
+            return
+        _queue_put(blocks, _PIPELINE_END, stop)
+
+    def parse_blocks() -> None:
+        try:
+            raw = io.BufferedReader(_BlockQueueReader(blocks, stop), PIPELINE_BLOCK_SIZE)
+            with io.TextIOWrapper(raw, encoding="utf-8", errors="ignore", newline="") as text_file:
+                batch: List[Candidate] = []
+                for candidate in parse_openfacts_text(text_file, source, source_rank, options, parse_rejects):
+                    batch.append(candidate)
+                    if len(batch) >= PIPELINE_BATCH_SIZE:
+                        if not _queue_put(batches, batch, stop):
+                            return
+                        batch = []
+                if batch and not _queue_put(batches, batch, stop):
+                    return
+        except Exception as error:
+            _queue_put(batches, _StageFailure(error), stop)
+            return
+        _queue_put(batches, _PIPELINE_END, stop)
+
+    threads = [
+        threading.Thread(target=read_blocks, name=f"{source}-inflate", daemon=True),
+        threading.Thread(target=parse_blocks, name=f"{source}-parse", daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = batches.get()
+            if item is _PIPELINE_END:
+                break
+            if isinstance(item, _StageFailure):
+                raise item.error
+            yield from item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        if rejects is not None:
+            rejects.update(parse_rejects)
+
+
+def collect_source_tasks(
+    raw_dir: Path,
+    include_off_food: bool,
+    split_archives: bool = False,
+    catalog_format: str = "auto",
+) -> List[SourceTask]:
+    tasks: List[SourceTask] = []
+
+    uhtt_archives = sorted(raw_dir.glob("*uhtt*.zip"))
+    if uhtt_archives:
+        for archive in uhtt_archives:
+            if not split_archives:
+                tasks.append(SourceTask("uhtt", archive, "uhtt", 300))
+                continue
+            with zipfile.ZipFile(archive, "r") as handle:
+                entries = list_uhtt_entries(handle)
+            for entry in entries:
+                tasks.append(SourceTask("uhtt", archive, "uhtt", 300, entry=entry))
+    else:
+        print("[warn] UHTT archive not found (*.zip)", file=sys.stderr)
+
+    catalog_csv_zip = raw_dir / "catalog-barcodes-csv.zip"
+    catalog_db_zip = raw_dir / "catalog-barcodes-db.zip"
+    use_db = False
+    # 'auto' stays on the CSV export while it is there; the database is the fallback when it is not.
+    if catalog_format == "db" or (catalog_format == "auto" and not catalog_csv_zip.exists()):
+        use_db = catalog_db_zip.exists()
+    if use_db:
+        with zipfile.ZipFile(catalog_db_zip, "r") as handle:
+            use_db = find_sqlite_entry(handle) is not None
+        if not use_db:
+            print(f"[warn] {catalog_db_zip.name} holds no SQLite database", file=sys.stderr)
+    if use_db:
+        tasks.append(SourceTask("catalog_db", catalog_db_zip, "catalog", 200))
+    elif catalog_format == "db":
+        raise RuntimeError(f"--catalog-format db needs an SQLite database in {catalog_db_zip}")
+    elif catalog_csv_zip.exists():
+        tasks.append(SourceTask("catalog", catalog_csv_zip, "catalog", 200))
+    else:
+        print("[warn] catalog-barcodes-csv.zip not found", file=sys.stderr)
+
+    openfacts_sources = [
+        (raw_dir / "openbeautyfacts-products.csv.gz", "open_beauty_facts", 100),
+        (raw_dir / "openpetfoodfacts-products.csv.gz", "open_pet_food_facts", 100),
+        (raw_dir / "openproductsfacts-products.csv.gz", "open_products_facts", 100),
+    ]
+
+    if include_off_food:
+        openfacts_sources.append((raw_dir / "openfoodfacts-products.csv.gz", "open_food_facts", 100))
+
+    for path, source, rank in openfacts_sources:
+        if not path.exists():
+            print(f"[warn] source file not found: {path.name}", file=sys.stderr)
+            continue
+        tasks.append(SourceTask("openfacts", path, source, rank))
+
+    return tasks
+
+
+def task_compressed_bytes(task: SourceTask) -> int:
+    if task.entry is None:
+        return task.path.stat().st_size
+    with zipfile.ZipFile(task.path, "r") as archive:
+        return archive.getinfo(task.entry).compress_size
+
+
+class ProgressFile(io.FileIO):
+    """Raw source file that reports how many bytes the parser has read from it."""
+
+    def __init__(self, path: Path, progress: "BuildProgress") -> None:
+        super().__init__(path, "rb")
+        self.progress = progress
+        self.consumed = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = super().read(size)
+        self.consumed += len(data)
+        self.progress.update(self.consumed)
+        return data
+
+    def readinto(self, buffer) -> int:
+        size = super().readinto(buffer)
+        self.consumed += size or 0
+        self.progress.update(self.consumed)
+        return size
+
+
+class BuildProgress:
+    """Throughput and ETA on stderr, paced by the compressed bytes consumed so far.
+
+    Progress counts bytes read rather than the read position: zip readers seek
+    to the central directory at the end of the archive first, and a split
+    archive entry starts deep inside its file. The few bytes of zip structure
+    read on top of the data are capped at the task's size.
+    """
+
+    def __init__(self, total_bytes: int, count_rows: Optional[Callable[[], int]] = None) -> None:
+        self.total_bytes = total_bytes
+        self.count_rows = count_rows
+        self.started = self.last_report = time.monotonic()
+        self.done_bytes = 0
+        self.done_rows = 0
+        self.position = 0
+        self.task_bytes = 0
+        self.label = ""
+
+    def open(self, task: SourceTask) -> ProgressFile:
+        self.label = task.source
+        self.position = 0
+        self.task_bytes = task_compressed_bytes(task)
+        return ProgressFile(task.path, self)
+
+    def update(self, consumed: int) -> None:
+        self.position = min(consumed, self.task_bytes)
+        now = time.monotonic()
+        if now - self.last_report >= PROGRESS_INTERVAL_SECONDS:
+            self.report(now)
+
+    def finish(self, task: SourceTask, rows: int = 0) -> None:
+        self.label = task.source
+        self.done_bytes += task_compressed_bytes(task)
+        self.done_rows += rows
+        self.position = 0
+        self.report(time.monotonic())
+
+    def report(self, now: float) -> None:
+        self.last_report = now
+        consumed = min(self.done_bytes + self.position, self.total_bytes)
+        elapsed = max(now - self.started, 1e-9)
+        rate = consumed / elapsed
+        rows = self.count_rows() if self.count_rows is not None else self.done_rows
+        eta = format_duration((self.total_bytes - consumed) / rate) if rate else "?"
+        percent = 100.0 * consumed / self.total_bytes if self.total_bytes else 100.0
+        print(
+            (
+                f"[progress] {percent:5.1f}% of {format_mib(self.total_bytes)} | "
+                f"{format_mib(int(rate))}/s, {rows / elapsed:,.0f} rows/s | eta {eta} | {self.label}"
+            ),
+            file=sys.stderr,
+        )
+
+
+@contextmanager
+def profiled(mode: str, output: Path) -> Iterator[None]:
+    """Profile the enclosed block with cProfile (stats dump) or tracemalloc (top allocation sites)."""
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(output)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(PROFILE_TOP_ENTRIES)
+            print(f"[profile] cProfile stats written to {output}", file=sys.stderr)
+        return
+
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        lines = [f"peak traced memory: {format_mib(peak)}"]
+        lines += [str(statistic) for statistic in snapshot.statistics("lineno")[:PROFILE_TOP_ENTRIES]]
+        output.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        print("\n".join(lines), file=sys.stderr)
+        print(f"[profile] tracemalloc top allocations written to {output}", file=sys.stderr)
+
+
+def aggregator_counts(aggregator: "Aggregator") -> Tuple[int, int, Counter]:
+    return aggregator.total_seen, aggregator.total_valid, Counter(aggregator.rejects)
+
+
+def source_stats(
+    task: SourceTask,
+    aggregator: "Aggregator",
+    started: float,
+    before: Optional[Tuple[int, int, Counter]] = None,
+) -> SourceStats:
+    """Stats for the candidates `aggregator` took in since `before` was captured (default: since it was empty)."""
+    seen, valid, rejects = before if before is not None else (0, 0, Counter())
+    return SourceStats(
+        source=task.source,
+        files=[task.file_key],
+        compressed_bytes=task_compressed_bytes(task),
+        seconds=time.perf_counter() - started,
+        candidates=aggregator.total_seen - seen,
+        valid=aggregator.total_valid - valid,
+        rejects=aggregator.rejects - rejects,
+        peak_rss_bytes=peak_rss_bytes(),
+    )
+
+
+def iter_source_candidates(
+    task: SourceTask,
+    options: ParseOptions = DEFAULT_PARSE_OPTIONS,
+    pipelined: bool = False,
+    rejects: Optional[Counter] = None,
+    source_file: Optional[BinaryIO] = None,
+    parse_cache: Optional["ParseCache"] = None,
+    staging_dir: Optional[Path] = None,
+) -> Iterator[Candidate]:
+    if parse_cache is not None:
+        return parse_cache.candidates(
+            task,
+            Counter() if rejects is None else rejects,
+            lambda parsed_rejects: iter_source_candidates(
+                task, options, pipelined, parsed_rejects, source_file, staging_dir=staging_dir
+            ),
+        )
+    path = task.path if source_file is None else source_file
+    if task.kind == "uhtt":
+        entries = None if task.entry is None else [task.entry]
+        return parse_uhtt_zip(path, source_rank=task.source_rank, entries=entries, options=options, rejects=rejects)
+    if task.kind == "catalog":
+        return parse_catalog_csv_zip(path, source_rank=task.source_rank, options=options, rejects=rejects)
+    if task.kind == "catalog_db":
+        # The extracted database is read with SQL, so progress only sees the archive on first extraction.
+        return parse_catalog_db_zip(
+            task.path, source_rank=task.source_rank, options=options, rejects=rejects, extract_dir=staging_dir
+        )
+    if task.kind == "openfacts":
+        parse = parse_openfacts_gzip_pipelined if pipelined else parse_openfacts_gzip
+        return parse(path, source=task.source, source_rank=task.source_rank, options=options, rejects=rejects)
+    raise ValueError(f"unknown source kind: {task.kind}")
+
+
+def aggregate_source_task(
+    task: SourceTask,
+    backend: str = "dict",
+    staging_dir: Optional[Path] = None,
+    options: ParseOptions = DEFAULT_PARSE_OPTIONS,
+    pipelined: bool = False,
+    parse_cache: Optional["ParseCache"] = None,
+) -> Tuple[Aggregator, SourceStats]:
+    started = time.perf_counter()
+    aggregator = create_aggregator(backend, staging_dir)
+    candidates = iter_source_candidates(
+        task, options, pipelined, aggregator.rejects, parse_cache=parse_cache, staging_dir=staging_dir
+    )
+    for candidate in candidates:
+        aggregator.offer(candidate)
+    return aggregator, source_stats(task, aggregator, started)
+
+
+def aggregate_openfacts_chunked(
+    executor: ProcessPoolExecutor,
+    task: SourceTask,
+    settings: BuildSettings,
+    progress: Optional[BuildProgress] = None,
+) -> Aggregator:
+    """Stream record-aligned line blocks of one dump to the pool and merge the partial winners in block order."""
+    aggregator = create_aggregator(settings.aggregator_backend, settings.staging_dir)
+    in_flight: Deque[Future] = deque()
+
+    def merge_oldest() -> None:
+        partial_aggregator = in_flight.popleft().result()
+        aggregator.merge(partial_aggregator)
+        partial_aggregator.close()
+
+    try:
+        source_file = open(task.path, "rb") if progress is None else progress.open(task)
+        with source_file, gzip.open(source_file, "rt", encoding="utf-8", errors="ignore", newline="") as text_file:
+            header = read_tsv_header(text_file)
+            if header is None:
+                return aggregator
+            columns = resolve_columns(header, OPENFACTS_COLUMNS)
+            for chunk in iter_record_chunks(text_file, settings.openfacts_chunk_lines):
+                in_flight.append(
+                    executor.submit(
+                        aggregate_openfacts_chunk,
+                        chunk,
+                        columns,
+                        task.source,
+                        task.source_rank,
+                        backend=settings.aggregator_backend,
+                        staging_dir=settings.staging_dir,
+                        options=settings.parse_options,
+                    )
+                )
+                # Bound decompressed text waiting in the pool instead of reading the whole dump ahead.
+                if len(in_flight) >= settings.jobs * CHUNKS_IN_FLIGHT_PER_JOB:
+                    merge_oldest()
+        while in_flight:
+            merge_oldest()
+    except BaseException:
+        for future in in_flight:
+            future.cancel()
+        aggregator.close()
+        raise
+    return aggregator
+
+
+def iter_task_aggregates(
+    tasks: List[SourceTask],
+    settings: BuildSettings,
+    progress: Optional[BuildProgress] = None,
+    parse_cache: Optional["ParseCache"] = None,
+) -> Iterator[Tuple[SourceTask, Aggregator, SourceStats]]:
+    for task in tasks:
+        print(f"[{task.source}] parsing {task.label}", file=sys.stderr)
+
+    for task, aggregator, stats in _iter_task_aggregates(tasks, settings, progress, parse_cache):
+        if progress is not None:
+            progress.finish(task, stats.candidates)
+        yield task, aggregator, stats
+
+
+def _iter_task_aggregates(
+    tasks: List[SourceTask],
+    settings: BuildSettings,
+    progress: Optional[BuildProgress],
+    parse_cache: Optional["ParseCache"] = None,
+) -> Iterator[Tuple[SourceTask, Aggregator, SourceStats]]:
+    worker = partial(
+        aggregate_source_task,
+        backend=settings.aggregator_backend,
+        staging_dir=settings.staging_dir,
+        options=settings.parse_options,
+        pipelined=settings.pipeline,
+        parse_cache=parse_cache,
+    )
+    # Cached dumps are read whole; only uncached ones are worth splitting (and are not cached then).
+    split = [
+        task.kind == "openfacts" and (parse_cache is None or not parse_cache.has(task)) for task in tasks
+    ]
+    chunked = settings.jobs > 1 and settings.openfacts_chunk_lines > 0
+    if chunked and any(split):
+        with ProcessPoolExecutor(max_workers=settings.jobs) as executor:
+            # Whole-file sources start first; dumps are then split while those run.
+            futures = {index: executor.submit(worker, task) for index, task in enumerate(tasks) if not split[index]}
+            for index, task in enumerate(tasks):
+                if index in futures:
+                    yield (task, *futures.pop(index).result())
+                else:
+                    started = time.perf_counter()
+                    aggregator = aggregate_openfacts_chunked(executor, task, settings, progress)
+                    yield task, aggregator, source_stats(task, aggregator, started)
+    elif settings.jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(settings.jobs, len(tasks))) as executor:
+            # map() yields in submission order, so merging stays in serial source order.
+            for task, (aggregator, stats) in zip(tasks, executor.map(worker, tasks)):
+                yield task, aggregator, stats
+    else:
+        for task in tasks:
+            yield (task, *worker(task))
+
+
+def build_timestamp() -> str:
+    # SOURCE_DATE_EPOCH pins updated_at so that repeated builds are reproducible.
+    epoch = os.environ.get("SOURCE_DATE_EPOCH")
+    moment = datetime.fromtimestamp(int(epoch), timezone.utc) if epoch else datetime.now(timezone.utc)
+    return moment.isoformat().replace("+00:00", "Z")
+
+
+def candidate_to_row(candidate: Candidate, now: str, schema: str = "text") -> tuple:
+    return (
+        int(candidate.barcode) if schema == "integer" else candidate.barcode,
+        candidate.name,
+        candidate.brand,
+        candidate.category or DEFAULT_CATEGORY,
+        candidate.source,
+        candidate.source_rank,
+        candidate.quality_score,
+        now,
+    )
+
+
+def load_manifest_hashes(raw_dir: Path) -> Dict[str, str]:
+    manifest_path = raw_dir / "manifest.json"
+    if not manifest_path.exists():
+        return {}
+    with manifest_path.open("r", encoding="utf-8") as handle:
+        manifest = json.load(handle)
+    return {
+        entry["file"]: entry["sha256"]
+        for entry in manifest.get("datasets", [])
+        if entry.get("file") and entry.get("sha256")
+    }
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_hashes(raw_dir: Path, tasks: List[SourceTask]) -> Dict[str, str]:
+    """sha256 per source file in task order, taken from raw/manifest.json when it lists one."""
+    manifest_hashes = load_manifest_hashes(raw_dir)
+    hashes: Dict[str, str] = {}
+    for task in tasks:
+        if task.file_key not in hashes:
+            hashes[task.file_key] = manifest_hashes.get(task.file_key) or file_sha256(task.path)
+    return hashes
+
+
+class ParseCache:
+    """Parsed (barcode, name, brand, category) rows per source task, keyed by file sha256 and parser version.
+
+    Validation and scoring are not cached: name_reject_reason() and
+    compute_quality_score() run again over the cached rows, and source
+    rank comes from the task, so rule changes need no re-parse. Rows keep
+    file order, so a build from the cache matches one from the raw files.
+    """
+
+    def __init__(self, directory: Path, options: ParseOptions, hashes: Dict[str, str]) -> None:
+        directory.mkdir(parents=True, exist_ok=True)
+        self.directory = directory
+        self.options = options
+        self.hashes = hashes
+
+    def stem(self, task: SourceTask) -> str:
+        return task.file_key if task.entry is None else f"{task.file_key}.{Path(task.entry).stem}"
+
+    def path_for(self, task: SourceTask) -> Path:
+        identity = f"{PARSE_CACHE_VERSION}:{self.options.fingerprint()}:{self.hashes[task.file_key]}:{task.entry}"
+        key = hashlib.sha256(identity.encode("utf-8")).hexdigest()[:16]
+        return self.directory / f"{self.stem(task)}.{key}.parse.sqlite"
+
+    def has(self, task: SourceTask) -> bool:
+        return self.path_for(task).exists()
+
+    def candidates(
+        self,
+        task: SourceTask,
+        rejects: Counter,
+        parse: Callable[[Counter], Iterator[Candidate]],
+    ) -> Iterator[Candidate]:
+        path = self.path_for(task)
+        if path.exists():
+            return self._read(path, task, rejects)
+        return self._write(path, task, rejects, parse)
+
+    def _read(self, path: Path, task: SourceTask, rejects: Counter) -> Iterator[Candidate]:
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            (parser_rejects,) = connection.execute("SELECT value FROM cache_meta WHERE key = 'rejects'").fetchone()
+            rejects.update(json.loads(parser_rejects))
+            for barcode, name, brand, category in connection.execute(
+                "SELECT barcode, name, brand, category FROM candidates ORDER BY rowid"
+            ):
+                yield Candidate(
+                    barcode=barcode,
+                    name=name,
+                    brand=brand,
+                    category=category,
+                    source=task.source,
+                    source_rank=task.source_rank,
+                    quality_score=compute_quality_score(name, barcode),
+                )
+        finally:
+            connection.close()
+
+    def _write(
+        self,
+        path: Path,
+        task: SourceTask,
+        rejects: Counter,
+        parse: Callable[[Counter], Iterator[Candidate]],
+    ) -> Iterator[Candidate]:
+        parser_rejects: Counter = Counter()
+        # The entry only appears once the whole source was parsed; an interrupted parse leaves nothing behind.
+        with atomic_output(path) as tmp_path:
+            connection = sqlite3.connect(tmp_path)
+            try:
+                apply_bulk_load_pragmas(connection)
+                connection.execute("CREATE TABLE cache_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+                connection.execute(
+                    "CREATE TABLE candidates (barcode TEXT NOT NULL, name TEXT NOT NULL, brand TEXT, category TEXT)"
+                )
+                insert = "INSERT INTO candidates (barcode, name, brand, category) VALUES (?, ?, ?, ?)"
+                pending = []
+                for candidate in parse(parser_rejects):
+                    pending.append((candidate.barcode, candidate.name, candidate.brand, candidate.category))
+                    if len(pending) >= STAGING_BATCH_SIZE:
+                        connection.executemany(insert, pending)
+                        pending = []
+                    yield candidate
+                connection.executemany(insert, pending)
+                connection.executemany(
+                    "INSERT INTO cache_meta (key, value) VALUES (?, ?)",
+                    [
+                        ("parser_version", PARSE_CACHE_VERSION),
+                        ("source_file", task.label),
+                        ("rejects", json.dumps(dict(parser_rejects))),
+                    ],
+                )
+                connection.commit()
+            finally:
+                connection.close()
+        rejects.update(parser_rejects)
+
+        # A whole-archive entry replaces the per-entry ones a split (--jobs) run left for the same file, and
+        # a per-entry one replaces the whole-archive entry; sibling entries of the current split are kept.
+        if task.entry is None:
+            suffix = r"(\.[^/]+)?"
+        else:
+            suffix = r"(\." + re.escape(Path(task.entry).stem) + r")?"
+        stale = re.compile(re.escape(task.file_key) + suffix + r"\.[0-9a-f]{16}\.parse\.sqlite")
+        for old in self.directory.iterdir():
+            if old != path and stale.fullmatch(old.name):
+                old.unlink(missing_ok=True)
+
+
+class SourceStateStore:
+    """Per-source winners kept next to the index so unchanged sources are not re-parsed."""
+
+    def __init__(self, path: Path, options: ParseOptions = DEFAULT_PARSE_OPTIONS) -> None:
+        self.connection = sqlite3.connect(path)
+        cursor = self.connection.cursor()
+        cursor.execute("CREATE TABLE IF NOT EXISTS state_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS source_files (
+                source_key TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                source_order INTEGER NOT NULL,
+                total_seen INTEGER NOT NULL,
+                total_valid INTEGER NOT NULL
+            )
             """
-            CREATE TABLE IF NOT EXISTS products (
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS source_candidates (
+                source_key TEXT NOT NULL,
                 barcode TEXT NOT NULL,
                 name TEXT NOT NULL,
                 brand TEXT,
@@ -275,59 +2008,1755 @@ def build_index(raw_dir: Path, output_db: Path, include_off_food: bool) -> None:
                 source TEXT NOT NULL,
                 source_rank INTEGER NOT NULL,
                 quality_score INTEGER NOT NULL,
-                updated_at TEXT NOT NULL
+                PRIMARY KEY (source_key, barcode)
+            ) WITHOUT ROWID
+            """
+        )
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_source_candidates_barcode ON source_candidates(barcode)")
+        self.connection.commit()
+
+        # Candidates parsed under other rules or options cannot be reused. A new or reset store no longer
+        # knows which barcodes the existing index got from it, so the caller must rewrite the index in full.
+        # Like every later change, the reset stays uncommitted until the caller has written the index.
+        version = f"{STATE_VERSION}:{options.fingerprint()}"
+        row = cursor.execute("SELECT value FROM state_meta WHERE key = 'version'").fetchone()
+        self.reset = row is None or row[0] != version
+        if self.reset:
+            cursor.execute("DELETE FROM source_files")
+            cursor.execute("DELETE FROM source_candidates")
+            cursor.execute("INSERT OR REPLACE INTO state_meta (key, value) VALUES ('version', ?)", (version,))
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def commit(self) -> None:
+        self.connection.commit()
+
+    def source_hashes(self) -> Dict[str, str]:
+        return dict(self.connection.execute("SELECT source_key, sha256 FROM source_files"))
+
+    def candidates_by_file(self) -> Dict[str, int]:
+        return dict(self.connection.execute("SELECT source_key, total_seen FROM source_files"))
+
+    def totals(self) -> Tuple[int, int]:
+        row = self.connection.execute(
+            "SELECT COALESCE(SUM(total_seen), 0), COALESCE(SUM(total_valid), 0) FROM source_files"
+        ).fetchone()
+        return row[0], row[1]
+
+    def barcodes_for(self, source_key: str) -> Set[str]:
+        cursor = self.connection.execute("SELECT barcode FROM source_candidates WHERE source_key = ?", (source_key,))
+        return {barcode for (barcode,) in cursor}
+
+    def remove_source(self, source_key: str) -> None:
+        self.connection.execute("DELETE FROM source_candidates WHERE source_key = ?", (source_key,))
+        self.connection.execute("DELETE FROM source_files WHERE source_key = ?", (source_key,))
+
+    def replace_source(self, source_key: str, sha256: str, aggregator: Aggregator) -> None:
+        self.remove_source(source_key)
+        self.connection.execute(
+            "INSERT INTO source_files (source_key, sha256, source_order, total_seen, total_valid) VALUES (?, ?, 0, ?, ?)",
+            (source_key, sha256, aggregator.total_seen, aggregator.total_valid),
+        )
+        self.connection.executemany(
+            """
+            INSERT INTO source_candidates (
+                source_key, barcode, name, brand, category, source, source_rank, quality_score
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                (
+                    source_key,
+                    candidate.barcode,
+                    candidate.name,
+                    candidate.brand,
+                    candidate.category,
+                    candidate.source,
+                    candidate.source_rank,
+                    candidate.quality_score,
+                )
+                for candidate in aggregator.iter_winners()
+            ),
+        )
+
+    def set_source_order(self, source_keys: List[str]) -> None:
+        self.connection.executemany(
+            "UPDATE source_files SET source_order = ? WHERE source_key = ?",
+            ((order, key) for order, key in enumerate(source_keys)),
+        )
+
+    def iter_winners(self, barcodes: Optional[Set[str]] = None) -> Iterator[Candidate]:
+        """Resolve the best candidate per barcode with CandidateAggregator precedence.
+
+        Ties go to the source that comes first in build order, as in a serial build.
+        """
+        query = """
+            SELECT c.barcode, c.name, c.brand, c.category, c.source, c.source_rank, c.quality_score
+            FROM source_candidates AS c
+            JOIN source_files AS f ON f.source_key = c.source_key
+            {where}
+            ORDER BY c.barcode, c.source_rank DESC, c.quality_score DESC, length(c.name) DESC, f.source_order
+        """
+        if barcodes is None:
+            cursor = self.connection.execute(query.format(where=""))
+        else:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS affected (barcode TEXT PRIMARY KEY)")
+            self.connection.execute("DELETE FROM temp.affected")
+            self.connection.executemany(
+                "INSERT INTO temp.affected (barcode) VALUES (?)", ((barcode,) for barcode in barcodes)
+            )
+            cursor = self.connection.execute(
+                query.format(where="WHERE c.barcode IN (SELECT barcode FROM temp.affected)")
+            )
+
+        last_barcode = None
+        for row in cursor:
+            if row[0] == last_barcode:
+                continue
+            last_barcode = row[0]
+            yield Candidate(*row)
+
+
+@contextmanager
+def atomic_output(path: Path) -> Iterator[Path]:
+    """Yield a temporary sibling of `path` and move it into place only on success.
+
+    Readers such as the iOS LocalBarcodeDatabase never see a half-written file.
+    """
+    handle, tmp_name = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+    os.close(handle)
+    tmp_path = Path(tmp_name)
+    # mkstemp creates 0600 files; give the result the permissions a plain open() would.
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_path, 0o666 & ~umask)
+    try:
+        yield tmp_path
+        with tmp_path.open("rb") as written:
+            os.fsync(written.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def apply_bulk_load_pragmas(connection: sqlite3.Connection) -> None:
+    # Durability does not matter for a file that is renamed into place only after commit.
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.execute("PRAGMA locking_mode = EXCLUSIVE")
+    connection.execute(f"PRAGMA cache_size = -{BULK_LOAD_CACHE_KIB}")
+
+
+def search_fold(value: Optional[str]) -> Optional[str]:
+    if value is None:
+        return None
+    return value.lower().replace("ё", "е")
+
+
+def search_match(query: str, prefix_last: bool = True) -> Optional[str]:
+    """FTS5 MATCH expression for a user query: folded, quoted tokens, last one as a prefix for type-ahead."""
+    tokens = SEARCH_TOKEN_RE.findall(search_fold(query) or "")
+    if not tokens:
+        return None
+    terms = [f'"{token}"' for token in tokens]
+    if prefix_last:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+def create_search_index(connection: sqlite3.Connection, schema: str = "text") -> None:
+    """(Re)build products_search over name and brand; contentless tables cannot be patched row by row."""
+    key = "barcode" if schema == "integer" else "rowid"
+    connection.create_function("search_fold", 1, search_fold, deterministic=True)
+    connection.execute("DROP TABLE IF EXISTS products_search")
+    connection.execute(SEARCH_TABLE_SQL)
+    connection.execute(
+        f"""
+        INSERT INTO products_search (rowid, name, brand)
+        SELECT {key}, search_fold(name), search_fold(brand) FROM products
+        """
+    )
+    connection.execute("INSERT INTO products_search (products_search) VALUES ('optimize')")
+
+
+def has_search_index(connection: sqlite3.Connection) -> bool:
+    row = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'products_search'").fetchone()
+    return row is not None
+
+
+class ContentDigest:
+    """Digest of the products content columns that does not depend on row order.
+
+    It is the sum of sha256(row_digest_line(row)) over all rows, modulo 2**256, so it can be
+    computed while rows are inserted in winner order, adjusted when rows are replaced, and
+    checked by reading products in any order.
+    """
+
+    def __init__(self, hexdigest: str = "0" * 64, count: int = 0) -> None:
+        self.value = int(hexdigest, 16)
+        self.count = count
+
+    @staticmethod
+    def row_value(row: tuple) -> int:
+        return int.from_bytes(hashlib.sha256(row_digest_line(row)).digest(), "big")
+
+    def add(self, row: tuple) -> None:
+        self.value = (self.value + self.row_value(row)) & MASK256
+        self.count += 1
+
+    def remove(self, row: tuple) -> None:
+        self.value = (self.value - self.row_value(row)) & MASK256
+        self.count -= 1
+
+    def hexdigest(self) -> str:
+        return f"{self.value:064x}"
+
+
+def index_content_digest(connection: sqlite3.Connection, schema: str = "main") -> ContentDigest:
+    """Recompute ContentDigest from the stored rows, e.g. to verify index_meta."""
+    digest = ContentDigest()
+    columns = ", ".join(PRODUCT_CONTENT_COLUMNS)
+    for row in connection.execute(f"SELECT {columns} FROM {schema}.products"):
+        digest.add(row)
+    return digest
+
+
+def index_sources(
+    tasks: Iterable[SourceTask], hashes: Dict[str, Optional[str]], candidates: Dict[str, int]
+) -> Dict[str, dict]:
+    """index_meta.sources without product counts: sha256 per raw file and candidates per source."""
+    sources: Dict[str, dict] = {}
+    for task in tasks:
+        entry = sources.setdefault(task.source, {"files": {}, "candidates": candidates.get(task.source, 0)})
+        entry["files"][task.file_key] = hashes.get(task.file_key)
+    return sources
+
+
+def write_index_meta(
+    connection: sqlite3.Connection,
+    schema: str,
+    built_at: str,
+    digest: ContentDigest,
+    sources: Dict[str, dict],
+    products_by_source: Dict[str, int],
+) -> None:
+    sources = {name: dict(entry, products=products_by_source.get(name, 0)) for name, entry in sources.items()}
+    connection.execute(INDEX_META_SCHEMA_SQL)
+    connection.execute(
+        "INSERT OR REPLACE INTO index_meta VALUES (1, ?, ?, ?, ?, ?, ?)",
+        (
+            INDEX_SCHEMA_VERSION,
+            schema,
+            built_at,
+            digest.count,
+            digest.hexdigest(),
+            json.dumps(sources, ensure_ascii=False, sort_keys=True),
+        ),
+    )
+
+
+def read_index_meta(connection: sqlite3.Connection, schema: str = "main") -> Optional[dict]:
+    """The index_meta row as a dict, or None for indexes built before it existed."""
+    if connection.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE name = 'index_meta'").fetchone() is None:
+        return None
+    cursor = connection.execute(f"SELECT * FROM {schema}.index_meta WHERE id = 1")
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    meta = dict(zip((column[0] for column in cursor.description), row))
+    meta["sources"] = json.loads(meta["sources"])
+    return meta
+
+
+def copy_index_meta(connection: sqlite3.Connection, from_schema: str) -> None:
+    """Replace main.index_meta with the one in `from_schema`, or drop it if that index has none."""
+    connection.execute("DROP TABLE IF EXISTS main.index_meta")
+    if connection.execute(f"SELECT 1 FROM {from_schema}.sqlite_master WHERE name = 'index_meta'").fetchone():
+        connection.execute(INDEX_META_SCHEMA_SQL)
+        connection.execute(f"INSERT INTO main.index_meta SELECT * FROM {from_schema}.index_meta")
+
+
+def write_products(
+    output_db: Path,
+    candidates: Iterable[Candidate],
+    now: str,
+    schema: str = "text",
+    search_index: bool = False,
+    sources: Optional[Dict[str, dict]] = None,
+) -> None:
+    schema_sql, index_sql = (
+        (PRODUCTS_INTEGER_SCHEMA_SQL, PRODUCTS_INTEGER_INDEX_SQL)
+        if schema == "integer"
+        else (PRODUCTS_SCHEMA_SQL, PRODUCTS_INDEX_SQL)
+    )
+    digest = ContentDigest()
+    products_by_source: Counter = Counter()
+
+    def rows() -> Iterator[tuple]:
+        for candidate in candidates:
+            row = candidate_to_row(candidate, now, schema)
+            digest.add(row[:-1])
+            products_by_source[candidate.source] += 1
+            yield row
+
+    with atomic_output(output_db) as tmp_db:
+        connection = sqlite3.connect(tmp_db)
+        try:
+            apply_bulk_load_pragmas(connection)
+            cursor = connection.cursor()
+            cursor.execute(schema_sql)
+            cursor.executemany(PRODUCTS_INSERT_SQL, rows())
+            # Indexes are built once over the loaded table instead of maintained per insert.
+            for statement in index_sql:
+                cursor.execute(statement)
+            if search_index:
+                create_search_index(connection, schema)
+            write_index_meta(connection, schema, now, digest, sources or {}, products_by_source)
+            connection.commit()
+        finally:
+            connection.close()
+
+
+def truncate_utf16(value: str, limit: int) -> str:
+    """value.substring(0, limit) as JavaScript computes it: `limit` counts UTF-16 code units."""
+    if len(value) <= limit // 2:
+        return value
+    encoded = value.encode("utf-16-le")
+    if len(encoded) <= 2 * limit:
+        return value
+    # A surrogate pair cut in half is dropped; SQLite could not store the lone half as UTF-8 anyway.
+    return encoded[: 2 * limit].decode("utf-16-le", errors="ignore")
+
+
+class BackendExport:
+    """Winners in the layout of the backend's local barcode database, not its selection or field rules.
+
+    The table, INSERT OR IGNORE, "" for a missing brand or category and the UTF-16 length cuts match
+    build-local-db.ts. The rows are the iOS winners, though: every source (UHTT and catalog too, not only
+    Open Food Facts products sold in Russia or with a product_name_ru), normalised barcodes and names
+    (product_name, not product_name_ru), and the first brand and category instead of the full lists.
+    """
+
+    label = "backend db"
+
+    def __init__(self, path: Path, target: Path) -> None:
+        self.target = target
+        self.connection = sqlite3.connect(path)
+        apply_bulk_load_pragmas(self.connection)
+        self.connection.execute(BACKEND_PRODUCTS_SCHEMA_SQL)
+        self.batch: List[tuple] = []
+        self.rows = 0
+
+    def write(self, candidate: Candidate) -> None:
+        name_limit, brand_limit, category_limit = BACKEND_FIELD_LIMITS
+        self.batch.append(
+            (
+                candidate.barcode,
+                truncate_utf16(candidate.name, name_limit),
+                truncate_utf16(candidate.brand or "", brand_limit),
+                truncate_utf16(candidate.category or "", category_limit),
+            )
+        )
+        if len(self.batch) >= EXPORT_BATCH_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        # INSERT OR IGNORE like build-local-db.ts; winners are unique per barcode, so nothing is ignored.
+        self.connection.executemany("INSERT OR IGNORE INTO products VALUES (?, ?, ?, ?)", self.batch)
+        self.rows += len(self.batch)
+        self.batch = []
+
+    def finish(self) -> None:
+        self.flush()
+        self.connection.commit()
+        self.connection.execute("VACUUM")
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class NdjsonExport:
+    """One JSON object per winner with the products content columns; a .gz path is gzip-compressed."""
+
+    label = "ndjson"
+
+    def __init__(self, path: Path, target: Path) -> None:
+        self.target = target
+        # The temporary sibling has a .tmp suffix, so compression follows the final name.
+        # zlib's default level: level 9 (gzip.open's default) took three times as long for a 9% smaller file.
+        self.handle = (
+            gzip.open(path, "wt", compresslevel=6, encoding="utf-8")
+            if target.suffix == ".gz"
+            else path.open("w", encoding="utf-8")
+        )
+        self.lines: List[str] = []
+        self.rows = 0
+
+    def write(self, candidate: Candidate) -> None:
+        # No updated_at: rows of an incrementally updated index carry different times, and without it the
+        # export of the same inputs is byte-identical across builds. Barcodes stay text for every schema.
+        row = {
+            "barcode": candidate.barcode,
+            "name": candidate.name,
+            "brand": candidate.brand,
+            "category": candidate.category or DEFAULT_CATEGORY,
+            "source": candidate.source,
+            "source_rank": candidate.source_rank,
+            "quality_score": candidate.quality_score,
+        }
+        self.lines.append(NDJSON_ENCODER.encode(row))
+        if len(self.lines) >= EXPORT_BATCH_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        # One write per batch: GzipFile compresses every write() call separately.
+        if self.lines:
+            self.handle.write("\n".join(self.lines) + "\n")
+            self.rows += len(self.lines)
+            self.lines = []
+
+    def finish(self) -> None:
+        self.flush()
+        self.handle.flush()
+
+    def close(self) -> None:
+        self.handle.close()
+
+
+@contextmanager
+def export_targets(settings: BuildSettings) -> Iterator[List[Union[BackendExport, NdjsonExport]]]:
+    """Open the extra outputs of a build; each is moved into place only if the whole block succeeds."""
+    exports: List[Union[BackendExport, NdjsonExport]] = []
+    with ExitStack() as stack:
+        for target, create in ((settings.backend_output, BackendExport), (settings.ndjson_output, NdjsonExport)):
+            if target is None:
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            exports.append(create(stack.enter_context(atomic_output(target)), target))
+            # Closed before atomic_output moves (or removes) the file; callbacks run last-in, first-out.
+            stack.callback(exports[-1].close)
+        yield exports
+        for export in exports:
+            export.finish()
+    for export in exports:
+        print(f"[ok] exported {export.label}: {export.target} | rows={export.rows}", file=sys.stderr)
+
+
+def tee_to_exports(
+    candidates: Iterable[Candidate], exports: List[Union[BackendExport, NdjsonExport]]
+) -> Iterator[Candidate]:
+    """Pass winners through to the iOS writer while each export receives the same stream."""
+    if not exports:
+        yield from candidates
+        return
+    for candidate in candidates:
+        for export in exports:
+            export.write(candidate)
+        yield candidate
+
+
+def write_exports(settings: BuildSettings, winners: Iterable[Candidate]) -> None:
+    """Write only the extra outputs, e.g. from the incremental state store."""
+    if settings.backend_output is None and settings.ndjson_output is None:
+        return
+    with export_targets(settings) as exports:
+        for candidate in winners:
+            for export in exports:
+                export.write(candidate)
+
+
+def update_products(
+    output_db: Path,
+    barcodes: Set[str],
+    candidates: Iterable[Candidate],
+    now: str,
+    schema: str = "text",
+    search_index: bool = False,
+    sources: Optional[Dict[str, dict]] = None,
+) -> None:
+    connection = sqlite3.connect(output_db)
+    try:
+        cursor = connection.cursor()
+        meta = read_index_meta(connection)
+        digest = ContentDigest(meta["content_digest"], meta["product_count"]) if meta is not None else None
+        if digest is not None:
+            # Take the replaced rows out of the digest instead of rehashing the whole table afterwards.
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS replaced (barcode TEXT PRIMARY KEY)")
+            cursor.execute("DELETE FROM temp.replaced")
+            cursor.executemany("INSERT INTO temp.replaced (barcode) VALUES (?)", ((barcode,) for barcode in barcodes))
+            columns = ", ".join(PRODUCT_CONTENT_COLUMNS)
+            for row in cursor.execute(
+                f"SELECT {columns} FROM products WHERE barcode IN (SELECT barcode FROM temp.replaced)"
+            ).fetchall():
+                digest.remove(row)
+
+        cursor.executemany("DELETE FROM products WHERE barcode = ?", ((barcode,) for barcode in barcodes))
+
+        def rows() -> Iterator[tuple]:
+            for candidate in candidates:
+                row = candidate_to_row(candidate, now, schema)
+                if digest is not None:
+                    digest.add(row[:-1])
+                yield row
+
+        cursor.executemany(PRODUCTS_INSERT_SQL, rows())
+        if search_index or has_search_index(connection):
+            create_search_index(connection, schema)
+        if digest is None:
+            digest = index_content_digest(connection)
+        products_by_source = dict(connection.execute("SELECT source, COUNT(*) FROM products GROUP BY source"))
+        write_index_meta(connection, schema, now, digest, sources or {}, products_by_source)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def products_schema(output_db: Path) -> Optional[str]:
+    """Return which products layout an existing index uses, or None if it has none."""
+    if not output_db.exists():
+        return None
+    connection = sqlite3.connect(output_db)
+    try:
+        columns = {row[1]: row[2].upper() for row in connection.execute("PRAGMA table_info(products)")}
+    finally:
+        connection.close()
+    if "barcode" not in columns:
+        return None
+    return "integer" if columns["barcode"] == "INTEGER" else "text"
+
+
+def default_state_path(output_db: Path) -> Path:
+    return output_db.with_name(output_db.stem + ".sources.sqlite")
+
+
+def default_checkpoint_path(output_db: Path) -> Path:
+    return output_db.with_name(output_db.stem + ".checkpoint.sqlite")
+
+
+@dataclass
+class CheckpointState:
+    completed_tasks: int = 0
+    stats: Dict[str, SourceStats] = field(default_factory=dict)
+    # Where tasks[completed_tasks] stood when the checkpoint was taken inside it.
+    chunks_done: int = 0
+    source_before: Tuple[int, int, Counter] = field(default_factory=lambda: (0, 0, Counter()))
+    source_seconds: float = 0.0
+
+
+def checkpoint_fingerprint(tasks: List[SourceTask], settings: BuildSettings) -> str:
+    # Size and mtime are enough to notice a re-downloaded dump without hashing gigabytes up front.
+    files = []
+    for task in tasks:
+        stat = task.path.stat()
+        files.append([task.file_key, task.entry, stat.st_size, stat.st_mtime_ns])
+    return json.dumps(
+        {
+            "version": CHECKPOINT_VERSION,
+            "options": settings.parse_options.fingerprint(),
+            "chunk_lines": CHECKPOINT_CHUNK_LINES,
+            "tasks": files,
+        },
+        sort_keys=True,
+    )
+
+
+def stats_to_json(stats: SourceStats) -> dict:
+    return {item.name: getattr(stats, item.name) for item in fields(SourceStats)}
+
+
+def stats_from_json(data: dict) -> SourceStats:
+    return SourceStats(**{**data, "rejects": Counter(data["rejects"])})
+
+
+class BuildCheckpoint:
+    """Aggregation state saved between sources (and every `interval` seconds inside dumps) for --resume.
+
+    Winners are stored in aggregator insertion order and restored through
+    offer_winner(), so a resumed build writes the same index as an
+    uninterrupted one.
+    """
+
+    def __init__(self, path: Path, fingerprint: str, interval: float = DEFAULT_CHECKPOINT_INTERVAL) -> None:
+        self.path = path
+        self.fingerprint = fingerprint
+        self.interval = interval
+        self.saved_at = time.monotonic()
+
+    def due(self) -> bool:
+        return self.interval > 0 and time.monotonic() - self.saved_at >= self.interval
+
+    def save(self, aggregator: Aggregator, state: CheckpointState) -> None:
+        seen, valid, rejects = state.source_before
+        meta = {
+            "fingerprint": self.fingerprint,
+            "completed_tasks": state.completed_tasks,
+            "chunks_done": state.chunks_done,
+            "source_before": [seen, valid, dict(rejects)],
+            "source_seconds": state.source_seconds,
+            "total_seen": aggregator.total_seen,
+            "total_valid": aggregator.total_valid,
+            "rejects": dict(aggregator.rejects),
+            "stats": [stats_to_json(source) for source in state.stats.values()],
+        }
+        with atomic_output(self.path) as tmp_path:
+            connection = sqlite3.connect(tmp_path)
+            try:
+                apply_bulk_load_pragmas(connection)
+                connection.execute("CREATE TABLE checkpoint_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+                connection.execute(
+                    """
+                    CREATE TABLE winners (
+                        seq INTEGER PRIMARY KEY,
+                        barcode TEXT NOT NULL,
+                        name TEXT NOT NULL,
+                        brand TEXT,
+                        category TEXT,
+                        source TEXT NOT NULL,
+                        source_rank INTEGER NOT NULL,
+                        quality_score INTEGER NOT NULL
+                    )
+                    """
+                )
+                connection.executemany(
+                    "INSERT INTO checkpoint_meta (key, value) VALUES (?, ?)",
+                    ((key, json.dumps(value)) for key, value in meta.items()),
+                )
+                connection.executemany(
+                    """
+                    INSERT INTO winners (barcode, name, brand, category, source, source_rank, quality_score)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        (
+                            candidate.barcode,
+                            candidate.name,
+                            candidate.brand,
+                            candidate.category,
+                            candidate.source,
+                            candidate.source_rank,
+                            candidate.quality_score,
+                        )
+                        for candidate in aggregator.iter_winners()
+                    ),
+                )
+                connection.commit()
+            finally:
+                connection.close()
+        self.saved_at = time.monotonic()
+        where = f" + {state.chunks_done} blocks" if state.chunks_done else ""
+        print(
+            f"[checkpoint] {state.completed_tasks} sources{where} | unique={len(aggregator)} -> {self.path}",
+            file=sys.stderr,
+        )
+
+    def load(self, aggregator: Aggregator) -> Optional[CheckpointState]:
+        """Restore a saved state into the empty `aggregator`; None when there is no checkpoint."""
+        if not self.path.exists():
+            return None
+        connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            rows = connection.execute("SELECT key, value FROM checkpoint_meta")
+            meta = {key: json.loads(value) for key, value in rows}
+            if meta.get("fingerprint") != self.fingerprint:
+                raise ValueError(
+                    f"checkpoint {self.path} was taken for other source files or options; rerun without --resume"
+                )
+            cursor = connection.execute(
+                "SELECT barcode, name, brand, category, source, source_rank, quality_score FROM winners ORDER BY seq"
+            )
+            for row in cursor:
+                aggregator.offer_winner(Candidate(*row))
+        finally:
+            connection.close()
+
+        aggregator.total_seen = meta["total_seen"]
+        aggregator.total_valid = meta["total_valid"]
+        aggregator.rejects.update(meta["rejects"])
+        seen, valid, rejects = meta["source_before"]
+        state = CheckpointState(
+            completed_tasks=meta["completed_tasks"],
+            stats={data["source"]: stats_from_json(data) for data in meta["stats"]},
+            chunks_done=meta["chunks_done"],
+            source_before=(seen, valid, Counter(rejects)),
+            source_seconds=meta["source_seconds"],
+        )
+        where = f" + {state.chunks_done} blocks" if state.chunks_done else ""
+        print(
+            f"[checkpoint] resuming after {state.completed_tasks} sources{where} | unique={len(aggregator)}",
+            file=sys.stderr,
+        )
+        return state
+
+    def discard(self) -> None:
+        self.path.unlink(missing_ok=True)
+
+
+def build_index(
+    raw_dir: Path,
+    output_db: Path,
+    include_off_food: bool,
+    settings: BuildSettings = BuildSettings(),
+    incremental: bool = False,
+    state_db: Optional[Path] = None,
+) -> None:
+    output_db.parent.mkdir(parents=True, exist_ok=True)
+    if settings.staging_dir is None:
+        settings = replace(settings, staging_dir=output_db.parent)
+
+    tasks = collect_source_tasks(
+        raw_dir, include_off_food, split_archives=settings.jobs > 1, catalog_format=settings.catalog_format
+    )
+    parse_cache = None
+    if settings.parse_cache_dir is not None:
+        parse_cache = ParseCache(settings.parse_cache_dir, settings.parse_options, source_hashes(raw_dir, tasks))
+
+    if incremental:
+        build_index_incremental(
+            raw_dir, output_db, tasks, settings, state_db or default_state_path(output_db), parse_cache
+        )
+        return
+
+    started = time.perf_counter()
+    aggregator = create_aggregator(settings.aggregator_backend, settings.staging_dir)
+    try:
+        checkpoint = None
+        state = CheckpointState()
+        if settings.checkpoint or settings.resume:
+            checkpoint = BuildCheckpoint(
+                default_checkpoint_path(output_db),
+                checkpoint_fingerprint(tasks, settings),
+                settings.checkpoint_interval,
+            )
+            restored = checkpoint.load(aggregator) if settings.resume else None
+            if restored is not None:
+                state = restored
+            elif settings.resume:
+                print(f"[checkpoint] none at {checkpoint.path}; starting from the first source", file=sys.stderr)
+        stats = state.stats
+
+        progress = None
+        if settings.progress:
+            progress = BuildProgress(sum(task_compressed_bytes(task) for task in tasks), lambda: aggregator.total_seen)
+            for task in tasks[: state.completed_tasks]:
+                progress.done_bytes += task_compressed_bytes(task)
+
+        if settings.jobs > 1:
+            if state.chunks_done:
+                raise ValueError("this checkpoint stopped inside a source; resume it with --jobs 1")
+            remaining = tasks[state.completed_tasks :]
+            for index, (_, source_aggregator, source) in enumerate(
+                iter_task_aggregates(remaining, settings, progress, parse_cache), state.completed_tasks + 1
+            ):
+                aggregator.merge(source_aggregator)
+                source_aggregator.close()
+                add_source_stats(stats, source)
+                if checkpoint is not None:
+                    checkpoint.save(aggregator, CheckpointState(index, stats))
+        else:
+            for index, task in enumerate(tasks):
+                if index < state.completed_tasks:
+                    continue
+                source = aggregate_task_into(aggregator, task, settings, progress, checkpoint, state, parse_cache)
+                add_source_stats(stats, source)
+                state = CheckpointState(index + 1, stats)
+                if checkpoint is not None:
+                    checkpoint.save(aggregator, state)
+
+        parsed = time.perf_counter()
+        with export_targets(settings) as exports:
+            winners = tee_to_exports(aggregator.iter_winners(), exports)
+            # Hashes come from raw/manifest.json only, so every build mode writes the same metadata.
+            candidates = {name: source.candidates for name, source in stats.items()}
+            write_products(
+                output_db,
+                winners,
+                build_timestamp(),
+                settings.schema,
+                settings.search_index,
+                index_sources(tasks, load_manifest_hashes(raw_dir), candidates),
+            )
+        written = time.perf_counter()
+        if checkpoint is not None:
+            checkpoint.discard()
+
+        totals = {"seen": aggregator.total_seen, "valid": aggregator.total_valid, "unique": len(aggregator)}
+        report_filtered_rows(stats)
+        print(
+            (
+                "[ok] built index: "
+                f"{output_db} | seen={totals['seen']} valid={totals['valid']} unique={totals['unique']}"
+            ),
+            file=sys.stderr,
+        )
+        if settings.parse_options.sample < 1.0:
+            report_sample(output_db, settings.parse_options.sample, totals)
+        if isinstance(aggregator, CompactCandidateAggregator):
+            report_compact_memory(aggregator)
+        if settings.stats_json is not None:
+            write_build_stats(
+                settings.stats_json,
+                output_db,
+                settings,
+                stats,
+                {"parse": parsed - started, "write": written - parsed, "total": time.perf_counter() - started},
+                totals,
+            )
+    finally:
+        aggregator.close()
+
+
+def aggregate_task_into(
+    aggregator: Aggregator,
+    task: SourceTask,
+    settings: BuildSettings,
+    progress: Optional[BuildProgress] = None,
+    checkpoint: Optional[BuildCheckpoint] = None,
+    state: Optional[CheckpointState] = None,
+    parse_cache: Optional["ParseCache"] = None,
+) -> SourceStats:
+    print(f"[{task.source}] parsing {task.label}", file=sys.stderr)
+    if state is None:
+        state = CheckpointState()
+    if state.chunks_done:
+        # Resuming inside this source: count it from where it really started.
+        before = state.source_before
+        started = time.perf_counter() - state.source_seconds
+    else:
+        before = aggregator_counts(aggregator)
+        started = time.perf_counter()
+    profile = nullcontext()
+    if settings.profile_source == task.source and settings.profile_output is not None:
+        profile = profiled(settings.profile_mode, settings.profile_output)
+
+    source_file = progress.open(task) if progress is not None else None
+    try:
+        with profile:
+            cached = parse_cache is not None and parse_cache.has(task)
+            if checkpoint is not None and task.kind == "openfacts" and not cached:
+                path = task.path if source_file is None else source_file
+                for chunks_done in aggregate_openfacts_blocks(aggregator, path, task, settings.parse_options, state):
+                    if checkpoint.due():
+                        checkpoint.save(
+                            aggregator,
+                            replace(
+                                state,
+                                chunks_done=chunks_done,
+                                source_before=before,
+                                source_seconds=time.perf_counter() - started,
+                            ),
+                        )
+            else:
+                candidates = iter_source_candidates(
+                    task,
+                    settings.parse_options,
+                    settings.pipeline,
+                    aggregator.rejects,
+                    source_file,
+                    parse_cache,
+                    settings.staging_dir,
+                )
+                for candidate in candidates:
+                    aggregator.offer(candidate)
+    finally:
+        if source_file is not None:
+            source_file.close()
+
+    if progress is not None:
+        progress.finish(task)
+    return source_stats(task, aggregator, started, before)
+
+
+def aggregate_openfacts_blocks(
+    aggregator: Aggregator,
+    path: SourceFile,
+    task: SourceTask,
+    options: ParseOptions,
+    state: CheckpointState,
+) -> Iterator[int]:
+    """Offer one dump's candidates block by block, yielding the blocks done so far after each one.
+
+    Blocks already in a resumed checkpoint are only decompressed and split,
+    not parsed. Block-wise parsing offers candidates in file order, so the
+    winners match a plain streaming parse.
+    """
+    with gzip.open(path, "rt", encoding="utf-8", errors="ignore", newline="") as text_file:
+        header = read_tsv_header(text_file)
+        if header is None:
+            return
+        columns = resolve_columns(header, OPENFACTS_COLUMNS)
+        for index, chunk in enumerate(iter_record_chunks(text_file, CHECKPOINT_CHUNK_LINES), 1):
+            if index <= state.chunks_done:
+                continue
+            reader = csv.reader(io.StringIO(chunk, newline=""), delimiter="\t")
+            for candidate in parse_openfacts_rows(
+                reader, columns, task.source, task.source_rank, options, aggregator.rejects
+            ):
+                aggregator.offer(candidate)
+            yield index
+
+
+def add_source_stats(stats: Dict[str, SourceStats], source: SourceStats) -> None:
+    if source.source in stats:
+        stats[source.source].add(source)
+    else:
+        stats[source.source] = source
+
+
+def report_filtered_rows(stats: Dict[str, SourceStats]) -> None:
+    for source in stats.values():
+        dropped = {reason: source.rejects[reason] for reason in OPENFACTS_FILTER_REASONS if source.rejects[reason]}
+        if dropped:
+            counts = " ".join(f"{reason.removeprefix('filtered_')}={count}" for reason, count in dropped.items())
+            print(f"[filter] {source.source}: dropped {counts} of {source.rows} rows", file=sys.stderr)
+
+
+def sample_estimate(sample: float, totals: Dict[str, int]) -> Dict[str, int]:
+    """Scale a sampled build's seen/valid/unique counts up to the full build they stand for."""
+    return {key: round(totals[key] / sample) for key in ("seen", "valid", "unique") if key in totals}
+
+
+def report_sample(output_db: Path, sample: float, totals: Dict[str, int]) -> None:
+    estimate = " ".join(f"{key}={value}" for key, value in sample_estimate(sample, totals).items())
+    size_mib = output_db.stat().st_size / sample / (1 << 20)
+    print(
+        f"[sample] kept {sample:.2%} of barcodes; full build estimate: {estimate} size={size_mib:.1f} MiB",
+        file=sys.stderr,
+    )
+
+
+def count_winners_by_source(output_db: Path) -> Dict[str, int]:
+    connection = sqlite3.connect(output_db)
+    try:
+        return dict(connection.execute("SELECT source, COUNT(*) FROM products GROUP BY source ORDER BY source"))
+    finally:
+        connection.close()
+
+
+def write_build_stats(
+    path: Path,
+    output_db: Path,
+    settings: BuildSettings,
+    stats: Dict[str, SourceStats],
+    seconds: Dict[str, float],
+    totals: Dict[str, int],
+    mode: str = "full",
+) -> None:
+    for source, winners in count_winners_by_source(output_db).items():
+        stats.setdefault(source, SourceStats(source)).winners = winners
+
+    document = {
+        "output": str(output_db),
+        "mode": mode,
+        "settings": {
+            "jobs": settings.jobs,
+            "aggregator": settings.aggregator_backend,
+            "schema": settings.schema,
+            "pipeline": settings.pipeline,
+            "openfacts_chunk_lines": settings.openfacts_chunk_lines,
+            "parse_options": asdict(settings.parse_options),
+        },
+        "seconds": {phase: round(value, 3) for phase, value in seconds.items()},
+        "totals": {"rows": sum(source.rows for source in stats.values()), **totals},
+        "peak_rss_mib": round(peak_rss_bytes() / (1 << 20), 1),
+        "sources": [source.to_json() for source in stats.values()],
+    }
+    if settings.parse_options.sample < 1.0:
+        document["estimate"] = sample_estimate(settings.parse_options.sample, totals)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(document, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+    print(f"[stats] build stats written to {path}", file=sys.stderr)
+
+
+def report_compact_memory(aggregator: CompactCandidateAggregator) -> None:
+    compact_bytes = aggregator.approx_memory_bytes()
+    # A dict of the same size holding Candidate objects is what the default backend keeps.
+    dict_bytes = sys.getsizeof(aggregator.slot_by_key) + estimate_candidate_bytes(
+        aggregator.iter_winners(), len(aggregator)
+    )
+    ratio = dict_bytes / compact_bytes if compact_bytes else 0.0
+    print(
+        (
+            f"[mem] compact aggregator ~{format_mib(compact_bytes)} vs ~{format_mib(dict_bytes)} "
+            f"for the dict backend | saved ~{format_mib(dict_bytes - compact_bytes)} ({ratio:.1f}x)"
+        ),
+        file=sys.stderr,
+    )
+
+
+def build_index_incremental(
+    raw_dir: Path,
+    output_db: Path,
+    tasks: List[SourceTask],
+    settings: BuildSettings,
+    state_db: Path,
+    parse_cache: Optional[ParseCache] = None,
+) -> None:
+    hashes = parse_cache.hashes if parse_cache is not None else source_hashes(raw_dir, tasks)
+    source_keys = list(hashes)
+
+    started = time.perf_counter()
+    stats: Dict[str, SourceStats] = {}
+    store = SourceStateStore(state_db, settings.parse_options)
+    try:
+        known = store.source_hashes()
+        changed = [key for key in source_keys if known.get(key) != hashes[key]]
+        removed = [key for key in known if key not in hashes]
+        full_rewrite = store.reset or products_schema(output_db) != settings.schema
+        if store.reset and output_db.exists():
+            print(f"[state] no reusable state for these options, rewriting {output_db}", file=sys.stderr)
+
+        if not changed and not removed and not full_rewrite:
+            print(f"[ok] index is up to date: {output_db}", file=sys.stderr)
+            write_exports(settings, store.iter_winners())
+            if settings.stats_json is not None:
+                total_seen, total_valid = store.totals()
+                seconds = {"total": time.perf_counter() - started}
+                totals = {"seen": total_seen, "valid": total_valid, "reparsed": 0}
+                write_build_stats(settings.stats_json, output_db, settings, stats, seconds, totals, "incremental")
+            return
+
+        for key in source_keys:
+            if key not in changed:
+                print(f"[state] {key} unchanged, reusing parsed candidates", file=sys.stderr)
+
+        affected: Set[str] = set()
+        for key in removed:
+            print(f"[state] dropping removed source {key}", file=sys.stderr)
+            affected |= store.barcodes_for(key)
+            store.remove_source(key)
+
+        changed_tasks = [task for task in tasks if task.file_key in changed]
+        progress = None
+        if settings.progress:
+            progress = BuildProgress(sum(task_compressed_bytes(task) for task in changed_tasks))
+        per_file: Dict[str, Aggregator] = {}
+        for task, source_aggregator, source in iter_task_aggregates(changed_tasks, settings, progress, parse_cache):
+            add_source_stats(stats, source)
+            if task.file_key in per_file:
+                per_file[task.file_key].merge(source_aggregator)
+                source_aggregator.close()
+            else:
+                per_file[task.file_key] = source_aggregator
+
+        for key in changed:
+            aggregator = per_file.pop(key, None)
+            if aggregator is None:
+                aggregator = create_aggregator(settings.aggregator_backend, settings.staging_dir)
+            affected |= store.barcodes_for(key)
+            affected.update(candidate.barcode for candidate in aggregator.iter_winners())
+            store.replace_source(key, hashes[key], aggregator)
+            aggregator.close()
+
+        store.set_source_order(source_keys)
+        parsed = time.perf_counter()
+
+        now = build_timestamp()
+        seen_by_file = store.candidates_by_file()
+        candidates: Counter = Counter()
+        for file_key, source in {task.file_key: task.source for task in tasks}.items():
+            candidates[source] += seen_by_file.get(file_key, 0)
+        sources = index_sources(tasks, load_manifest_hashes(raw_dir), candidates)
+        if full_rewrite:
+            write_products(output_db, store.iter_winners(), now, settings.schema, settings.search_index, sources)
+        else:
+            update_products(
+                output_db, affected, store.iter_winners(affected), now, settings.schema, settings.search_index, sources
+            )
+        # Only now may the new hashes be recorded: a write that fails leaves them unchanged, so the next
+        # run reparses these sources instead of reporting a stale index as up to date.
+        store.commit()
+        # The exports are not patched in place: they are rewritten from the state store, without parsing.
+        write_exports(settings, store.iter_winners())
+
+        total_seen, total_valid = store.totals()
+    finally:
+        store.close()
+
+    report_filtered_rows(stats)
+    if settings.stats_json is not None:
+        finished = time.perf_counter()
+        seconds = {"parse": parsed - started, "write": finished - parsed, "total": finished - started}
+        totals = {"seen": total_seen, "valid": total_valid, "reparsed": len(changed)}
+        write_build_stats(settings.stats_json, output_db, settings, stats, seconds, totals, "incremental")
+
+    print(
+        (
+            "[ok] built index incrementally: "
+            f"{output_db} | reparsed={len(changed)} removed={len(removed)} "
+            f"affected={'all' if full_rewrite else len(affected)} seen={total_seen} valid={total_valid}"
+        ),
+        file=sys.stderr,
+    )
+    if settings.parse_options.sample < 1.0:
+        report_sample(output_db, settings.parse_options.sample, {"seen": total_seen, "valid": total_valid})
+
+
+def iter_product_rows(connection: sqlite3.Connection, schema: str = "main") -> Iterator[tuple]:
+    columns = ", ".join(PRODUCT_CONTENT_COLUMNS)
+    return connection.execute(f"SELECT {columns} FROM {schema}.products ORDER BY barcode")
+
+
+def row_digest_line(row: tuple) -> bytes:
+    # Tab-separated, \N for NULL: easy to reproduce on the client before and after patching.
+    return ("\t".join("\\N" if value is None else str(value) for value in row) + "\n").encode("utf-8")
+
+
+def products_digest(connection: sqlite3.Connection, schema: str = "main") -> str:
+    digest = hashlib.sha256()
+    for row in iter_product_rows(connection, schema):
+        digest.update(row_digest_line(row))
+    return digest.hexdigest()
+
+
+def first_product_difference(left_db: Path, right_db: Path) -> Optional[str]:
+    """Compare two indexes row by row on the content columns; describe the first mismatch."""
+    left = sqlite3.connect(left_db)
+    right = sqlite3.connect(right_db)
+    try:
+        left_rows = iter_product_rows(left)
+        right_rows = iter_product_rows(right)
+        for index, (left_row, right_row) in enumerate(itertools.zip_longest(left_rows, right_rows)):
+            if left_row != right_row:
+                return f"row {index}: {left_row!r} != {right_row!r}"
+        return None
+    finally:
+        left.close()
+        right.close()
+
+
+def write_delta(previous_db: Path, current_db: Path, delta_db: Path) -> Dict[str, int]:
+    """Write the inserted, updated and deleted barcodes that turn `previous_db` into `current_db`."""
+    schema = products_schema(current_db)
+    if products_schema(previous_db) != schema:
+        raise ValueError(f"{previous_db} uses a different products layout; ship the full index instead")
+
+    key_type = "INTEGER" if schema == "integer" else "TEXT"
+    changed = " OR ".join(f"n.{column} IS NOT o.{column}" for column in PRODUCT_CONTENT_COLUMNS[1:])
+    select_new = ", ".join(f"n.{column}" for column in PRODUCT_COLUMNS)
+    columns = ", ".join(PRODUCT_COLUMNS)
+    with atomic_output(delta_db) as tmp_db:
+        connection = sqlite3.connect(tmp_db)
+        try:
+            apply_bulk_load_pragmas(connection)
+            connection.execute("ATTACH DATABASE ? AS old", (str(previous_db),))
+            connection.execute("ATTACH DATABASE ? AS new", (str(current_db),))
+            cursor = connection.cursor()
+            cursor.execute("CREATE TABLE delta_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID")
+            for table in DELTA_TABLES:
+                cursor.execute(
+                    f"""
+                    CREATE TABLE {table} (
+                        barcode {key_type} PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        brand TEXT,
+                        category TEXT,
+                        source TEXT NOT NULL,
+                        source_rank INTEGER NOT NULL,
+                        quality_score INTEGER NOT NULL,
+                        updated_at TEXT NOT NULL
+                    ) WITHOUT ROWID
+                    """
+                )
+            cursor.execute(f"CREATE TABLE deleted (barcode {key_type} PRIMARY KEY) WITHOUT ROWID")
+
+            cursor.execute(
+                f"""
+                INSERT INTO inserted ({columns})
+                SELECT {select_new} FROM new.products AS n
+                WHERE NOT EXISTS (SELECT 1 FROM old.products AS o WHERE o.barcode = n.barcode)
+                ORDER BY n.barcode
+                """
+            )
+            cursor.execute(
+                f"""
+                INSERT INTO updated ({columns})
+                SELECT {select_new} FROM new.products AS n
+                JOIN old.products AS o ON o.barcode = n.barcode
+                WHERE {changed}
+                ORDER BY n.barcode
+                """
+            )
+            cursor.execute(
+                """
+                INSERT INTO deleted (barcode)
+                SELECT o.barcode FROM old.products AS o
+                WHERE NOT EXISTS (SELECT 1 FROM new.products AS n WHERE n.barcode = o.barcode)
+                ORDER BY o.barcode
+                """
             )
-            """
-        )
-        cursor.execute("DELETE FROM products")
 
-        rows = [
-            (
-                barcode,
-                candidate.name,
-                candidate.brand,
-                candidate.category or "Продукты",
-                candidate.source,
-                candidate.source_rank,
-                candidate.quality_score,
-                now,
+            counts = {
+                table: cursor.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                for table in (*DELTA_TABLES, "deleted")
+            }
+            meta = {
+                "format": DELTA_FORMAT_VERSION,
+                "schema": schema,
+                "base_digest": products_digest(connection, "old"),
+                "base_rows": str(cursor.execute("SELECT COUNT(*) FROM old.products").fetchone()[0]),
+                "target_digest": products_digest(connection, "new"),
+                "target_rows": str(cursor.execute("SELECT COUNT(*) FROM new.products").fetchone()[0]),
+                **{table: str(count) for table, count in counts.items()},
+            }
+            cursor.executemany("INSERT INTO delta_meta (key, value) VALUES (?, ?)", meta.items())
+            # Carried whole so the patched index describes the build it now matches.
+            copy_index_meta(connection, "new")
+            connection.commit()
+            connection.execute("DETACH DATABASE old")
+            connection.execute("DETACH DATABASE new")
+            connection.execute("VACUUM")
+        finally:
+            connection.close()
+    return counts
+
+
+def read_delta_meta(delta_db: Path) -> Dict[str, str]:
+    connection = sqlite3.connect(delta_db)
+    try:
+        return dict(connection.execute("SELECT key, value FROM delta_meta"))
+    finally:
+        connection.close()
+
+
+def apply_delta(base_db: Path, delta_db: Path, output_db: Path) -> Dict[str, str]:
+    """Patch a copy of `base_db` with `delta_db` into `output_db`, checking both content digests."""
+    meta = read_delta_meta(delta_db)
+    if meta.get("format") != DELTA_FORMAT_VERSION:
+        raise ValueError(f"unsupported delta format: {meta.get('format')}")
+    if products_schema(base_db) != meta["schema"]:
+        raise ValueError(f"{base_db} does not use the {meta['schema']} products layout this delta expects")
+
+    columns = ", ".join(PRODUCT_COLUMNS)
+    with atomic_output(output_db) as tmp_db:
+        shutil.copyfile(base_db, tmp_db)
+        connection = sqlite3.connect(tmp_db)
+        try:
+            if is_shipped_index(connection):
+                raise ValueError(f"{base_db} was optimized for ship; patch the unoptimized build and ship that")
+            if products_digest(connection) != meta["base_digest"]:
+                raise ValueError(f"{base_db} is not the index this delta was built against")
+            connection.execute("ATTACH DATABASE ? AS delta", (str(delta_db),))
+            cursor = connection.cursor()
+            cursor.execute(
+                """
+                DELETE FROM products WHERE barcode IN (
+                    SELECT barcode FROM delta.deleted UNION ALL SELECT barcode FROM delta.updated
+                )
+                """
             )
-            for barcode, candidate in aggregator.best_by_barcode.items()
-        ]
+            for table in DELTA_TABLES:
+                cursor.execute(f"INSERT INTO products ({columns}) SELECT {columns} FROM delta.{table}")
+            if has_search_index(connection):
+                create_search_index(connection, meta["schema"])
+            copy_index_meta(connection, "delta")
+            connection.commit()
+            connection.execute("DETACH DATABASE delta")
+            if products_digest(connection) != meta["target_digest"]:
+                raise RuntimeError(f"patched index does not match the target digest in {delta_db}")
+            connection.execute("VACUUM")
+        finally:
+            connection.close()
+    return meta
 
-        cursor.executemany(
-            """
-            INSERT INTO products (
-                barcode,
-                name,
-                brand,
-                category,
-                source,
-                source_rank,
-                quality_score,
-                updated_at
+
+def build_delta(previous_db: Path, current_db: Path, delta_db: Path) -> None:
+    counts = write_delta(previous_db, current_db, delta_db)
+
+    # Check the delta the way a client would use it: patch the old index and compare every row.
+    with tempfile.TemporaryDirectory(dir=delta_db.parent) as tmp_dir:
+        patched_db = Path(tmp_dir) / "patched.sqlite"
+        apply_delta(previous_db, delta_db, patched_db)
+        difference = first_product_difference(patched_db, current_db)
+    if difference is not None:
+        delta_db.unlink()
+        raise RuntimeError(f"patched index differs from {current_db}: {difference}")
+
+    delta_size = delta_db.stat().st_size
+    full_size = current_db.stat().st_size
+    print(
+        (
+            f"[ok] delta written: {delta_db} | inserted={counts['inserted']} updated={counts['updated']} "
+            f"deleted={counts['deleted']} | {format_mib(delta_size)} vs {format_mib(full_size)} full "
+            f"({100.0 * delta_size / full_size:.1f}%), verified row by row"
+        ),
+        file=sys.stderr,
+    )
+
+
+def parse_prefix_ranges(spec: str) -> List[Tuple[str, str]]:
+    """Parse '460-469,4810-4819,20' into inclusive (low, high) digit-prefix pairs of equal length."""
+    ranges: List[Tuple[str, str]] = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        low, _, high = part.partition("-")
+        high = high or low
+        if not (low.isdigit() and high.isdigit()) or len(low) != len(high) or low > high:
+            raise ValueError(f"bad prefix range {part!r}: expected digits like 460-469 with equal lengths")
+        ranges.append((low, high))
+    return ranges
+
+
+def parse_tag_list(spec: str) -> Tuple[str, ...]:
+    """Parse 'russia,fr:boissons' into Open*Facts tags; a bare name gets the 'en:' prefix the dumps use."""
+    tags = set()
+    for part in spec.split(","):
+        tag = "-".join(part.strip().lower().split())
+        if tag:
+            tags.add(tag if ":" in tag else f"en:{tag}")
+    return tuple(sorted(tags))
+
+
+def prefix_in_ranges(key: str, ranges: Iterable[Tuple[str, str]]) -> bool:
+    return any(low <= key[: len(low)] <= high for low, high in ranges)
+
+
+def shard_for_barcode(manifest: dict, barcode: str) -> Optional[str]:
+    """Reference routing for clients: the shard file that would hold `barcode`, if that shard exists.
+
+    The key is the barcode's decimal text as stored, so with the integer layout
+    it is the canonical GTIN without leading zeros.
+    """
+    key = str(int(barcode)) if manifest["schema"] == "integer" else barcode
+    routing = manifest["routing"]
+    if prefix_in_ranges(key, routing["hot_prefixes"]):
+        name = "hot"
+    else:
+        name = f"range-{key[: routing['range_digits']]}"
+    files = {shard["name"]: shard["file"] for shard in manifest["shards"]}
+    return files.get(name)
+
+
+def write_shards(
+    index_db: Path,
+    shard_dir: Path,
+    hot_prefixes: List[Tuple[str, str]],
+    range_digits: int = 1,
+) -> dict:
+    """Split `index_db` into a hot shard plus per-prefix range shards, then write the manifest.
+
+    Each shard has the same products layout as the full index, so the app's
+    barcode query runs unchanged against whichever shard the manifest routes to.
+    Each also gets its own index_meta row: the digest and counts cover that
+    shard's products, so the shard digests add up to the full index's digest.
+    """
+    schema = products_schema(index_db) or "text"
+    schema_sql = PRODUCTS_INTEGER_SCHEMA_SQL if schema == "integer" else PRODUCTS_SCHEMA_SQL
+    # The integer layout is clustered on barcode; the text layout needs its lookup index.
+    index_sql = PRODUCTS_INDEX_SQL[:1] if schema == "text" else ()
+    key = "CAST(barcode AS TEXT)"
+    hot_predicate = " OR ".join(f"substr({key}, 1, {len(low)}) BETWEEN ? AND ?" for low, _ in hot_prefixes) or "0"
+    hot_params = [value for pair in hot_prefixes for value in pair]
+    columns = ", ".join(PRODUCT_COLUMNS)
+
+    source = sqlite3.connect(f"file:{index_db}?mode=ro", uri=True)
+    try:
+        full_meta = read_index_meta(source) or {"built_at": build_timestamp(), "sources": {}}
+        range_keys = [
+            row[0]
+            for row in source.execute(
+                f"SELECT DISTINCT substr({key}, 1, ?) FROM products WHERE NOT ({hot_predicate}) ORDER BY 1",
+                (range_digits, *hot_params),
             )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            rows,
-        )
+        ]
+    finally:
+        source.close()
 
-        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_products_barcode ON products(barcode)")
-        cursor.execute(
-            "CREATE INDEX IF NOT EXISTS idx_products_source_rank_quality ON products(source_rank DESC, quality_score DESC)"
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    plans = [("hot", hot_predicate, hot_params, [list(pair) for pair in hot_prefixes])]
+    for range_key in range_keys:
+        predicate = f"substr({key}, 1, {range_digits}) = ? AND NOT ({hot_predicate})"
+        plans.append((f"range-{range_key}", predicate, [range_key, *hot_params], [[range_key, range_key]]))
+
+    shards = []
+    for name, predicate, params, prefixes in plans:
+        shard_path = shard_dir / f"{name}.sqlite"
+        with atomic_output(shard_path) as tmp_db:
+            connection = sqlite3.connect(tmp_db)
+            try:
+                apply_bulk_load_pragmas(connection)
+                connection.execute(schema_sql)
+                connection.execute("ATTACH DATABASE ? AS full_index", (f"file:{index_db}?mode=ro",))
+                connection.execute(
+                    f"""
+                    INSERT INTO products ({columns})
+                    SELECT {columns} FROM full_index.products WHERE {predicate} ORDER BY barcode
+                    """,
+                    params,
+                )
+                rows = connection.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+                for statement in index_sql:
+                    connection.execute(statement)
+                digest = index_content_digest(connection)
+                products_by_source = dict(connection.execute("SELECT source, COUNT(*) FROM products GROUP BY source"))
+                write_index_meta(
+                    connection, schema, full_meta["built_at"], digest, full_meta["sources"], products_by_source
+                )
+                connection.commit()
+                connection.execute("DETACH DATABASE full_index")
+            finally:
+                connection.close()
+        shards.append(
+            {
+                "name": name,
+                "file": shard_path.name,
+                "prefixes": prefixes,
+                "rows": rows,
+                "content_digest": digest.hexdigest(),
+                "bytes": shard_path.stat().st_size,
+                "sha256": file_sha256(shard_path),
+            }
         )
-        connection.commit()
+
+    manifest = {
+        "format": SHARD_FORMAT_VERSION,
+        "schema": schema,
+        "source_index": index_db.name,
+        "built_at": build_timestamp(),
+        "routing": {"hot_prefixes": [list(pair) for pair in hot_prefixes], "range_digits": range_digits},
+        "shards": shards,
+    }
+    manifest_path = shard_dir / SHARD_MANIFEST
+    with atomic_output(manifest_path) as tmp_manifest:
+        tmp_manifest.write_text(json.dumps(manifest, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+
+    # Shards from an earlier run with other prefixes would otherwise linger next to the manifest.
+    current = {shard["file"] for shard in shards}
+    for stale in shard_dir.glob("*.sqlite"):
+        if stale.name not in current and (stale.name == "hot.sqlite" or stale.name.startswith("range-")):
+            stale.unlink()
+
+    hot = shards[0]
+    print(
+        (
+            f"[ok] shards written: {shard_dir} | hot={hot['rows']} rows {format_mib(hot['bytes'])} "
+            f"+ {len(shards) - 1} range shards"
+        ),
+        file=sys.stderr,
+    )
+    return manifest
+
+
+def mix64(value: int) -> int:
+    # splitmix64 finalizer: cheap, well-distributed and easy to port to the app.
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
+
+
+def bloom_positions(key: int, bits: int, hashes: int) -> Iterator[int]:
+    first = mix64(key)
+    step = mix64(key ^ 0x9E3779B97F4A7C15) | 1
+    return ((first + index * step) % bits for index in range(hashes))
+
+
+def write_binary_index(index_db: Path, output_path: Path) -> Dict[str, int]:
+    """Write the products of `index_db` as a sorted, memory-mappable lookup file.
+
+    Keys are barcode_key() values (the GTIN itself for the integer layout, flagged
+    in the header so readers canonicalise queries the same way), names live in one
+    UTF-8 blob addressed by offsets, and brands/categories share a string dictionary.
+    """
+    canonical = products_schema(index_db) == "integer"
+    # Both orders match ascending key order, so rows stream straight into the arrays.
+    order = "barcode" if canonical else "length(barcode), barcode"
+    keys = array("Q")
+    name_offsets = array("I", [0])
+    brand_ids = array("I")
+    category_ids = array("I")
+    names = bytearray()
+    strings = StringInterner()
+    skipped = 0
+
+    connection = sqlite3.connect(f"file:{index_db}?mode=ro", uri=True)
+    try:
+        rows = connection.execute(f"SELECT barcode, name, brand, category FROM products ORDER BY {order}")
+        for barcode, name, brand, category in rows:
+            # Like oversized keys, barcodes that are not plain ASCII digits have no u64 key.
+            if not canonical and not is_ascii_digits(barcode):
+                skipped += 1
+                continue
+            key = barcode if canonical else barcode_key(barcode)
+            if key > MASK64:
+                skipped += 1
+                continue
+            keys.append(key)
+            names += name.encode("utf-8")
+            name_offsets.append(len(names))
+            brand_ids.append(strings.intern(brand))
+            category_ids.append(strings.intern(category))
     finally:
         connection.close()
 
+    dictionary = bytearray()
+    dictionary_offsets = array("I", [0])
+    for value in strings.values[1:]:
+        dictionary += value.encode("utf-8")
+        dictionary_offsets.append(len(dictionary))
+
+    bloom_bits = max(64, -(-len(keys) * BINARY_BLOOM_BITS_PER_KEY // 64) * 64)
+    bloom = bytearray(bloom_bits // 8)
+    for key in keys:
+        for position in bloom_positions(key, bloom_bits, BINARY_BLOOM_HASHES):
+            bloom[position >> 3] |= 1 << (position & 7)
+
+    arrays = (keys, name_offsets, brand_ids, category_ids, dictionary_offsets)
+    if sys.byteorder != "little":
+        for values in arrays:
+            values.byteswap()
+    sections = [values.tobytes() for values in arrays] + [bytes(dictionary), bytes(names), bytes(bloom)]
+
+    offsets = []
+    position = BINARY_HEADER.size
+    for section in sections:
+        position = -(-position // 8) * 8
+        offsets.append(position)
+        position += len(section)
+
+    with atomic_output(output_path) as tmp_path:
+        with tmp_path.open("wb") as handle:
+            handle.write(
+                BINARY_HEADER.pack(
+                    BINARY_MAGIC,
+                    BINARY_FORMAT_VERSION,
+                    BINARY_FLAG_CANONICAL if canonical else 0,
+                    len(keys),
+                    len(strings.values) - 1,
+                    bloom_bits,
+                    BINARY_BLOOM_HASHES,
+                    *offsets,
+                )
+            )
+            for offset, section in zip(offsets, sections):
+                handle.write(b"\0" * (offset - handle.tell()))
+                handle.write(section)
+
+    print(
+        (
+            f"[ok] binary index written: {output_path} | rows={len(keys)} skipped={skipped} "
+            f"strings={len(strings.values) - 1} | {format_mib(output_path.stat().st_size)}"
+        ),
+        file=sys.stderr,
+    )
+    return {"rows": len(keys), "skipped": skipped, "strings": len(strings.values) - 1}
+
+
+class BinaryIndexReader:
+    """Lookups against a write_binary_index() file through mmap: bloom filter, then binary search."""
+
+    def __init__(self, path: Path) -> None:
+        self.handle = path.open("rb")
+        self.map = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, flags, count, strings, bloom_bits, bloom_hashes, *offsets = BINARY_HEADER.unpack_from(self.map)
+        if magic != BINARY_MAGIC or version != BINARY_FORMAT_VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a version {BINARY_FORMAT_VERSION} binary barcode index")
+        if sys.byteorder != "little":
+            self.close()
+            raise ValueError("binary barcode indexes are little-endian")
+
+        keys_at, name_offsets_at, brand_ids_at, category_ids_at = offsets[:4]
+        dictionary_offsets_at, dictionary_at, names_at, bloom_at = offsets[4:]
+        self.canonical = bool(flags & BINARY_FLAG_CANONICAL)
+        self.bloom_bits = bloom_bits
+        self.bloom_hashes = bloom_hashes
+        self.views: List[memoryview] = []
+        self.keys = self._view(keys_at, count * 8, "Q")
+        self.name_offsets = self._view(name_offsets_at, (count + 1) * 4, "I")
+        self.brand_ids = self._view(brand_ids_at, count * 4, "I")
+        self.category_ids = self._view(category_ids_at, count * 4, "I")
+        self.names = self._view(names_at, self.name_offsets[count] if count else 0)
+        self.bloom = self._view(bloom_at, bloom_bits // 8)
+        dictionary_offsets = self._view(dictionary_offsets_at, (strings + 1) * 4, "I")
+        dictionary = self._view(dictionary_at, dictionary_offsets[strings])
+        # The dictionary is small (distinct brands and categories), so decode it once.
+        self.dictionary: List[Optional[str]] = [None] + [
+            bytes(dictionary[dictionary_offsets[index] : dictionary_offsets[index + 1]]).decode("utf-8")
+            for index in range(strings)
+        ]
+
+    def _view(self, offset: int, size: int, fmt: str = "B") -> memoryview:
+        view = memoryview(self.map)[offset : offset + size]
+        if fmt != "B":
+            view = view.cast(fmt)
+        self.views.append(view)
+        return view
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __enter__(self) -> "BinaryIndexReader":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for view in getattr(self, "views", []):
+            view.release()
+        self.views = []
+        self.map.close()
+        self.handle.close()
+
+    def key_for(self, barcode: str) -> Optional[int]:
+        if self.canonical:
+            canonical = canonicalize_gtin(barcode)
+            return int(canonical) if canonical else None
+        digits = normalize_barcode(barcode)
+        if not is_ascii_digits(digits):
+            return None
+        key = barcode_key(digits)
+        return key if key <= MASK64 else None
+
+    def might_contain(self, key: int) -> bool:
+        bloom = self.bloom
+        return all(
+            bloom[position >> 3] & (1 << (position & 7))
+            for position in bloom_positions(key, self.bloom_bits, self.bloom_hashes)
+        )
+
+    def lookup(self, barcode: str) -> Optional[Tuple[str, Optional[str], Optional[str]]]:
+        """(name, brand, category) for `barcode`, like the app's products query."""
+        key = self.key_for(barcode)
+        if key is None or not self.might_contain(key):
+            return None
+        index = bisect.bisect_left(self.keys, key)
+        if index == len(self.keys) or self.keys[index] != key:
+            return None
+        name = bytes(self.names[self.name_offsets[index] : self.name_offsets[index + 1]]).decode("utf-8")
+        return name, self.dictionary[self.brand_ids[index]], self.dictionary[self.category_ids[index]]
+
+
+def is_shipped_index(connection: sqlite3.Connection, schema: str = "main") -> bool:
+    row = connection.execute(f"SELECT type FROM {schema}.sqlite_master WHERE name = 'products'").fetchone()
+    return row is not None and row[0] == "view"
+
+
+def optimize_for_ship(index_db: Path, page_size: int = SHIP_PAGE_SIZE) -> Tuple[int, int]:
+    """Rewrite a built index into its shipped layout and return the file size before and after.
+
+    brand, category, source and updated_at become ids into one product_strings
+    table (most frequent first, so common values get the shortest varints),
+    rows are clustered on barcode in a WITHOUT ROWID table, and a products view
+    restores the original columns. Indexes the app never queries are left out.
+    A products_search table keeps rowids, so text-key indexes that have one
+    store rows in a rowid table with a unique barcode index instead.
+    """
+    before = index_db.stat().st_size
+    schema = products_schema(index_db)
+    if schema is None:
+        raise ValueError(f"{index_db} has no products table")
+
+    with atomic_output(index_db) as tmp_path:
+        connection = sqlite3.connect(tmp_path)
+        try:
+            connection.execute(f"PRAGMA page_size = {page_size}")
+            apply_bulk_load_pragmas(connection)
+            connection.execute("ATTACH DATABASE ? AS built", (str(index_db),))
+            if is_shipped_index(connection, "built"):
+                raise ValueError(f"{index_db} is already optimized for ship")
+            search = connection.execute(
+                "SELECT 1 FROM built.sqlite_master WHERE name = 'products_search'"
+            ).fetchone() is not None
+            keep_rowid = schema == "text" and search
+
+            values = " UNION ALL ".join(
+                f"SELECT {column} AS value FROM built.products" for column in SHIP_STRING_COLUMNS
+            )
+            connection.execute("CREATE TABLE product_strings (id INTEGER PRIMARY KEY, value TEXT NOT NULL)")
+            connection.execute(
+                f"""
+                INSERT INTO product_strings (value)
+                SELECT value FROM ({values}) WHERE value IS NOT NULL
+                GROUP BY value
+                ORDER BY COUNT(*) DESC, value
+                """
+            )
+            connection.execute(
+                "CREATE TEMP TABLE string_ids (value TEXT PRIMARY KEY, id INTEGER NOT NULL) WITHOUT ROWID"
+            )
+            connection.execute("INSERT INTO temp.string_ids (value, id) SELECT value, id FROM product_strings")
+
+            if keep_rowid:
+                key_columns = "id INTEGER PRIMARY KEY, barcode TEXT NOT NULL"
+                table_options = ""
+            else:
+                key_columns = f"barcode {'INTEGER' if schema == 'integer' else 'TEXT'} PRIMARY KEY"
+                table_options = "WITHOUT ROWID"
+            connection.execute(
+                f"""
+                CREATE TABLE product_rows (
+                    {key_columns},
+                    name TEXT NOT NULL,
+                    brand_id INTEGER,
+                    category_id INTEGER,
+                    source_id INTEGER NOT NULL,
+                    source_rank INTEGER NOT NULL,
+                    quality_score INTEGER NOT NULL,
+                    updated_at_id INTEGER NOT NULL
+                ) {table_options}
+                """
+            )
+            joins = "\n".join(
+                f"LEFT JOIN temp.string_ids AS {column} ON {column}.value = p.{column}"
+                for column in SHIP_STRING_COLUMNS
+            )
+            connection.execute(
+                f"""
+                INSERT INTO product_rows (
+                    {"id, " if keep_rowid else ""}barcode, name, brand_id, category_id, source_id,
+                    source_rank, quality_score, updated_at_id
+                )
+                SELECT {"p.rowid, " if keep_rowid else ""}p.barcode, p.name, brand.id, category.id, source.id,
+                    p.source_rank, p.quality_score, updated_at.id
+                FROM built.products AS p
+                {joins}
+                ORDER BY {"p.rowid" if keep_rowid else "p.barcode"}
+                """
+            )
+            if keep_rowid:
+                connection.execute("CREATE UNIQUE INDEX idx_product_rows_barcode ON product_rows(barcode)")
+
+            view_joins = "\n".join(
+                f"LEFT JOIN product_strings AS {column} ON {column}.id = r.{column}_id"
+                for column in SHIP_STRING_COLUMNS
+            )
+            connection.execute(
+                f"""
+                CREATE VIEW products AS
+                SELECT {"r.id AS rowid, " if keep_rowid else ""}r.barcode AS barcode, r.name AS name,
+                    brand.value AS brand, category.value AS category, source.value AS source,
+                    r.source_rank AS source_rank, r.quality_score AS quality_score, updated_at.value AS updated_at
+                FROM product_rows AS r
+                {view_joins}
+                """
+            )
+            if search:
+                create_search_index(connection, schema)
+            strings = connection.execute("SELECT COUNT(*) FROM product_strings").fetchone()[0]
+
+            if products_digest(connection) != products_digest(connection, "built"):
+                raise RuntimeError("optimized index does not match the built one")
+            copy_index_meta(connection, "built")
+            connection.commit()
+            connection.execute("DETACH DATABASE built")
+            connection.execute("ANALYZE")
+            connection.commit()
+            connection.execute("VACUUM")
+        finally:
+            connection.close()
+
+    after = index_db.stat().st_size
     print(
         (
-            "[ok] built index: "
-            f"{output_db} | seen={aggregator.total_seen} valid={aggregator.total_valid} "
-            f"unique={len(aggregator.best_by_barcode)}"
+            f"[ok] optimized for ship: {index_db} | {format_mib(before)} -> {format_mib(after)} "
+            f"({(after - before) / before:+.1%}) | page_size={page_size} strings={strings}"
         ),
         file=sys.stderr,
     )
+    return before, after
 
 
 def parse_args() -> argparse.Namespace:
@@ -360,6 +3789,232 @@ def parse_args() -> argparse.Namespace:
         help="Skip openfoodfacts-products.csv.gz source.",
     )
     parser.set_defaults(include_off_food=True)
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Parse sources (and UHTT archive entries) in N worker processes.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Re-parse only sources whose manifest sha256 changed and update the affected barcodes in place.",
+    )
+    parser.add_argument(
+        "--state-db",
+        type=Path,
+        default=None,
+        help="Per-source candidate store used by --incremental (default: <output>.sources.sqlite).",
+    )
+    parser.add_argument(
+        "--aggregator",
+        choices=AGGREGATOR_BACKENDS,
+        default="dict",
+        help=(
+            "Winner store: 'dict' keeps Candidate objects, 'compact' uses typed arrays and interned strings, "
+            "'sqlite' upserts into an on-disk staging table so memory stays flat."
+        ),
+    )
+    parser.add_argument(
+        "--staging-dir",
+        type=Path,
+        default=None,
+        help=(
+            "Directory for --aggregator sqlite staging files and the extracted catalog database "
+            "(default: next to --output)."
+        ),
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Inflate, parse and aggregate each Open*Facts dump in separate threads joined by bounded queues.",
+    )
+    parser.add_argument(
+        "--openfacts-chunk-lines",
+        type=int,
+        default=0,
+        help=(
+            "With --jobs > 1, split each Open*Facts dump into record-aligned blocks of about N lines "
+            "parsed across the worker pool (0 keeps one worker per dump)."
+        ),
+    )
+    parser.add_argument(
+        "--canonical-gtin",
+        action="store_true",
+        help="Canonicalise barcodes as GTIN-8/12/13/14 and drop codes with a bad length or check digit.",
+    )
+    parser.add_argument(
+        "--openfacts-countries",
+        default="",
+        help="Keep only Open*Facts rows whose countries_tags include one of these tags, e.g. en:russia,en:belarus.",
+    )
+    parser.add_argument(
+        "--openfacts-categories",
+        default="",
+        help="Keep only Open*Facts rows whose categories_tags include one of these tags, e.g. en:beverages.",
+    )
+    parser.add_argument(
+        "--openfacts-barcode-prefixes",
+        default="",
+        help="Keep only Open*Facts barcodes in these prefix ranges, e.g. 460-469,4810-4819.",
+    )
+    parser.add_argument(
+        "--sample",
+        type=float,
+        default=1.0,
+        metavar="FRACTION",
+        help="Keep this hash-picked fraction of barcodes from every source (e.g. 0.01) and estimate full-build counts.",
+    )
+    parser.add_argument(
+        "--schema",
+        choices=PRODUCT_SCHEMAS,
+        default="text",
+        help="'integer' stores canonical GTINs as an INTEGER primary key in a WITHOUT ROWID table (implies --canonical-gtin).",
+    )
+    parser.add_argument(
+        "--search-index",
+        action="store_true",
+        help="Add a products_search FTS5 table over folded name/brand tokens with 2-4 character prefix indexes.",
+    )
+    parser.add_argument(
+        "--previous-index",
+        type=Path,
+        default=None,
+        help="Earlier index to diff the new build against (or to patch with --apply-delta).",
+    )
+    parser.add_argument(
+        "--delta-output",
+        type=Path,
+        default=None,
+        help="Where to write the delta against --previous-index (default: <output>.delta.sqlite).",
+    )
+    parser.add_argument(
+        "--apply-delta",
+        type=Path,
+        default=None,
+        help="Instead of building, patch --previous-index with this delta into --output and verify it.",
+    )
+    parser.add_argument(
+        "--shard-dir",
+        type=Path,
+        default=None,
+        help="Also split the index into a hot shard, prefix-range shards and manifest.json in this directory.",
+    )
+    parser.add_argument(
+        "--hot-prefixes",
+        default=DEFAULT_HOT_PREFIXES,
+        help="Comma-separated barcode prefix ranges for the hot shard, e.g. 460-469,4810-4819.",
+    )
+    parser.add_argument(
+        "--shard-digits",
+        type=int,
+        default=1,
+        help="Leading digits that pick a range shard outside the hot prefixes (1 = up to 10 shards).",
+    )
+    parser.add_argument(
+        "--backend-output",
+        type=Path,
+        default=None,
+        help=(
+            "Also write the iOS winners in the backend's local barcode database layout "
+            "(e.g. backend/data/local_barcode_db.sqlite). Same table as backend/scripts/build-local-db.ts, "
+            "but every source and the iOS field rules: normalised barcode and name, first brand and category."
+        ),
+    )
+    parser.add_argument(
+        "--ndjson-output",
+        type=Path,
+        default=None,
+        help="Also stream every product as one JSON object per line; a .gz name is gzip-compressed.",
+    )
+    parser.add_argument(
+        "--catalog-format",
+        choices=CATALOG_FORMATS,
+        default="auto",
+        help=(
+            "catalog.app export to read: 'db' extracts catalog-barcodes-db.zip once and reads it with SQL, "
+            "'csv' parses catalog-barcodes-csv.zip, 'auto' reads the CSV export and falls back to the "
+            "database only when the CSV zip is missing."
+        ),
+    )
+    parser.add_argument(
+        "--parse-cache",
+        type=Path,
+        default=None,
+        help=(
+            "Directory of parsed rows per source, keyed by file sha256 and parser version; later builds read these "
+            "instead of the raw archives. Dumps split with --openfacts-chunk-lines or checkpointed in blocks are "
+            "not cached on that run."
+        ),
+    )
+    parser.add_argument(
+        "--checkpoint",
+        action="store_true",
+        help="Save aggregation state to <output>.checkpoint.sqlite after each source and periodically inside dumps.",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=float,
+        default=DEFAULT_CHECKPOINT_INTERVAL,
+        help="Seconds between checkpoints inside one Open*Facts dump (0 = only between sources).",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue from the last checkpoint of an interrupted build (implies --checkpoint).",
+    )
+    parser.add_argument(
+        "--binary-output",
+        type=Path,
+        default=None,
+        help="Also write a sorted, memory-mappable binary lookup file (bloom filter + binary search) here.",
+    )
+    parser.add_argument(
+        "--optimize-for-ship",
+        action="store_true",
+        help=(
+            "Finally rewrite the index for shipping: dictionary-encoded brand/category/source/updated_at behind a "
+            "products view, barcode-clustered rows, no unused indexes, then ANALYZE and VACUUM."
+        ),
+    )
+    parser.add_argument(
+        "--ship-page-size",
+        type=int,
+        default=SHIP_PAGE_SIZE,
+        help="Page size of the shipped index (a power of two from 512 to 65536).",
+    )
+    parser.add_argument(
+        "--stats-json",
+        type=Path,
+        default=None,
+        help="Write per-source timings, rows/s, peak memory, reject reasons and winner counts to this JSON file.",
+    )
+    parser.add_argument(
+        "--progress",
+        dest="progress",
+        action="store_true",
+        default=None,
+        help="Print throughput and an ETA from compressed bytes consumed (default: when stderr is a terminal).",
+    )
+    parser.add_argument("--no-progress", dest="progress", action="store_false", help="Disable progress lines.")
+    parser.add_argument(
+        "--profile-source",
+        default=None,
+        help="Profile parsing of one source (e.g. open_food_facts); needs --jobs 1 and a full build.",
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profile_mode",
+        choices=PROFILE_MODES,
+        default="cprofile",
+        help="Profiler used by --profile-source.",
+    )
+    parser.add_argument(
+        "--profile-output",
+        type=Path,
+        default=None,
+        help="Profile output (default: <output>.<source>.prof, or .tracemalloc.txt for tracemalloc).",
+    )
     return parser.parse_args()
 
 
@@ -368,11 +4023,148 @@ def main() -> int:
     raw_dir = args.raw_dir.resolve()
     output = args.output.resolve()
 
+    previous_index = args.previous_index.resolve() if args.previous_index else None
+    if args.apply_delta:
+        if previous_index is None:
+            print("[error] --apply-delta needs --previous-index", file=sys.stderr)
+            return 1
+        try:
+            meta = apply_delta(previous_index, args.apply_delta.resolve(), output)
+        except (ValueError, RuntimeError) as error:
+            print(f"[error] {error}", file=sys.stderr)
+            return 1
+        print(
+            (
+                f"[ok] patched index: {output} | inserted={meta['inserted']} updated={meta['updated']} "
+                f"deleted={meta['deleted']} rows={meta['target_rows']}"
+            ),
+            file=sys.stderr,
+        )
+        return 0
+
+    if previous_index is not None and previous_index == output:
+        print("[error] --previous-index must be a copy; --output is replaced by the build", file=sys.stderr)
+        return 1
+
     if not raw_dir.exists():
         print(f"[error] raw directory does not exist: {raw_dir}", file=sys.stderr)
         return 1
 
-    build_index(raw_dir=raw_dir, output_db=output, include_off_food=args.include_off_food)
+    exports = [path.resolve() for path in (args.backend_output, args.ndjson_output) if path is not None]
+    if output in exports or len(set(exports)) < len(exports):
+        print("[error] --output, --backend-output and --ndjson-output must be different files", file=sys.stderr)
+        return 1
+
+    if args.jobs < 1:
+        print("[error] --jobs must be at least 1", file=sys.stderr)
+        return 1
+
+    if args.openfacts_chunk_lines < 0:
+        print("[error] --openfacts-chunk-lines must not be negative", file=sys.stderr)
+        return 1
+
+    try:
+        hot_prefixes = parse_prefix_ranges(args.hot_prefixes)
+    except ValueError as error:
+        print(f"[error] --hot-prefixes: {error}", file=sys.stderr)
+        return 1
+    try:
+        openfacts_prefixes = tuple(parse_prefix_ranges(args.openfacts_barcode_prefixes))
+    except ValueError as error:
+        print(f"[error] --openfacts-barcode-prefixes: {error}", file=sys.stderr)
+        return 1
+    if not 0.0 < args.sample <= 1.0:
+        print("[error] --sample must be a fraction in (0, 1]", file=sys.stderr)
+        return 1
+    if args.shard_digits < 1:
+        print("[error] --shard-digits must be at least 1", file=sys.stderr)
+        return 1
+
+    if args.optimize_for_ship and args.incremental:
+        print("[error] --optimize-for-ship rewrites the products table that --incremental updates", file=sys.stderr)
+        return 1
+    if args.ship_page_size < 512 or args.ship_page_size > 65536 or args.ship_page_size & (args.ship_page_size - 1):
+        print("[error] --ship-page-size must be a power of two from 512 to 65536", file=sys.stderr)
+        return 1
+
+    if (args.checkpoint or args.resume) and args.incremental:
+        print("[error] --checkpoint/--resume apply to full builds; --incremental keeps its own state", file=sys.stderr)
+        return 1
+    if (args.checkpoint or args.resume) and args.pipeline:
+        # Checkpointed Open*Facts dumps are parsed block by block on one thread, which --pipeline cannot resume.
+        print("[error] --checkpoint/--resume cannot be combined with --pipeline", file=sys.stderr)
+        return 1
+
+    profile_output = None
+    if args.profile_source:
+        if args.jobs > 1 or args.incremental:
+            print("[error] --profile-source needs a full build with --jobs 1", file=sys.stderr)
+            return 1
+        suffix = ".prof" if args.profile_mode == "cprofile" else ".tracemalloc.txt"
+        default_output = output.with_name(f"{output.stem}.{args.profile_source}{suffix}")
+        profile_output = (args.profile_output or default_output).resolve()
+
+    settings = BuildSettings(
+        jobs=args.jobs,
+        aggregator_backend=args.aggregator,
+        staging_dir=args.staging_dir.resolve() if args.staging_dir else None,
+        schema=args.schema,
+        pipeline=args.pipeline,
+        openfacts_chunk_lines=args.openfacts_chunk_lines,
+        parse_options=ParseOptions(
+            canonical_gtin=args.canonical_gtin or args.schema == "integer",
+            countries=parse_tag_list(args.openfacts_countries),
+            categories=parse_tag_list(args.openfacts_categories),
+            barcode_prefixes=openfacts_prefixes,
+            sample=args.sample,
+        ),
+        search_index=args.search_index,
+        progress=sys.stderr.isatty() if args.progress is None else args.progress,
+        stats_json=args.stats_json.resolve() if args.stats_json else None,
+        profile_source=args.profile_source,
+        profile_mode=args.profile_mode,
+        profile_output=profile_output,
+        checkpoint=args.checkpoint,
+        checkpoint_interval=args.checkpoint_interval,
+        resume=args.resume,
+        parse_cache_dir=args.parse_cache.resolve() if args.parse_cache else None,
+        catalog_format=args.catalog_format,
+        backend_output=args.backend_output.resolve() if args.backend_output else None,
+        ndjson_output=args.ndjson_output.resolve() if args.ndjson_output else None,
+    )
+    try:
+        build_index(
+            raw_dir=raw_dir,
+            output_db=output,
+            include_off_food=args.include_off_food,
+            settings=settings,
+            incremental=args.incremental,
+            state_db=args.state_db.resolve() if args.state_db else None,
+        )
+    except (ValueError, RuntimeError) as error:
+        print(f"[error] {error}", file=sys.stderr)
+        return 1
+    if previous_index is not None:
+        delta_output = args.delta_output or output.with_name(f"{output.stem}.delta.sqlite")
+        try:
+            build_delta(previous_index, output, delta_output.resolve())
+        except (ValueError, RuntimeError) as error:
+            print(f"[error] {error}", file=sys.stderr)
+            return 1
+    if args.shard_dir is not None:
+        write_shards(output, args.shard_dir.resolve(), hot_prefixes, args.shard_digits)
+    if args.binary_output is not None:
+        try:
+            write_binary_index(output, args.binary_output.resolve())
+        except ValueError as error:
+            print(f"[error] {error}", file=sys.stderr)
+            return 1
+    if args.optimize_for_ship:
+        try:
+            optimize_for_ship(output, args.ship_page_size)
+        except (ValueError, RuntimeError) as error:
+            print(f"[error] {error}", file=sys.stderr)
+            return 1
     return 0
 
 
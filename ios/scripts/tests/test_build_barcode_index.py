@@ -3,8 +3,13 @@ from __future__ import annotations
 
 import csv
 import gzip
+import io
+import json
+import os
+import shutil
 import sqlite3
 import subprocess
+import sys
 import tempfile
 import zipfile
 from pathlib import Path
@@ -33,6 +38,29 @@ def _write_catalog_zip(path: Path) -> None:
             writer.writerows(rows)
 
 
+def _write_catalog_db_zip(path: Path, barcode_type: str = "TEXT") -> None:
+    database = path.with_suffix(".db")
+    connection = sqlite3.connect(database)
+    try:
+        connection.execute(
+            "CREATE TABLE barcodes "
+            f"(Id INTEGER PRIMARY KEY, Category TEXT, Vendor TEXT, Name TEXT, Article TEXT, Barcode {barcode_type})"
+        )
+        connection.executemany(
+            "INSERT INTO barcodes VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (1, "Соусы", "Brand", "МАЙОНЕЗ", None, "4601576009686"),
+                (2, "Соусы", "Brand", "4601576009686", None, "4601576009686"),
+            ],
+        )
+        connection.commit()
+    finally:
+        connection.close()
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.write(database, "barcodes.db")
+    database.unlink()
+
+
 def _write_openfacts_gz(path: Path) -> None:
     headers = ["code", "product_name", "generic_name", "brands", "categories"]
     rows = [
@@ -55,32 +83,986 @@ class TextWriter:
         return len(data)
 
 
-def main() -> int:
-    script_path = Path(__file__).resolve().parents[1] / "build_barcode_index.py"
+SCRIPT_PATH = Path(__file__).resolve().parents[1] / "build_barcode_index.py"
+
+
+def _import_builder():
+    if str(SCRIPT_PATH.parent) not in sys.path:
+        sys.path.insert(0, str(SCRIPT_PATH.parent))
+    import build_barcode_index
+
+    return build_barcode_index
+
+
+def _import_bench():
+    _import_builder()
+    import bench_barcode_index
+
+    return bench_barcode_index
+
+
+def _write_raw_fixture(raw_dir: Path) -> None:
+    raw_dir.mkdir(parents=True)
+    _write_uhtt_zip(raw_dir / "uhtt-reference-20230913.zip")
+    _write_catalog_zip(raw_dir / "catalog-barcodes-csv.zip")
+    _write_openfacts_gz(raw_dir / "openbeautyfacts-products.csv.gz")
+    _write_openfacts_gz(raw_dir / "openpetfoodfacts-products.csv.gz")
+    _write_openfacts_gz(raw_dir / "openproductsfacts-products.csv.gz")
+
+
+# str.isdigit() accepts these, so normalize_barcode keeps them; the second is 4601576009686 in Arabic-Indic digits.
+ODD_DIGIT_BARCODES = ("4601576009686\u00b2", "\u0664\u0666\u0660\u0661\u0665\u0667\u0666\u0660\u0660\u0669\u0666\u0668\u0666")
+
+
+def _odd_digit_raw_dir(raw_dir: Path, tmp_path: Path) -> Path:
+    odd_raw = tmp_path / "odd-digit-raw"
+    if odd_raw.exists():
+        return odd_raw
+    shutil.copytree(raw_dir, odd_raw)
+    with gzip.open(odd_raw / "openproductsfacts-products.csv.gz", "wt", encoding="utf-8", newline="") as handle:
+        writer = csv.writer(handle, delimiter="\t", lineterminator="\n")
+        writer.writerow(["code", "product_name", "brands"])
+        writer.writerow([ODD_DIGIT_BARCODES[0], "Соус сырный", "Верхний индекс"])
+        writer.writerow([ODD_DIGIT_BARCODES[1], "Соус томатный", "Арабские цифры"])
+        writer.writerow(["1234567890123", "Корм для котов сухой", "PetBrand"])
+    return odd_raw
+
+
+def _run_builder(raw_dir: Path, output_db: Path, *extra_args: str) -> None:
+    env = dict(os.environ, SOURCE_DATE_EPOCH="1700000000")
+    subprocess.run(
+        [
+            "python3",
+            str(SCRIPT_PATH),
+            "--raw-dir",
+            str(raw_dir),
+            "--output",
+            str(output_db),
+            *extra_args,
+        ],
+        check=True,
+        env=env,
+    )
+
+
+def _products_and_digest(index_db: Path) -> tuple:
+    """Everything but index_meta.sources, which names the raw files a build read."""
+    connection = sqlite3.connect(index_db)
+    try:
+        rows = connection.execute("SELECT * FROM products ORDER BY barcode").fetchall()
+        (digest,) = connection.execute("SELECT content_digest FROM index_meta").fetchone()
+    finally:
+        connection.close()
+    return rows, digest
+
+
+def _check_failed_write_keeps_previous_output(tmp_path: Path, serial_db: Path) -> None:
+    builder = _import_builder()
+    output_db = tmp_path / "kept.sqlite"
+    output_db.write_bytes(serial_db.read_bytes())
+
+    def interrupted_candidates():
+        yield builder.Candidate("4600000000017", "Кефир", None, None, "uhtt", 300, 10)
+        raise KeyboardInterrupt
+
+    try:
+        builder.write_products(output_db, interrupted_candidates(), "2023-11-14T22:13:20Z")
+    except KeyboardInterrupt:
+        pass
+    else:
+        raise AssertionError("write_products swallowed the interruption")
+
+    assert output_db.read_bytes() == serial_db.read_bytes(), "interrupted write touched the previous index"
+    leftovers = [path.name for path in tmp_path.iterdir() if path.name.startswith(".kept.sqlite.")]
+    assert not leftovers, leftovers
+
+
+def _check_parallel_build_matches_serial(raw_dir: Path, tmp_path: Path, serial_db: Path) -> None:
+    parallel_db = tmp_path / "parallel.sqlite"
+    _run_builder(raw_dir, parallel_db, "--jobs", "3")
+    assert parallel_db.read_bytes() == serial_db.read_bytes(), "parallel build differs from serial build"
+
+
+def _check_compact_aggregator_matches_dict(raw_dir: Path, tmp_path: Path, serial_db: Path) -> None:
+    compact_db = tmp_path / "compact.sqlite"
+    _run_builder(raw_dir, compact_db, "--aggregator", "compact")
+    assert compact_db.read_bytes() == serial_db.read_bytes(), "compact aggregator output differs"
+
+    builder = _import_builder()
+    candidates = [
+        builder.Candidate(barcode, f"Товар {index}", None, None, "uhtt", 300, index % 3)
+        for index, barcode in enumerate((*ODD_DIGIT_BARCODES, "4601576009686", "0123", "123", *ODD_DIGIT_BARCODES))
+    ]
+    expected = builder.CandidateAggregator()
+    compact = builder.CompactCandidateAggregator()
+    for candidate in candidates:
+        expected.offer(candidate)
+        compact.offer(candidate)
+    assert list(compact.iter_winners()) == list(expected.iter_winners())
+
+    odd_raw = _odd_digit_raw_dir(raw_dir, tmp_path)
+    odd_dict_db = tmp_path / "odd-dict.sqlite"
+    odd_compact_db = tmp_path / "odd-compact.sqlite"
+    _run_builder(odd_raw, odd_dict_db)
+    _run_builder(odd_raw, odd_compact_db, "--aggregator", "compact")
+    assert odd_compact_db.read_bytes() == odd_dict_db.read_bytes(), "compact aggregator differs on odd digits"
+    connection = sqlite3.connect(odd_compact_db)
+    try:
+        barcodes = {barcode for (barcode,) in connection.execute("SELECT barcode FROM products")}
+    finally:
+        connection.close()
+    assert set(ODD_DIGIT_BARCODES) <= barcodes, barcodes
+
+
+def _check_checkpoint_resume(raw_dir: Path, tmp_path: Path, serial_db: Path) -> None:
+    builder = _import_builder()
+    output_db = tmp_path / "resumed.sqlite"
+    checkpoint_path = builder.default_checkpoint_path(output_db)
+    settings = builder.BuildSettings(checkpoint=True, checkpoint_interval=1e-9)
+    original_save = builder.BuildCheckpoint.save
+    original_chunk_lines = builder.CHECKPOINT_CHUNK_LINES
+
+    def save_then_interrupt(checkpoint, aggregator, state):
+        original_save(checkpoint, aggregator, state)
+        if state.chunks_done:
+            raise KeyboardInterrupt
+
+    previous_epoch = os.environ.get("SOURCE_DATE_EPOCH")
+    os.environ["SOURCE_DATE_EPOCH"] = "1700000000"
+    builder.CHECKPOINT_CHUNK_LINES = 1
+    try:
+        builder.BuildCheckpoint.save = save_then_interrupt
+        try:
+            builder.build_index(raw_dir, output_db, False, settings)
+        except KeyboardInterrupt:
+            pass
+        else:
+            raise AssertionError("build was not interrupted inside an Open*Facts dump")
+        finally:
+            builder.BuildCheckpoint.save = original_save
+        assert checkpoint_path.exists() and not output_db.exists()
+
+        builder.build_index(raw_dir, output_db, False, builder.BuildSettings(resume=True, checkpoint_interval=1e-9))
+    finally:
+        builder.CHECKPOINT_CHUNK_LINES = original_chunk_lines
+        if previous_epoch is None:
+            os.environ.pop("SOURCE_DATE_EPOCH", None)
+        else:
+            os.environ["SOURCE_DATE_EPOCH"] = previous_epoch
+
+    assert output_db.read_bytes() == serial_db.read_bytes(), "resumed build differs from an uninterrupted one"
+    assert not checkpoint_path.exists(), "checkpoint was not removed after a finished build"
+
+    # Defaults are built per state, so one source's reject counts cannot leak into the next.
+    assert builder.CheckpointState().source_before[2] is not builder.CheckpointState().source_before[2]
+    result = subprocess.run(
+        ["python3", str(SCRIPT_PATH), "--raw-dir", str(raw_dir), "--output", str(output_db), "--checkpoint", "--pipeline"],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 1 and "--pipeline" in result.stderr, result.stderr
+
 
+def _check_parse_cache(raw_dir: Path, tmp_path: Path, serial_db: Path) -> None:
+    cache_dir = tmp_path / "parse-cache"
+    cached_db = tmp_path / "cached.sqlite"
+    _run_builder(raw_dir, cached_db, "--parse-cache", str(cache_dir))
+    assert cached_db.read_bytes() == serial_db.read_bytes(), "build that filled the parse cache differs"
+    entries = sorted(path.name for path in cache_dir.iterdir())
+    assert len(entries) == 5 and all(name.endswith(".parse.sqlite") for name in entries), entries
+
+    _run_builder(raw_dir, cached_db, "--parse-cache", str(cache_dir))
+    assert cached_db.read_bytes() == serial_db.read_bytes(), "build from the parse cache differs"
+
+    # A hit reads the cached rows instead of the archive, and rules are applied again on top of them.
+    (uhtt_cache,) = cache_dir.glob("uhtt-reference-20230913.zip.*")
+    connection = sqlite3.connect(uhtt_cache)
+    try:
+        connection.execute("UPDATE candidates SET name = 'Майонез из кэша провансаль' WHERE barcode = '4601576009686'")
+        connection.commit()
+    finally:
+        connection.close()
+    _run_builder(raw_dir, cached_db, "--parse-cache", str(cache_dir))
+    connection = sqlite3.connect(cached_db)
+    try:
+        row = connection.execute("SELECT name, source FROM products WHERE barcode = '4601576009686'").fetchone()
+    finally:
+        connection.close()
+    assert row == ("Майонез из кэша провансаль", "uhtt"), row
+
+    uhtt_path = raw_dir / "uhtt-reference-20230913.zip"
+    original = uhtt_path.read_bytes()
+    try:
+        with zipfile.ZipFile(uhtt_path, "a") as archive:
+            archive.writestr("readme.txt", "changed")
+        _run_builder(raw_dir, cached_db, "--parse-cache", str(cache_dir))
+    finally:
+        uhtt_path.write_bytes(original)
+    assert uhtt_cache.name not in {path.name for path in cache_dir.iterdir()}, "stale cache entry was kept"
+    assert cached_db.read_bytes() == serial_db.read_bytes(), "changed source was not parsed again"
+
+    # Switching --jobs swaps the whole-archive UHTT entry for per-entry ones and back, without leaving the other kind.
+    def uhtt_entries() -> list:
+        return sorted(path.name for path in cache_dir.glob("uhtt-reference-20230913.zip.*"))
+
+    _run_builder(raw_dir, cached_db, "--parse-cache", str(cache_dir), "--jobs", "2")
+    (split_entry,) = uhtt_entries()
+    assert split_entry.startswith("uhtt-reference-20230913.zip.uhtt_barcode_ref_0001."), split_entry
+    assert cached_db.read_bytes() == serial_db.read_bytes(), "build from per-entry cache entries differs"
+    _run_builder(raw_dir, cached_db, "--parse-cache", str(cache_dir), "--jobs", "1")
+    (whole_entry,) = uhtt_entries()
+    assert "uhtt_barcode_ref_0001" not in whole_entry, whole_entry
+    assert cached_db.read_bytes() == serial_db.read_bytes(), "build after dropping per-entry cache entries differs"
+
+
+def _check_catalog_db_matches_csv(raw_dir: Path, tmp_path: Path, serial_db: Path) -> None:
+    db_raw_dir = tmp_path / "raw-catalog-db"
+    shutil.copytree(raw_dir, db_raw_dir)
+    db_zip = db_raw_dir / "catalog-barcodes-db.zip"
+    _write_catalog_db_zip(db_zip)
+    catalog_db = tmp_path / "catalog-db.sqlite"
+
+    # 'auto' keeps reading the CSV export while it is there.
+    _run_builder(db_raw_dir, catalog_db)
+    assert catalog_db.read_bytes() == serial_db.read_bytes(), "auto build did not stay on the CSV export"
+    assert not list(tmp_path.glob(".catalog-barcodes-db.*.sqlite")), "auto build extracted the database"
+
+    # The extraction goes to the staging directory (next to --output), never into the raw downloads.
+    raw_files = sorted(path.name for path in db_raw_dir.iterdir())
+    _run_builder(db_raw_dir, catalog_db, "--catalog-format", "db")
+    assert _products_and_digest(catalog_db) == _products_and_digest(serial_db), "build from the catalog database differs"
+    assert sorted(path.name for path in db_raw_dir.iterdir()) == raw_files, "build wrote into the raw directory"
+    (extracted,) = tmp_path.glob(".catalog-barcodes-db.*.sqlite")
+    extracted_mtime = extracted.stat().st_mtime_ns
+
+    _run_builder(db_raw_dir, catalog_db, "--catalog-format", "db")
+    assert _products_and_digest(catalog_db) == _products_and_digest(serial_db), "rebuild from the extraction differs"
+    assert extracted.stat().st_mtime_ns == extracted_mtime, "catalog database was extracted again"
+
+    def run_db_build() -> subprocess.CompletedProcess:
+        return subprocess.run(
+            ["python3", str(SCRIPT_PATH), "--raw-dir", str(db_raw_dir), "--output", str(catalog_db), "--catalog-format", "db"],
+            capture_output=True,
+            text=True,
+        )
+
+    # Typed barcode columns have lost the CSV's leading zeros or gained a ".0"; they are refused, not guessed.
+    for barcode_type in ("INTEGER", "REAL", ""):
+        _write_catalog_db_zip(db_zip, barcode_type)
+        result = run_db_build()
+        assert result.returncode == 1 and "not TEXT" in result.stderr, (barcode_type, result.stderr)
+    _write_catalog_db_zip(db_zip, "VARCHAR(32)")
+
+    # Without the CSV export 'auto' falls back to the database; a DB-only request without the zip is an error.
+    (db_raw_dir / "catalog-barcodes-csv.zip").unlink()
+    _run_builder(db_raw_dir, catalog_db)
+    assert _products_and_digest(catalog_db) == _products_and_digest(serial_db), "build without the CSV export differs"
+    db_zip.unlink()
+    result = run_db_build()
+    assert result.returncode == 1 and "[error]" in result.stderr, result.stderr
+
+
+def _check_sqlite_staging_matches_dict(raw_dir: Path, tmp_path: Path, serial_db: Path) -> None:
+    staging_dir = tmp_path / "staging"
+    staging_dir.mkdir()
+    staged_db = tmp_path / "staged.sqlite"
+    _run_builder(raw_dir, staged_db, "--aggregator", "sqlite", "--jobs", "2", "--staging-dir", str(staging_dir))
+    assert staged_db.read_bytes() == serial_db.read_bytes(), "sqlite staging output differs"
+    assert not list(staging_dir.iterdir()), "staging files were not cleaned up"
+
+
+def _check_positional_reader_matches_dictreader(tmp_path: Path) -> None:
+    bench = _import_bench()
+    dump = tmp_path / "synthetic-openfacts.csv.gz"
+    bench.write_openfacts_gzip(dump, rows=2_000)
+    with gzip.open(dump, "at", encoding="utf-8", newline="") as handle:
+        handle.write('4601234567893\t"quoted\tname"\n\n4601234567893\n')
+
+    reference = list(bench.parse_openfacts_dictreader(dump, "open_food_facts", 100))
+    positional = list(bench.builder.parse_openfacts_gzip(dump, "open_food_facts", 100))
+    assert positional == reference, "positional Open*Facts reader differs from DictReader"
+
+
+def _check_progress_through_zip(tmp_path: Path) -> None:
+    builder = _import_builder()
+    archive_path = tmp_path / "progress-uhtt.zip"
+    with zipfile.ZipFile(archive_path, "w", compression=zipfile.ZIP_STORED) as archive:
+        for index in range(3):
+            archive.writestr(f"DATA/part{index}.csv", os.urandom(1 << 16))
+    task = builder.SourceTask("uhtt", archive_path, "uhtt", 300)
+    total = builder.task_compressed_bytes(task)
+    member = -1
+    reported = []
+
+    class RecordingProgress(builder.BuildProgress):
+        def update(self, consumed: int) -> None:
+            super().update(consumed)
+            reported.append((member, self.done_bytes + self.position))
+
+    # ZipFile reads the central directory at the end of the archive before any member.
+    progress = RecordingProgress(total)
+    with progress.open(task) as handle, zipfile.ZipFile(handle) as archive:
+        names = archive.namelist()
+        for member, name in enumerate(names):
+            with archive.open(name) as entry:
+                while entry.read(4096):
+                    pass
+    progress.finish(task)
+
+    positions = [position for _, position in reported]
+    assert positions == sorted(positions), "progress went backwards"
+    early = [position for index, position in reported if index < len(names) - 1]
+    assert early and max(early) < total, "progress reached 100% before the last member"
+    assert progress.done_bytes == total
+
+
+def _check_pipelined_parse(raw_dir: Path, tmp_path: Path, serial_db: Path) -> None:
+    pipelined_db = tmp_path / "pipelined.sqlite"
+    _run_builder(raw_dir, pipelined_db, "--pipeline")
+    assert pipelined_db.read_bytes() == serial_db.read_bytes(), "pipelined build differs from serial build"
+
+    bench = _import_bench()
+    dump = tmp_path / "synthetic-pipeline.csv.gz"
+    bench.write_openfacts_gzip(dump, rows=2_000)
+    serial = list(bench.builder.parse_openfacts_gzip(dump, "open_food_facts", 100))
+    pipelined = list(bench.builder.parse_openfacts_gzip_pipelined(dump, "open_food_facts", 100))
+    assert pipelined == serial, "pipelined Open*Facts parse differs"
+
+    # Abandoning the generator early must stop and join the stage threads.
+    stream = bench.builder.parse_openfacts_gzip_pipelined(dump, "open_food_facts", 100)
+    next(stream)
+    stream.close()
+
+
+def _check_chunked_openfacts(raw_dir: Path, tmp_path: Path, serial_db: Path) -> None:
+    builder = _import_builder()
+    text = (
+        "code\tproduct_name\tbrands\n"
+        '4601234567893\t"multi\nline\tname"\tB\n'
+        '4601234567894\t"doubled ""quote""\n"\t"\n"\n'
+        '4601234567895\tinch 5"\t"ends"x\n'
+        "4601234567896\tplain\r\n"
+        '4601234567897\t"open\n\nstill open"\n'
+    )
+    lines = io.StringIO(text, newline="").readlines()
+    for size in range(1, len(lines) + 1):
+        chunks = list(builder.iter_record_chunks(lines, size))
+        assert "".join(chunks) == text
+        rows = [row for chunk in chunks for row in csv.reader(io.StringIO(chunk, newline=""), delimiter="\t")]
+        assert rows == list(csv.reader(io.StringIO(text, newline=""), delimiter="\t")), f"chunk size {size}"
+
+    chunked_db = tmp_path / "chunked.sqlite"
+    _run_builder(raw_dir, chunked_db, "--jobs", "2", "--openfacts-chunk-lines", "1")
+    assert chunked_db.read_bytes() == serial_db.read_bytes(), "chunked Open*Facts build differs from serial build"
+
+
+def _check_synthetic_build_benchmark(tmp_path: Path) -> None:
+    bench = _import_bench()
+    raw_dir = tmp_path / "synthetic-raw"
+    rows = bench.ensure_synthetic_raw(raw_dir, 2_000)
+    assert sum(rows.values()) >= 1_990, rows
+    result = bench.measure_build(raw_dir, tmp_path / "synthetic.sqlite", bench.builder.BuildSettings())
+    phases = [phase["phase"] for phase in result["phases"]]
+    assert phases[0] == "parse:uhtt" and phases[-1] == "write", phases
+    assert 0 < result["unique"] < result["rows"], result
+    assert not bench.compare_with_baseline("synthetic", result, result, 0.25, 0.15)
+
+    index = tmp_path / "synthetic.sqlite"
+    streams = bench.lookup_streams(index, 50, seed=1)
+    assert [len(barcodes) for barcodes in streams.values()] == [50, 50, 50], streams.keys()
+    variant = tmp_path / "synthetic-lookup.sqlite"
+    bench.make_lookup_variant(index, variant, 1024, extra_index=False)
+    connection = sqlite3.connect(variant)
+    try:
+        assert connection.execute("PRAGMA page_size").fetchone() == (1024,)
+        names = {name for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert bench.LOOKUP_EXTRA_INDEX not in names, names
+    finally:
+        connection.close()
+    for cold in (True, False):
+        latencies, pages = bench.measure_lookups(variant, streams["hits-zipf"][:5], cold)
+        assert len(latencies) == 5 and (pages is None or pages >= 0), (cold, latencies, pages)
+
+
+def _check_gtin_canonicalisation() -> None:
+    builder = _import_builder()
+    assert builder.canonicalize_gtin("4601576009686") == "4601576009686"
+    assert builder.canonicalize_gtin("04601576009686") == "4601576009686"
+    assert builder.canonicalize_gtin("036000291452") == "0036000291452"
+    assert builder.canonicalize_gtin("96385074") == "96385074"
+    assert builder.canonicalize_gtin("00000096385074") == "96385074"
+    assert builder.canonicalize_gtin("4601576009687") is None, "bad check digit accepted"
+    assert builder.canonicalize_gtin("12345") is None, "bad length accepted"
+    for barcode in ODD_DIGIT_BARCODES:
+        assert builder.canonicalize_gtin(barcode) is None, barcode
+    # UPC-E is checked on its UPC-A expansion, not with the GTIN-8 weights, but keeps the scanned 8 digits.
+    assert builder.expand_upce("04252614") == "042100005264"
+    assert builder.expand_upce("01234565") == "012345000065"
+    assert builder.canonicalize_gtin("04252614") == "04252614"
+    assert builder.canonicalize_gtin("04252615") is None, "bad UPC-E check digit accepted"
+    assert builder.canonicalize_gtin("01234565") == "01234565"
+
+
+def _check_name_kernel() -> None:
+    builder = _import_builder()
+    assert builder.normalize_text("\u00a0 Молоко\t 3,2%\n") == "Молоко 3,2%"
+    assert builder.normalize_barcode(" 460-157\u00b2 ") == "460157\u00b2", "str.isdigit() semantics changed"
+    assert builder.first_list_item(" Бренд , Другой ") == "Бренд"
+    assert builder.normalize_field("  ") is None
+
+    barcode = "4601576009686"
+    assert builder.name_reject_reason("  Штрих-код 1 ", barcode) == "generic_token"
+    assert builder.name_reject_reason("12 34", barcode) == "no_letters"
+    assert builder.name_reject_reason(f"A {barcode}", barcode) == "digits_only_name"
+    assert builder.name_reject_reason(f"Молоко {barcode}", barcode) is None
+    assert builder.compute_quality_score("Молоко  пастеризованное", barcode) == 21 * 2 + 22
+    # "ℂ" has no lowercase form, so the lowercased name still counts as upper case.
+    assert builder.compute_quality_score("ℂ 1234", "1234") == 1 * 2 + 6 - 2 - 20
+
+
+def _check_integer_schema(raw_dir: Path, tmp_path: Path) -> None:
+    integer_db = tmp_path / "integer.sqlite"
+    _run_builder(raw_dir, integer_db, "--schema", "integer")
+
+    connection = sqlite3.connect(integer_db)
+    try:
+        ddl = connection.execute("SELECT sql FROM sqlite_master WHERE name = 'products'").fetchone()[0]
+        assert "WITHOUT ROWID" in ddl, ddl
+        query = "SELECT name FROM products WHERE barcode = ? LIMIT 1"
+        for scanned in ("4601576009686", "04601576009686"):
+            row = connection.execute(query, (scanned,)).fetchone()
+            assert row == ("МАЙОНЕЗ МОСКОВСКИЙ ПРОВАНСАЛЬ",), (scanned, row)
+        # 1234567890123 has a wrong check digit and is rejected by the parsers.
+        assert connection.execute(query, ("1234567890123",)).fetchone() is None
+    finally:
+        connection.close()
+
+    # A UPC-E product is found with the code the scanner reports, through LocalBarcodeDatabaseReader's SQL.
+    upce_raw = tmp_path / "upce-raw"
+    shutil.copytree(raw_dir, upce_raw)
+    with gzip.open(upce_raw / "openproductsfacts-products.csv.gz", "wt", encoding="utf-8", newline="") as handle:
+        writer = csv.writer(handle, delimiter="\t", lineterminator="\n")
+        writer.writerow(["code", "product_name", "brands"])
+        writer.writerow(["04252614", "Жевательная резинка", "Wrigley"])
+        writer.writerow(["96385074", "Леденцы", "Halls"])
+    app_query = "SELECT name, brand, category FROM products WHERE barcode = ? LIMIT 1"
+    for extra in (("--schema", "integer"), ("--canonical-gtin",)):
+        upce_db = tmp_path / "upce.sqlite"
+        _run_builder(upce_raw, upce_db, *extra)
+        connection = sqlite3.connect(upce_db)
+        try:
+            assert connection.execute(app_query, ("04252614",)).fetchone() == (
+                "Жевательная резинка",
+                "Wrigley",
+                "Продукты",
+            ), extra
+            assert connection.execute(app_query, ("96385074",)).fetchone() == ("Леденцы", "Halls", "Продукты"), extra
+        finally:
+            connection.close()
+
+    # Codes the default build keeps as text are rejected like bad check digits, not fatal.
+    odd_raw = _odd_digit_raw_dir(raw_dir, tmp_path)
+    for extra in (("--schema", "integer"), ("--canonical-gtin",)):
+        odd_db = tmp_path / "odd-canonical.sqlite"
+        _run_builder(odd_raw, odd_db, *extra)
+        connection = sqlite3.connect(odd_db)
+        try:
+            barcodes = [str(barcode) for (barcode,) in connection.execute("SELECT barcode FROM products")]
+        finally:
+            connection.close()
+        assert barcodes == ["4601576009686"], (extra, barcodes)
+
+
+def _check_stats_json(raw_dir: Path, tmp_path: Path) -> None:
+    for extra in ((), ("--jobs", "2")):
+        stats_path = tmp_path / "stats.json"
+        _run_builder(raw_dir, tmp_path / "stats.sqlite", "--stats-json", str(stats_path), *extra)
+        stats = json.loads(stats_path.read_text(encoding="utf-8"))
+        sources = {source["source"]: source for source in stats["sources"]}
+
+        assert stats["totals"]["unique"] == 2, stats["totals"]
+        assert sources["uhtt"]["rejects"] == {"name_is_barcode": 1}, sources["uhtt"]
+        assert sources["uhtt"]["winners"] == 1, sources["uhtt"]
+        assert sources["catalog"]["winners"] == 0, sources["catalog"]
+        assert sources["open_beauty_facts"]["rejects"] == {"generic_token": 1}, sources["open_beauty_facts"]
+        assert sources["open_beauty_facts"]["winners"] == 1, sources["open_beauty_facts"]
+        assert sum(source["rows"] for source in sources.values()) == stats["totals"]["rows"] == 10
+
+
+def _check_openfacts_filters(raw_dir: Path, tmp_path: Path) -> None:
+    filter_raw_dir = tmp_path / "raw-filters"
+    filter_raw_dir.mkdir()
+    rows = [
+        ["code", "product_name", "brands", "countries_tags", "categories_tags"],
+        ["4600000000017", "Сок яблочный", "", "en:russia", "en:beverages,en:juices"],
+        ["4600000000024", "Шоколад молочный", "", "en:russia", "en:snacks"],
+        ["3017620422003", "Паста ореховая", "", "en:france,en:russia", "en:beverages"],
+        ["4600000000031", "Квас хлебный", "", "en:france", "en:beverages"],
+        ["4600000000048", "Морс клюквенный", "", "", "en:beverages"],
+    ]
+    with gzip.open(filter_raw_dir / "openbeautyfacts-products.csv.gz", "wt", encoding="utf-8", newline="") as handle:
+        csv.writer(handle, delimiter="\t", lineterminator="\n").writerows(rows)
+
+    stats_path = tmp_path / "filter-stats.json"
+    filters = ("--openfacts-countries", "Russia", "--openfacts-categories", "en:beverages")
+    command = [
+        "python3",
+        str(SCRIPT_PATH),
+        "--raw-dir",
+        str(filter_raw_dir),
+        "--output",
+        str(tmp_path / "filtered.sqlite"),
+        "--stats-json",
+        str(stats_path),
+        *filters,
+        "--openfacts-barcode-prefixes",
+        "460-469",
+    ]
+    result = subprocess.run(command, capture_output=True, text=True, check=True)
+    assert "[filter] open_beauty_facts: dropped country=2 category=1 barcode_prefix=1 of 5 rows" in result.stderr
+    (source,) = json.loads(stats_path.read_text(encoding="utf-8"))["sources"]
+    assert source["rows"] == 5 and source["winners"] == 1, source
+    assert source["rejects"] == {"filtered_barcode_prefix": 1, "filtered_category": 1, "filtered_country": 2}, source
+
+    connection = sqlite3.connect(tmp_path / "filtered.sqlite")
+    try:
+        assert connection.execute("SELECT barcode FROM products").fetchall() == [("4600000000017",)]
+    finally:
+        connection.close()
+
+    # A dump without the column a filter needs is an error, not an empty index.
+    result = subprocess.run(
+        ["python3", str(SCRIPT_PATH), "--raw-dir", str(raw_dir), "--output", str(tmp_path / "unfiltered.sqlite"), *filters],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 1 and "no countries_tags column" in result.stderr, result.stderr
+
+
+def _check_sampled_build(raw_dir: Path, tmp_path: Path, serial_db: Path) -> None:
+    # CRC-32 puts 4601576009686 at 0.42 and 1234567890123 at 0.46 of the hash space.
+    sampled_db = tmp_path / "sampled.sqlite"
+    stats_path = tmp_path / "sampled-stats.json"
+    _run_builder(raw_dir, sampled_db, "--sample", "0.44", "--stats-json", str(stats_path))
+    stats = json.loads(stats_path.read_text(encoding="utf-8"))
+    sources = {source["source"]: source for source in stats["sources"]}
+    assert stats["totals"]["rows"] == 10 and stats["totals"]["unique"] == 1, stats["totals"]
+    assert stats["estimate"]["unique"] == 2, stats["estimate"]
+    assert sources["open_beauty_facts"]["rejects"] == {"sampled_out": 2}, sources["open_beauty_facts"]
+
+    # Kept barcodes keep every source's candidates, so the winner matches the full build.
+    query = "SELECT * FROM products ORDER BY barcode"
+    sampled, full = sqlite3.connect(sampled_db), sqlite3.connect(serial_db)
+    try:
+        expected = [row for row in full.execute(query) if row[0] == "4601576009686"]
+        assert sampled.execute(query).fetchall() == expected
+    finally:
+        sampled.close()
+        full.close()
+
+
+def _check_multi_target_export(raw_dir: Path, tmp_path: Path, serial_db: Path) -> None:
+    builder = _import_builder()
+    assert builder.truncate_utf16("я" * 250, 200) == "я" * 200
+    assert builder.truncate_utf16("\U0001F600" * 3, 3) == "\U0001F600", "JS substring() splits surrogate pairs"
+    # Missing brands and categories are "" as in build-local-db.ts, not the iOS default category.
+    unit_db = tmp_path / "backend-unit.sqlite"
+    export = builder.BackendExport(unit_db, unit_db)
+    export.write(builder.Candidate("4600000000017", "Н" * 300, None, None, "uhtt", 300, 0))
+    export.finish()
+    export.close()
+    connection = sqlite3.connect(unit_db)
+    try:
+        assert connection.execute("SELECT * FROM products").fetchall() == [("4600000000017", "Н" * 200, "", "")]
+    finally:
+        connection.close()
+
+    ios_db = tmp_path / "export-ios.sqlite"
+    backend_db = tmp_path / "backend" / "local_barcode_db.sqlite"
+    ndjson = tmp_path / "products.ndjson.gz"
+    exports = ("--backend-output", str(backend_db), "--ndjson-output", str(ndjson))
+    _run_builder(raw_dir, ios_db, *exports)
+    assert ios_db.read_bytes() == serial_db.read_bytes(), "exports changed the iOS index"
+
+    connection = sqlite3.connect(ios_db)
+    try:
+        products = connection.execute(
+            "SELECT barcode, name, brand, category, source, source_rank, quality_score FROM products ORDER BY barcode"
+        ).fetchall()
+    finally:
+        connection.close()
+    connection = sqlite3.connect(backend_db)
+    try:
+        (table_sql,) = connection.execute("SELECT sql FROM sqlite_master WHERE name = 'products'").fetchone()
+        backend_rows = connection.execute("SELECT * FROM products ORDER BY barcode").fetchall()
+    finally:
+        connection.close()
+    assert " ".join(table_sql.split()) == (
+        "CREATE TABLE products ( barcode TEXT PRIMARY KEY, name TEXT NOT NULL, brand TEXT, category TEXT )"
+    ), table_sql
+    # The UHTT winner is exported too; build-local-db.ts only reads Open Food Facts.
+    assert backend_rows == [
+        ("1234567890123", "Корм для котов", "PetBrand", "Корма"),
+        ("4601576009686", "МАЙОНЕЗ МОСКОВСКИЙ ПРОВАНСАЛЬ", "МЖК", "Продукты"),
+    ], backend_rows
+
+    # Deliberate differences from build-local-db.ts, which would keep only the first row, as
+    # ("46-01234567890", "Чипсы", "Lays, PepsiCo", "Snacks, Chips"): the export follows the iOS rules.
+    backend_raw = tmp_path / "backend-raw"
+    backend_raw.mkdir()
+    with gzip.open(backend_raw / "openproductsfacts-products.csv.gz", "wt", encoding="utf-8", newline="") as handle:
+        writer = csv.writer(handle, delimiter="\t", lineterminator="\n")
+        writer.writerow(["code", "product_name", "product_name_ru", "brands", "categories", "countries_tags"])
+        writer.writerow(["46-01234567890", "Chips", "Чипсы", "Lays, PepsiCo", "Snacks, Chips", "en:france"])
+        writer.writerow(["4000000000017", "Gummibärchen", "", "Haribo", "Sweets", "en:germany"])
+    rules_db = tmp_path / "backend-rules.sqlite"
+    _run_builder(backend_raw, tmp_path / "backend-rules-ios.sqlite", "--backend-output", str(rules_db))
+    connection = sqlite3.connect(rules_db)
+    try:
+        assert connection.execute("SELECT * FROM products ORDER BY barcode").fetchall() == [
+            ("4000000000017", "Gummibärchen", "Haribo", "Sweets"),
+            ("4601234567890", "Chips", "Lays", "Snacks"),
+        ]
+    finally:
+        connection.close()
+    with gzip.open(ndjson, "rt", encoding="utf-8") as handle:
+        records = sorted((json.loads(line) for line in handle), key=lambda record: record["barcode"])
+    assert [tuple(record.values()) for record in records] == products, records
+
+    # Incremental builds rewrite the exports from the state store, even when the index is up to date.
+    backend_db.unlink()
+    ndjson.unlink()
+    for _ in range(2):
+        _run_builder(raw_dir, tmp_path / "export-incremental.sqlite", "--incremental", *exports)
+        connection = sqlite3.connect(backend_db)
+        try:
+            assert connection.execute("SELECT * FROM products ORDER BY barcode").fetchall() == backend_rows
+        finally:
+            connection.close()
+        with gzip.open(ndjson, "rt", encoding="utf-8") as handle:
+            assert sorted(json.loads(line)["barcode"] for line in handle) == [row[0] for row in products]
+
+
+def _read_index_meta(index_db: Path) -> dict:
+    builder = _import_builder()
+    connection = sqlite3.connect(f"file:{index_db}?mode=ro", uri=True)
+    try:
+        meta = builder.read_index_meta(connection)
+        assert meta is not None, f"{index_db} has no index_meta row"
+        assert meta["content_digest"] == builder.index_content_digest(connection).hexdigest(), index_db
+        assert meta["product_count"] == connection.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+    finally:
+        connection.close()
+    return meta
+
+
+def _check_index_meta(raw_dir: Path, tmp_path: Path, serial_db: Path) -> None:
+    builder = _import_builder()
+    meta = _read_index_meta(serial_db)
+    assert (meta["schema_version"], meta["products_schema"]) == (builder.INDEX_SCHEMA_VERSION, "text"), meta
+    assert meta["sources"]["uhtt"]["products"] >= 1, meta["sources"]
+    assert sum(entry["products"] for entry in meta["sources"].values()) == meta["product_count"]
+    assert meta["sources"]["uhtt"]["candidates"] >= meta["sources"]["uhtt"]["products"]
+
+    digest = builder.ContentDigest()
+    rows = [("1", "a", None, None, "uhtt", 1, 10), ("2", "b", "B", None, "uhtt", 1, 20)]
+    for row in rows:
+        digest.add(row)
+    reordered = builder.ContentDigest()
+    for row in reversed(rows):
+        reordered.add(row)
+    assert digest.hexdigest() == reordered.hexdigest()
+    digest.remove(rows[0])
+    assert (digest.hexdigest(), digest.count) != (reordered.hexdigest(), reordered.count)
+
+    meta_raw = tmp_path / "meta-raw"
+    shutil.copytree(raw_dir, meta_raw)
+    uhtt_file = "uhtt-reference-20230913.zip"
+    (meta_raw / "manifest.json").write_text(
+        json.dumps({"datasets": [{"file": uhtt_file, "sha256": "ab" * 32}]}), encoding="utf-8"
+    )
+    incremental_db = tmp_path / "meta-incremental.sqlite"
+    _run_builder(meta_raw, incremental_db, "--incremental", "--schema", "integer")
+    beauty_path = meta_raw / "openbeautyfacts-products.csv.gz"
+    with gzip.open(beauty_path, "wt", encoding="utf-8", newline="") as handle:
+        writer = csv.writer(handle, delimiter="\t", lineterminator="\n")
+        writer.writerow(["code", "product_name", "brands"])
+        writer.writerow(["4607001234567", "Крем для рук", "Бархатные ручки"])
+    _run_builder(meta_raw, incremental_db, "--incremental", "--schema", "integer")
+    full_db = tmp_path / "meta-full.sqlite"
+    _run_builder(meta_raw, full_db, "--schema", "integer")
+
+    # Maintained across the incremental update, the digest still matches a fresh recompute and a full build.
+    incremental = _read_index_meta(incremental_db)
+    full = _read_index_meta(full_db)
+    assert incremental["products_schema"] == "integer", incremental
+    for key in ("content_digest", "product_count", "sources"):
+        assert incremental[key] == full[key], (key, incremental[key], full[key])
+    assert full["sources"]["uhtt"]["files"] == {uhtt_file: "ab" * 32}, full["sources"]
+
+    shipped_db = tmp_path / "meta-shipped.sqlite"
+    shutil.copyfile(full_db, shipped_db)
+    builder.optimize_for_ship(shipped_db)
+    assert _read_index_meta(shipped_db) == full
+
+
+def _check_delta_patch(raw_dir: Path, tmp_path: Path) -> None:
+    builder = _import_builder()
+    previous_db = tmp_path / "previous.sqlite"
+    current_db = tmp_path / "current.sqlite"
+    _run_builder(raw_dir, previous_db)
+
+    beauty_path = raw_dir / "openbeautyfacts-products.csv.gz"
+    pet_path = raw_dir / "openpetfoodfacts-products.csv.gz"
+    original_beauty = beauty_path.read_bytes()
+    original_pet = pet_path.read_bytes()
+    with gzip.open(beauty_path, "wt", encoding="utf-8", newline="") as handle:
+        writer = csv.writer(handle, delimiter="\t", lineterminator="\n")
+        writer.writerow(["code", "product_name", "brands"])
+        writer.writerow(["4607001234567", "Крем для рук", "Бархатные ручки"])
+    pet_path.unlink()
+    try:
+        _run_builder(raw_dir, current_db, "--previous-index", str(previous_db))
+    finally:
+        beauty_path.write_bytes(original_beauty)
+        pet_path.write_bytes(original_pet)
+
+    delta_db = tmp_path / "current.delta.sqlite"
+    meta = builder.read_delta_meta(delta_db)
+    assert (meta["inserted"], meta["updated"], meta["deleted"]) == ("1", "1", "0"), meta
+
+    patched_db = tmp_path / "patched.sqlite"
+    builder.apply_delta(previous_db, delta_db, patched_db)
+    assert builder.first_product_difference(patched_db, current_db) is None
+    assert _read_index_meta(patched_db) == _read_index_meta(current_db)
+
+    try:
+        builder.apply_delta(current_db, delta_db, tmp_path / "wrong-base.sqlite")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("delta applied to an index it was not built against")
+    assert not (tmp_path / "wrong-base.sqlite").exists()
+
+
+def _check_search_index(raw_dir: Path, tmp_path: Path) -> None:
+    builder = _import_builder()
+    assert builder.search_match("Ёлочный  шар!") == '"елочный" "шар"*'
+    assert builder.search_match(" -- ") is None
+
+    for schema, key in (("text", "p.rowid"), ("integer", "p.barcode")):
+        search_db = tmp_path / f"search-{schema}.sqlite"
+        _run_builder(raw_dir, search_db, "--search-index", "--schema", schema)
+        connection = sqlite3.connect(search_db)
+        try:
+            query = (
+                f"SELECT p.name FROM products_search AS s JOIN products AS p ON {key} = s.rowid "
+                "WHERE products_search MATCH ? ORDER BY s.rank"
+            )
+            for text in ("майонез моск", "мжк", "МАЙО"):
+                rows = connection.execute(query, (builder.search_match(text),)).fetchall()
+                assert rows == [("МАЙОНЕЗ МОСКОВСКИЙ ПРОВАНСАЛЬ",)], (schema, text, rows)
+        finally:
+            connection.close()
+
+
+def _check_sharded_output(raw_dir: Path, tmp_path: Path) -> None:
+    builder = _import_builder()
+    assert builder.parse_prefix_ranges("460-469, 20") == [("460", "469"), ("20", "20")]
+    for bad in ("46-469", "469-460", "4a0"):
+        try:
+            builder.parse_prefix_ranges(bad)
+        except ValueError:
+            continue
+        raise AssertionError(f"accepted bad prefix range {bad!r}")
+
+    shard_dir = tmp_path / "shards"
+    _run_builder(
+        raw_dir, tmp_path / "sharded.sqlite", "--shard-dir", str(shard_dir), "--hot-prefixes", "460-469"
+    )
+    manifest = json.loads((shard_dir / "manifest.json").read_text(encoding="utf-8"))
+    assert [(shard["name"], shard["rows"]) for shard in manifest["shards"]] == [("hot", 1), ("range-1", 1)], manifest
+
+    expected = {
+        "4601576009686": "МАЙОНЕЗ МОСКОВСКИЙ ПРОВАНСАЛЬ",
+        "1234567890123": "Корм для котов",
+    }
+    for barcode, name in expected.items():
+        shard_file = builder.shard_for_barcode(manifest, barcode)
+        connection = sqlite3.connect(shard_dir / shard_file)
+        try:
+            row = connection.execute("SELECT name FROM products WHERE barcode = ? LIMIT 1", (barcode,)).fetchone()
+        finally:
+            connection.close()
+        assert row == (name,), (barcode, shard_file, row)
+    assert builder.shard_for_barcode(manifest, "7001234567890") is None
+
+    # Each shard carries index_meta for its own rows, and the order-independent digests add up.
+    total = 0
+    for shard in manifest["shards"]:
+        shard_meta = _read_index_meta(shard_dir / shard["file"])
+        assert (shard_meta["product_count"], shard_meta["content_digest"]) == (shard["rows"], shard["content_digest"])
+        total += int(shard_meta["content_digest"], 16)
+    assert f"{total % (1 << 256):064x}" == _read_index_meta(tmp_path / "sharded.sqlite")["content_digest"]
+
+
+def _check_binary_index(raw_dir: Path, tmp_path: Path) -> None:
+    builder = _import_builder()
+    for schema in ("text", "integer"):
+        output_db = tmp_path / f"binary-{schema}.sqlite"
+        binary_path = tmp_path / f"binary-{schema}.bcix"
+        _run_builder(raw_dir, output_db, "--schema", schema, "--binary-output", str(binary_path))
+
+        connection = sqlite3.connect(output_db)
+        try:
+            rows = connection.execute("SELECT barcode, name, brand, category FROM products").fetchall()
+        finally:
+            connection.close()
+        with builder.BinaryIndexReader(binary_path) as reader:
+            assert len(reader) == len(rows), (schema, len(reader), len(rows))
+            for barcode, name, brand, category in rows:
+                assert reader.lookup(str(barcode)) == (name, brand, category), (schema, barcode)
+            for missing in ("7001234567890", "", "not-a-barcode", "0"):
+                assert reader.lookup(missing) is None, (schema, missing)
+        if schema == "integer":
+            with builder.BinaryIndexReader(binary_path) as reader:
+                # Canonical layout: a UPC-A query finds the zero-padded GTIN-13 row.
+                assert reader.lookup("0" + str(rows[0][0]).zfill(13)) == tuple(rows[0][1:])
+
+    # The bench's parity check must find integer keys that lost their leading zeros, e.g. UPC-A codes.
+    bench = _import_bench()
+    upc_raw = tmp_path / "binary-upc-raw"
+    shutil.copytree(raw_dir, upc_raw)
+    with gzip.open(upc_raw / "openproductsfacts-products.csv.gz", "wt", encoding="utf-8", newline="") as handle:
+        writer = csv.writer(handle, delimiter="\t", lineterminator="\n")
+        writer.writerow(["code", "product_name", "brands"])
+        writer.writerow(["036000291452", "Салфетки бумажные", "Kleenex"])
+    upc_db = tmp_path / "binary-upc.sqlite"
+    _run_builder(upc_raw, upc_db, "--schema", "integer")
+    assert bench.bench_binary(upc_db, "100k", None, 2) == 0
+
+    # Text-layout barcodes that are not ASCII digits are skipped, not fatal.
+    odd_raw = _odd_digit_raw_dir(raw_dir, tmp_path)
+    odd_db = tmp_path / "binary-odd.sqlite"
+    odd_binary = tmp_path / "binary-odd.bcix"
+    _run_builder(odd_raw, odd_db, "--binary-output", str(odd_binary))
+    counts = builder.write_binary_index(odd_db, odd_binary)
+    assert (counts["rows"], counts["skipped"]) == (2, len(ODD_DIGIT_BARCODES)), counts
+    with builder.BinaryIndexReader(odd_binary) as reader:
+        assert reader.lookup("1234567890123") == ("Корм для котов сухой", "PetBrand", "Продукты")
+        for barcode in ODD_DIGIT_BARCODES:
+            assert reader.lookup(barcode) is None, barcode
+
+
+def _check_optimize_for_ship(raw_dir: Path, tmp_path: Path) -> None:
+    builder = _import_builder()
+    bench = _import_bench()
+    lookup = "SELECT name, brand, category FROM products WHERE barcode = ? LIMIT 1"
+    for schema, extra in (("text", ()), ("integer", ()), ("text", ("--search-index",))):
+        plain_db = tmp_path / f"ship-plain-{schema}.sqlite"
+        shipped_db = tmp_path / f"ship-{schema}.sqlite"
+        _run_builder(raw_dir, plain_db, "--schema", schema, *extra)
+        _run_builder(raw_dir, shipped_db, "--schema", schema, *extra, "--optimize-for-ship")
+        assert builder.products_schema(shipped_db) == schema
+
+        plain = sqlite3.connect(plain_db)
+        shipped = sqlite3.connect(f"file:{shipped_db}?mode=ro", uri=True)
+        try:
+            assert builder.is_shipped_index(shipped) and not builder.is_shipped_index(plain)
+            assert builder.products_digest(shipped) == builder.products_digest(plain)
+            for barcode in ("4601576009686", "1234567890123", "7001234567890"):
+                assert shipped.execute(lookup, (barcode,)).fetchall() == plain.execute(lookup, (barcode,)).fetchall()
+            indexes = {name for (name,) in shipped.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            assert "idx_products_source_rank_quality" not in indexes, indexes
+            assert shipped.execute("SELECT COUNT(*) FROM sqlite_stat1").fetchone()[0] > 0
+            assert shipped.execute("PRAGMA page_size").fetchone() == (builder.SHIP_PAGE_SIZE,)
+            if extra:
+                search = bench.search_sql(schema, ranked=True)
+                match = builder.search_match("корм")
+                assert shipped.execute(search, (match,)).fetchall() == plain.execute(search, (match,)).fetchall()
+        finally:
+            plain.close()
+            shipped.close()
+
+    try:
+        builder.optimize_for_ship(tmp_path / "ship-text.sqlite")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("optimized an already shipped index twice")
+
+
+def _check_incremental_rebuild(raw_dir: Path, tmp_path: Path, serial_db: Path) -> None:
+    builder = _import_builder()
+    incremental_db = tmp_path / "incremental.sqlite"
+    _run_builder(raw_dir, incremental_db, "--incremental")
+    assert (tmp_path / "incremental.sources.sqlite").exists(), "missing incremental state sidecar"
+
+    beauty_path = raw_dir / "openbeautyfacts-products.csv.gz"
+    original = beauty_path.read_bytes()
+    with gzip.open(beauty_path, "wt", encoding="utf-8", newline="") as handle:
+        writer = csv.writer(handle, delimiter="\t", lineterminator="\n")
+        writer.writerow(["code", "product_name", "brands"])
+        writer.writerow(["4607001234567", "Крем для рук", "Бархатные ручки"])
+    try:
+        _run_builder(raw_dir, incremental_db, "--incremental")
+    finally:
+        beauty_path.write_bytes(original)
+
+    connection = sqlite3.connect(incremental_db)
+    try:
+        rows = dict(connection.execute("SELECT barcode, name FROM products"))
+    finally:
+        connection.close()
+    assert rows.get("4607001234567") == "Крем для рук", rows
+    assert rows.get("1234567890123") == "Корм для котов", rows
+    assert rows.get("4601576009686") == "МАЙОНЕЗ МОСКОВСКИЙ ПРОВАНСАЛЬ", rows
+
+    # New options reset the state store; rows kept for the old options must not survive the rebuild.
+    sampled_db = tmp_path / "incremental-sampled-fresh.sqlite"
+    _run_builder(raw_dir, sampled_db, "--sample", "0.44")
+    _run_builder(raw_dir, incremental_db, "--incremental", "--sample", "0.44")
+    assert builder.first_product_difference(incremental_db, sampled_db) is None
+    _run_builder(raw_dir, incremental_db, "--incremental")
+    assert builder.first_product_difference(incremental_db, serial_db) is None
+
+    # A write that fails after parsing must not leave the new source hashes behind as "up to date".
+    interrupted_raw = tmp_path / "interrupted-raw"
+    shutil.copytree(raw_dir, interrupted_raw)
+    interrupted_db = tmp_path / "interrupted.sqlite"
+    builder.build_index(interrupted_raw, interrupted_db, True, incremental=True)
+    with gzip.open(interrupted_raw / "openbeautyfacts-products.csv.gz", "wt", encoding="utf-8", newline="") as handle:
+        writer = csv.writer(handle, delimiter="\t", lineterminator="\n")
+        writer.writerow(["code", "product_name", "brands"])
+        writer.writerow(["4607001234567", "Крем для рук", "Бархатные ручки"])
+
+    def failing_update(*args, **kwargs):
+        raise RuntimeError("simulated interrupted write")
+
+    update_products = builder.update_products
+    builder.update_products = failing_update
+    try:
+        builder.build_index(interrupted_raw, interrupted_db, True, incremental=True)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("the simulated write failure was swallowed")
+    finally:
+        builder.update_products = update_products
+    builder.build_index(interrupted_raw, interrupted_db, True, incremental=True)
+    rebuilt_db = tmp_path / "interrupted-full.sqlite"
+    _run_builder(interrupted_raw, rebuilt_db)
+    assert builder.first_product_difference(interrupted_db, rebuilt_db) is None
+
+
+def main() -> int:
     with tempfile.TemporaryDirectory() as tmp_dir:
         tmp_path = Path(tmp_dir)
         raw_dir = tmp_path / "raw"
-        raw_dir.mkdir(parents=True)
         output_db = tmp_path / "barcode_local_index.sqlite"
 
-        _write_uhtt_zip(raw_dir / "uhtt-reference-20230913.zip")
-        _write_catalog_zip(raw_dir / "catalog-barcodes-csv.zip")
-        _write_openfacts_gz(raw_dir / "openbeautyfacts-products.csv.gz")
-        _write_openfacts_gz(raw_dir / "openpetfoodfacts-products.csv.gz")
-        _write_openfacts_gz(raw_dir / "openproductsfacts-products.csv.gz")
-
-        subprocess.run(
-            [
-                "python3",
-                str(script_path),
-                "--raw-dir",
-                str(raw_dir),
-                "--output",
-                str(output_db),
-            ],
-            check=True,
-        )
+        _write_raw_fixture(raw_dir)
+        _run_builder(raw_dir, output_db)
 
         connection = sqlite3.connect(output_db)
         try:
@@ -98,6 +1080,33 @@ def main() -> int:
         finally:
             connection.close()
 
+        _check_failed_write_keeps_previous_output(tmp_path, output_db)
+        _check_parallel_build_matches_serial(raw_dir, tmp_path, output_db)
+        _check_compact_aggregator_matches_dict(raw_dir, tmp_path, output_db)
+        _check_sqlite_staging_matches_dict(raw_dir, tmp_path, output_db)
+        _check_checkpoint_resume(raw_dir, tmp_path, output_db)
+        _check_parse_cache(raw_dir, tmp_path, output_db)
+        _check_catalog_db_matches_csv(raw_dir, tmp_path, output_db)
+        _check_incremental_rebuild(raw_dir, tmp_path, output_db)
+        _check_positional_reader_matches_dictreader(tmp_path)
+        _check_progress_through_zip(tmp_path)
+        _check_pipelined_parse(raw_dir, tmp_path, output_db)
+        _check_chunked_openfacts(raw_dir, tmp_path, output_db)
+        _check_synthetic_build_benchmark(tmp_path)
+        _check_gtin_canonicalisation()
+        _check_name_kernel()
+        _check_integer_schema(raw_dir, tmp_path)
+        _check_stats_json(raw_dir, tmp_path)
+        _check_openfacts_filters(raw_dir, tmp_path)
+        _check_sampled_build(raw_dir, tmp_path, output_db)
+        _check_multi_target_export(raw_dir, tmp_path, output_db)
+        _check_index_meta(raw_dir, tmp_path, output_db)
+        _check_delta_patch(raw_dir, tmp_path)
+        _check_search_index(raw_dir, tmp_path)
+        _check_sharded_output(raw_dir, tmp_path)
+        _check_binary_index(raw_dir, tmp_path)
+        _check_optimize_for_ship(raw_dir, tmp_path)
+
     print("ok")
     return 0
 